@@ -11,8 +11,6 @@ class contained in the infrastructure directory.
 
 import logging
 
-from fab.steps.grab.folder import grab_folder
-
 from lfric_base import LFRicBase
 
 
@@ -27,8 +25,8 @@ class FabGravityWave(LFRicBase):
 
         # pylint: disable=redefined-builtin
         for dir in dirs:
-            grab_folder(self.config, src=self.lfric_apps_root / dir,
-                        dst_label='')
+            self.grab_folder(src=self.lfric_apps_root / dir,
+                             dst_label='')
 
     def get_rose_meta(self):
         return (self.lfric_apps_root / 'applications' / 'gravity_wave'
@@ -11,8 +11,6 @@ contained in the infrastructure directory.
 
 import logging
 
-from fab.steps.grab.folder import grab_folder
-
 from lfric_base import LFRicBase
 
 
@@ -26,13 +24,13 @@ class FabGungho(LFRicBase):
                 ]
         # pylint: disable=redefined-builtin
         for dir in dirs:
-            grab_folder(self.config, src=self.lfric_apps_root / dir,
-                        dst_label='')
+            self.grab_folder(src=self.lfric_apps_root / dir,
+                             dst_label='')
 
         # Copy the optimisation scripts into a separate directory
         dir = 'applications/gungho_model/optimisation'
-        grab_folder(self.config, src=self.lfric_apps_root / dir,
-                    dst_label='optimisation')
+        self.grab_folder(src=self.lfric_apps_root / dir,
+                         dst_label='optimisation')
 
     def get_rose_meta(self):
         return (self.lfric_apps_root / 'applications' / 'gungho_model'
@@ -9,18 +9,16 @@
 contained in the infrastructure directory.
 '''
 
+from functools import partial
 import logging
 
-from fab.steps.grab.fcm import fcm_export
-from fab.steps.grab.folder import grab_folder
 from fab.build_config import AddFlags
-from fab.steps.find_source_files import Exclude, Include
 from fab.tools import Category
 
 from lfric_base import LFRicBase
 from get_revision import GetRevision
 
-from fcm_extract import FcmExtract
+from source_cache import fcm_export_cached
 
 
 class FabLFRicAtm(LFRicBase):
@@ -33,57 +31,57 @@ class FabLFRicAtm(LFRicBase):
              '-DCOUPLED', '-DUSE_MPI=YES'], self._preprocessor_flags)
 
     def grab_files(self):
-        super().grab_files()
-        dirs = ['science/coupled_interface/source/',
-                'science/gungho/source',
-                'science/um_physics_interface/source/',
-                'science/socrates_interface/source/',
-                'science/jules_interface/source/',
-                'applications/lfric_atm/source',
-                'science/shared/source/',
-                ]
-        # pylint: disable=redefined-builtin
-        for dir in dirs:
-            grab_folder(self.config,
-                        src=self.lfric_apps_root / dir,
-                        dst_label='')
-
-        gr = GetRevision("../../dependencies.sh")
-        xm = "xm"
-        for lib, revision in gr.items():
-            # Shumlib has no src directory
-            if lib == "shumlib":
-                src = ""
-            else:
-                src = "/src"
-            print(f'fcm:{lib}.{xm}_tr{src}', f'science/{lib}', revision)
-            fcm_export(self.config, src=f'fcm:{lib}.{xm}_tr/{src}',
-                       dst_label=f'science/{lib}', revision=revision)
-
-        # Copy the optimisation scripts into a separate directory
-        dir = 'applications/lfric_atm/optimisation'
-        grab_folder(self.config, src=self.lfric_apps_root / dir,
-                    dst_label='optimisation')
+        with self.concurrent_grabs():
+            super().grab_files()
+            dirs = ['science/coupled_interface/source/',
+                    'science/gungho/source',
+                    'science/um_physics_interface/source/',
+                    'science/socrates_interface/source/',
+                    'science/jules_interface/source/',
+                    'applications/lfric_atm/source',
+                    'science/shared/source/',
+                    ]
+            # pylint: disable=redefined-builtin
+            for dir in dirs:
+                self.grab_folder(src=self.lfric_apps_root / dir,
+                                 dst_label='')
+
+            # Only copy the files of a library that are used according
+            # to the extract rules (see find_source_files)
+            extract = self.read_extract(self.lfric_apps_root / "build" /
+                                        "extract" / "extract.cfg")
+            gr = GetRevision("../../dependencies.sh")
+            xm = "xm"
+            for lib, revision in gr.items():
+                # Shumlib has no src directory
+                if lib == "shumlib":
+                    src = ""
+                else:
+                    src = "src"
+                print(f'fcm:{lib}.{xm}_tr/{src}', f'science/{lib}', revision)
+                self.add_grab(f'fcm:{lib}.{xm}_tr/{src}@{revision}',
+                              partial(fcm_export_cached, self.config,
+                                      self.source_cache,
+                                      url=f'fcm:{lib}.{xm}_tr', path=src,
+                                      dst_label=f'science/{lib}',
+                                      revision=revision,
+                                      path_filter=extract.get_path_filter(
+                                          lib)),
+                              dst_label=f'science/{lib}')
+
+            # Copy the optimisation scripts into a separate directory
+            dir = 'applications/lfric_atm/optimisation'
+            self.grab_folder(src=self.lfric_apps_root / dir,
+                             dst_label='optimisation')
 
     def find_source_files(self):
         """Based on $LFRIC_APPS_ROOT/build/extract/extract.cfg"""
 
-        extract = FcmExtract(self.lfric_apps_root / "build" / "extract" /
-                             "extract.cfg")
+        extract = self.read_extract(self.lfric_apps_root / "build" /
+                                    "extract" / "extract.cfg")
 
         science_root = self.config.source_root / 'science'
-        path_filters = []
-        for section, source_file_info in extract.items():
-            for (list_type, list_of_paths) in source_file_info:
-                if list_type == "exclude":
-                    path_filters.append(Exclude(science_root / section))
-                else:
-                    # Remove the 'src' which is the first part of the name
-                    new_paths = [i.relative_to(i.parents[-2])
-                                 for i in list_of_paths]
-                    for path in new_paths:
-                        path_filters.append(Include(science_root /
-                                                    section / path))
+        path_filters = [extract.get_path_filter_index(science_root)]
         super().find_source_files(path_filters=path_filters)
 
     def get_rose_meta(self):
@@ -9,53 +9,134 @@
 contained in the infrastructure directory.
 '''
 
+from fnmatch import fnmatchcase
 import logging
+from pathlib import Path
+import shutil
 
 from fab.artefacts import ArtefactSet
+from fab.steps import run_mp, step
 from fab.tools import Category
+from fab.util import log_or_dot, TimerLogger
+
+from cache_util import hash_file, hash_strings
+from memory_budget import memory_limited
 
 from fab_lfric_atm import FabLFRicAtm
 
+logger = logging.getLogger('fab')
+
 
 class FabLFRicAtmUmTransform(FabLFRicAtm):
     '''An lfric_atm build script that additional shows how to call
     PSyclone with a transformation script for existing Fortran code.
+    The files to transform, and the script for each file, are listed in
+    the manifest `optimisation/um_transform_manifest.txt`.
     '''
 
-    def get_um_script(self, input_file, config):
-        ''':returns: the PSyclone script to be used for the specified
-            input file. ATM this always returns the same script.
-            See lfric_base.get_transformation_script for a more
-            elaborate example.
+    STAGES = FabLFRicAtm.STAGES + ["um_transform"]
+
+    def get_um_manifest(self, config):
+        ''':returns: the list of glob patterns and transformation scripts
+            from the manifest file.
+        :rtype: List[Tuple[str, Path]]
         '''
-        return config.source_root / "optimisation" / "umscript.py"
+        optimisation_path = config.source_root / "optimisation"
+        manifest = []
+        with open(optimisation_path / "um_transform_manifest.txt",
+                  encoding="utf8") as f_in:
+            for line in f_in:
+                line = line.split("#", 1)[0].strip()
+                if not line:
+                    continue
+                pattern, script = line.split()
+                manifest.append((pattern, optimisation_path / script))
+        return manifest
 
-    def psyclone(self):
-        super().psyclone()
+    def get_um_scripts(self, input_files, config):
+        ''':returns: the PSyclone script to be used for each input file
+            that is listed in the manifest.
+        :rtype: Dict[Path, Path]
+        '''
+        manifest = self.get_um_manifest(config)
+        scripts = {}
+        for input_file in input_files:
+            try:
+                relative_path = str(input_file.relative_to(
+                    config.build_output))
+            except ValueError:
+                continue
+            for pattern, script in manifest:
+                if fnmatchcase(relative_path, pattern):
+                    scripts[input_file] = script
+        return scripts
 
-        psyclone = self.config.tool_box[Category.PSYCLONE]
-        psyclone_cli_args = self.get_psyclone_config()
-        # Long term we would want to run these in parallel, but for
-        # now this version is easy to understand. Add more files
-        # as required to the loop. Note that the files are already
-        # preprocessed at this stage, so make sure not to use capital
-        # F90!
-        for file in ["science/um/atmosphere/boundary_layer/bdy_impl3.f90"]:
-            file_path = self.config.build_output / file
-            # Make up a new output filename
-            transformed_file = file_path.with_stem(file_path.stem +
-                                                   "_psyclonified")
-            psyclone.process(config=self.config,
+    @staticmethod
+    def transform_one_file(args):
+        '''Transforms one file with PSyclone, and stores the result as a
+        prebuild, keyed by the hashes of the input file, the script and the
+        PSyclone arguments (including the content of files, e.g. the
+        PSyclone configuration file). If the prebuild exists, PSyclone is
+        not run.
+
+        :returns: the transformed file and the prebuild file.
+        '''
+        config, file_path, script, psyclone_cli_args = args
+        # Make up a new output filename
+        transformed_file = file_path.with_stem(file_path.stem +
+                                               "_psyclonified")
+        key = hash_strings(hash_file(file_path), hash_file(script),
+                           *(hash_file(Path(arg)) if Path(arg).is_file()
+                             else arg for arg in psyclone_cli_args))
+        prebuild = (config.prebuild_folder /
+                    f"{transformed_file.stem}.{key}{file_path.suffix}")
+        if prebuild.exists():
+            log_or_dot(logger, f"Transforming using prebuild: {prebuild}")
+        else:
+            log_or_dot(logger, f"Transforming '{file_path}' with '{script}'")
+
+            def get_um_script(_input_file, _config):
+                return script
+
+            psyclone = config.tool_box[Category.PSYCLONE]
+            psyclone.process(config=config,
                              x90_file=file_path,
                              api=None,     # This triggers transformation only
                              transformed_file=transformed_file,
-                             transformation_script=self.get_um_script,
+                             transformation_script=get_um_script,
                              additional_parameters=psyclone_cli_args)
-            # Now remove the unprocessed file from the build files, and add
-            # the newly file processed file
-            self.config.artefact_store.replace(ArtefactSet.FORTRAN_BUILD_FILES,
-                                               [file_path],
-                                               [transformed_file])
+            shutil.copy2(transformed_file, prebuild)
+            return transformed_file, prebuild
+        shutil.copy2(prebuild, transformed_file)
+        return transformed_file, prebuild
+
+    @step
+    def um_transform(self):
+        '''Transforms all UM files listed in the manifest in parallel.
+        The files are already preprocessed at this stage, so the manifest
+        must use .f90 (not .F90).
+        '''
+        config = self.config
+        input_files = config.artefact_store[ArtefactSet.FORTRAN_BUILD_FILES]
+        scripts = self.get_um_scripts(input_files, config)
+        psyclone_cli_args = [str(arg) for arg in self.get_psyclone_config()]
+        args = [(config, file_path, script, psyclone_cli_args)
+                for file_path, script in sorted(scripts.items())]
+        with TimerLogger(f"transforming {len(args)} UM files"), \
+                self.stage_jobs("um_transform") as stage_config, \
+                memory_limited(config, "um_transform", self.memory_limit):
+            results = run_mp(stage_config, args, self.transform_one_file)
+        config.add_current_prebuilds([prebuild for _, prebuild in results])
+        # Now remove the unprocessed files from the build files, and add
+        # the newly processed files
+        config.artefact_store.replace(
+            ArtefactSet.FORTRAN_BUILD_FILES,
+            [file_path for _, file_path, _, _ in args],
+            [transformed_file for transformed_file, _ in results])
+
+    def psyclone(self):
+        super().psyclone()
+        self.um_transform()
 
 
 # -----------------------------------------------------------------------------
@@ -9,20 +9,31 @@
 contained in the infrastructure directory.
 '''
 
+from functools import partial
 import logging
 import os
 
-from fab.steps.grab.fcm import fcm_export
-from fab.steps.grab.folder import grab_folder
 from fab.build_config import AddFlags
 from fab.steps.find_source_files import Exclude, Include
 
+from get_revision import GetRevision
 from lfric_base import LFRicBase
-
-from fcm_extract import FcmExtract
+from source_cache import fcm_export_cached
 
 
 class FabLfricInputs(LFRicBase):
+    '''The build script for all lfricinputs tools. The scripts for the
+    individual tools derive from this class, and only change the source
+    directories that are grabbed. All scripts use the same workspace, so
+    they share the configuration output and the object files (which are
+    kept for KEEP_PREBUILDS_DAYS instead of being removed if the last build
+    did not use them).
+    '''
+    # The directories in lfric_apps to grab, in addition to the science
+    # interfaces
+    SOURCE_DIRS = ['applications/lfricinputs/source/']
+
+    KEEP_PREBUILDS_DAYS = 30
 
     def define_preprocessor_flags(self):
         super().define_preprocessor_flags()
@@ -32,28 +43,38 @@ class FabLfricInputs(LFRicBase):
              '-DCOUPLED', '-DUSE_MPI=YES'], self._preprocessor_flags)
 
     def grab_files(self):
-        super().grab_files()
-        dirs = ['applications/lfricinputs/source/',
+        with self.concurrent_grabs():
+            super().grab_files()
+            dirs = self.SOURCE_DIRS + [
                 'science/um_physics_interface/source/',
                 'science/jules_interface/source/',
                 'science/socrates_interface/source/',
                 'science/gungho/source',
                 ]
 
-        # pylint: disable=redefined-builtin
-        for dir in dirs:
-            grab_folder(self.config, src=self.lfric_apps_root / dir,
-                        dst_label=dir)
-
-        fcm_export(self.config, src=f'fcm:shumlib.xm_tr',
-                   dst_label=f'shumlib')
+            # pylint: disable=redefined-builtin
+            for dir in dirs:
+                self.grab_folder(src=self.lfric_apps_root / dir,
+                                 dst_label=dir)
+
+            # Use the shumlib revision of lfric_apps, so that the export
+            # can be taken from the source cache
+            revision = GetRevision(self.lfric_apps_root /
+                                   "dependencies.sh").get("shumlib")
+            self.add_grab("fcm:shumlib.xm_tr",
+                          partial(fcm_export_cached, self.config,
+                                  self.source_cache, url='fcm:shumlib.xm_tr',
+                                  path='', dst_label='shumlib',
+                                  revision=revision),
+                          dst_label='shumlib')
 
     def find_source_files(self):
         """Based on $LFRIC_APPS_ROOT/applications/lfricinputs/fcm-make"""
 
-        shumlib_extract = FcmExtract(self.lfric_apps_root / "applications" /
-                                     "lfricinputs" / "fcm-make" / "util" /
-                                     "common" / "extract-shumlib.cfg")
+        extract_dir = (self.lfric_apps_root / "applications" / "lfricinputs" /
+                       "fcm-make" / "util" / "common")
+        shumlib_extract = self.read_extract(extract_dir /
+                                            "extract-shumlib.cfg")
         shumlib_root = self.config.source_root / 'science'
         path_filters = []
         for section, source_file_info in shumlib_extract.items():
@@ -65,14 +86,11 @@ class FabLfricInputs(LFRicBase):
                         path_filters.append(Include(shumlib_root /
                                                     section / path))
 
-        infra_extract = FcmExtract(self.lfric_apps_root / "applications" /
-                                   "lfricinputs" / "fcm-make" / "util" /
-                                   "common" / "extract-lfric-core.cfg")
+        infra_extract = self.read_extract(extract_dir /
+                                          "extract-lfric-core.cfg")
 
-        infra_extract.update(FcmExtract(self.lfric_apps_root /
-                                        "applications" / "lfricinputs" /
-                                        "fcm-make" / "util" /
-                                        "common" / "extract-lfric-apps.cfg"))
+        infra_extract.update(self.read_extract(extract_dir /
+                                               "extract-lfric-apps.cfg"))
 
         for section, source_file_info in infra_extract.items():
             for (list_type, list_of_paths) in source_file_info:
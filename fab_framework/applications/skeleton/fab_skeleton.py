@@ -11,8 +11,6 @@ the LFRicBase class contained in the infrastructure directory.
 
 import logging
 
-from fab.steps.grab.folder import grab_folder
-
 from lfric_base import LFRicBase
 
 
@@ -24,13 +22,13 @@ class FabSkeleton(LFRicBase):
 
         # pylint: disable=redefined-builtin
         for dir in dirs:
-            grab_folder(self.config, src=self.lfric_core_root / dir,
-                        dst_label='')
+            self.grab_folder(src=self.lfric_core_root / dir,
+                             dst_label='')
 
         # Copy the optimisation scripts into a separate directory
         dir = 'applications/skeleton/optimisation/'
-        grab_folder(self.config, src=self.lfric_core_root / dir,
-                    dst_label='optimisation')
+        self.grab_folder(src=self.lfric_core_root / dir,
+                         dst_label='optimisation')
 
     def get_rose_meta(self):
         return (self.lfric_core_root / 'applications' / 'skeleton' /
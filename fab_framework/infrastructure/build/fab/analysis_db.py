@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''This module contains a persistent database of Fab's dependency analysis
+results. Fab stores the analysis of each file as a prebuild
+(`<stem>.<hash>.an`), so a file is only parsed again if its content has
+changed. But the prebuilds are lost when the workspace is removed (e.g.
+by a clean build), and they cannot be shared between workspaces.
+
+The database stores the content of each analysis file in a shared SQLite
+database, keyed by the path of the file relative to the build output
+directory, the hash of its content, and the Fab version. Since the
+analysed files are already preprocessed, the hash covers the effect of
+the preprocessor flags. The build output directory in the analysis is
+replaced with a placeholder, so that the results can be used in other
+workspaces. Before the analysis, missing prebuilds are restored from the
+database, and afterwards new analysis results are added to it:
+
+    with analysis_db.restored(config):
+        analyse(config, ...)
+'''
+
+from contextlib import contextmanager
+import logging
+from pathlib import Path
+import sqlite3
+import time
+from typing import Dict, Iterable
+
+import fab
+from fab.artefacts import ArtefactSet
+from fab.util import file_checksum
+
+logger = logging.getLogger('fab')
+
+
+class AnalysisDatabase:
+    '''A persistent database of analysis results.
+
+    :param db_path: the SQLite database file.
+    :param max_age_days: entries that have not been used for this number
+        of days are removed.
+    '''
+    # Replaces the build output directory in the stored analysis
+    PLACEHOLDER = "$FAB_BUILD_OUTPUT"
+
+    # The number of rows written in one transaction, so that other builds
+    # do not have to wait for the whole restore or harvest
+    BATCH_SIZE = 500
+
+    def __init__(self, db_path: Path, max_age_days: float = 60):
+        self._db_path = db_path
+        self._max_age = max_age_days * 24 * 3600
+        self._version = getattr(fab, "__version__", "")
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS analysis ("
+                "path TEXT, file_hash TEXT, fab_version TEXT, result TEXT, "
+                "last_used REAL, "
+                "PRIMARY KEY (path, file_hash, fab_version))")
+
+    def _connect(self) -> sqlite3.Connection:
+        ''':returns: a connection to the database, which waits if the
+            database is locked by another build. The default rollback
+            journal is used, since the write-ahead log relies on shared
+            memory, which does not work on network file systems (e.g.
+            Lustre or NFS).'''
+        return sqlite3.connect(self._db_path, timeout=600)
+
+    @staticmethod
+    def get_analysed_files(config) -> Iterable[Path]:
+        ''':returns: the files analysed by Fab.'''
+        for artefact_set in [ArtefactSet.FORTRAN_BUILD_FILES,
+                             ArtefactSet.C_BUILD_FILES]:
+            yield from config.artefact_store.get(artefact_set, set())
+
+    @staticmethod
+    def get_analysis_fpath(config, fpath: Path, file_hash: int) -> Path:
+        ''':returns: the name of the prebuild file that Fab uses for the
+            analysis of a file.'''
+        return config.prebuild_folder / f'{fpath.stem}.{file_hash}.an'
+
+    @staticmethod
+    def get_relative_path(config, fpath: Path) -> str:
+        ''':returns: the path of a file relative to the build output
+            directory (or the absolute path if it is not in there).'''
+        try:
+            return str(fpath.relative_to(config.build_output))
+        except ValueError:
+            return str(fpath)
+
+    def restore(self, config, file_hashes: Dict[Path, int]) -> int:
+        '''Restores the analysis prebuilds for all files that are stored
+        in the database, but do not have a prebuild.
+
+        :param config: the Fab build config.
+        :param file_hashes: the files and their hashes.
+
+        :returns: the number of restored prebuilds.
+        '''
+        build_output = str(config.build_output)
+        config.prebuild_folder.mkdir(parents=True, exist_ok=True)
+        used = []
+        connection = self._connect()
+        try:
+            for fpath, file_hash in file_hashes.items():
+                analysis_fpath = self.get_analysis_fpath(config, fpath,
+                                                         file_hash)
+                if analysis_fpath.exists():
+                    continue
+                key = (self.get_relative_path(config, fpath), str(file_hash),
+                       self._version)
+                row = connection.execute(
+                    "SELECT result FROM analysis WHERE path=? AND "
+                    "file_hash=? AND fab_version=?", key).fetchone()
+                if not row:
+                    continue
+                analysis_fpath.write_text(
+                    row[0].replace(self.PLACEHOLDER, build_output),
+                    encoding="utf8")
+                used.append(key)
+            # Only update the time stamps after reading, in short
+            # transactions
+            now = time.time()
+            for start in range(0, len(used), self.BATCH_SIZE):
+                with connection:
+                    connection.executemany(
+                        "UPDATE analysis SET last_used=? WHERE path=? AND "
+                        "file_hash=? AND fab_version=?",
+                        [(now,) + key
+                         for key in used[start:start + self.BATCH_SIZE]])
+        finally:
+            connection.close()
+        return len(used)
+
+    def harvest(self, config, file_hashes: Dict[Path, int]) -> int:
+        '''Stores the analysis prebuilds of all files in the database,
+        and removes old entries.
+
+        :param config: the Fab build config.
+        :param file_hashes: the files and their hashes.
+
+        :returns: the number of stored analysis results.
+        '''
+        build_output = str(config.build_output)
+        rows = []
+        now = time.time()
+        for fpath, file_hash in file_hashes.items():
+            analysis_fpath = self.get_analysis_fpath(config, fpath, file_hash)
+            try:
+                result = analysis_fpath.read_text(encoding="utf8")
+            except OSError:
+                continue
+            rows.append((self.get_relative_path(config, fpath),
+                         str(file_hash), self._version,
+                         result.replace(build_output, self.PLACEHOLDER), now))
+        connection = self._connect()
+        try:
+            for start in range(0, len(rows), self.BATCH_SIZE):
+                with connection:
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO analysis "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        rows[start:start + self.BATCH_SIZE])
+            with connection:
+                connection.execute("DELETE FROM analysis WHERE last_used < ?",
+                                   (now - self._max_age,))
+        finally:
+            connection.close()
+        return len(rows)
+
+    @contextmanager
+    def restored(self, config):
+        '''A context manager for running Fab's analysis: missing prebuilds
+        are restored from the database before, and all analysis results
+        are stored in the database afterwards.
+
+        :param config: the Fab build config.
+        '''
+        file_hashes = {fpath: file_checksum(fpath).file_hash
+                       for fpath in self.get_analysed_files(config)}
+        start = time.time()
+        restored = self.restore(config, file_hashes)
+        logger.info(f"Restored {restored} of {len(file_hashes)} analysis "
+                    f"results from '{self._db_path}' in "
+                    f"{time.time() - start:.1f}s.")
+        yield
+        start = time.time()
+        stored = self.harvest(config, file_hashes)
+        logger.info(f"Stored {stored} analysis results in "
+                    f"'{self._db_path}' in {time.time() - start:.1f}s.")
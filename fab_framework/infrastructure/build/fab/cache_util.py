@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''This module contains the building blocks for the persistent caches used
+by the LFRic build scripts. A cache is a directory in which each entry is
+a sub-directory named after the hash of everything that determines its
+content. The caches are shared between builds (and workspaces), and are
+limited in size by removing the least recently used entries.
+'''
+
+from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional, Union
+
+logger = logging.getLogger('fab')
+
+
+def get_cache_root() -> Path:
+    ''':returns: the root directory of all caches. This is
+        $LFRIC_FAB_CACHE if set, otherwise `lfric_fab` in the user's cache
+        directory ($XDG_CACHE_HOME or ~/.cache). The caches are not
+        stored in the Fab workspace, so that they survive a clean build
+        that removes the workspace.'''
+    cache_root = os.environ.get("LFRIC_FAB_CACHE")
+    if cache_root:
+        return Path(cache_root)
+    xdg_cache = os.environ.get("XDG_CACHE_HOME")
+    if xdg_cache:
+        return Path(xdg_cache) / "lfric_fab"
+    return Path.home() / ".cache" / "lfric_fab"
+
+
+def hash_strings(*strings: Union[str, Path]) -> str:
+    ''':returns: a hex digest of all strings.'''
+    hasher = hashlib.sha256()
+    for string in strings:
+        hasher.update(str(string).encode())
+        # Separator, so that ("ab", "c") and ("a", "bc") differ
+        hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+def hash_file(fpath: Path) -> str:
+    ''':returns: a hex digest of the content of the file.'''
+    hasher = hashlib.sha256()
+    with open(fpath, "rb") as f_in:
+        for block in iter(lambda: f_in.read(1024 * 1024), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def hash_files(fpaths: Iterable[Path]) -> str:
+    ''':returns: a hex digest of the names and contents of all files.'''
+    return hash_strings(*(f"{fpath}:{hash_file(fpath)}"
+                          for fpath in fpaths))
+
+
+def get_tree_size(path: Path) -> int:
+    ''':returns: the size of all files in a directory tree in bytes.'''
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class DirectoryCache:
+    '''A persistent cache, in which each entry is a directory. The entry
+    for key `KEY` is stored in `ROOT/KEY/data`, with some metadata in
+    `ROOT/KEY/entry.json`. The modification time of the metadata file
+    records when an entry was last used. If the total size of all
+    entries exceeds the maximum size, the least recently used entries
+    are removed.
+
+    :param root: the root directory of the cache.
+    :param max_size: the maximum size of the cache in bytes.
+    '''
+    def __init__(self, root: Path, max_size: int):
+        self._root = root
+        self._max_size = max_size
+        self._root.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def root(self) -> Path:
+        ''':returns: the root directory of the cache.'''
+        return self._root
+
+    @contextmanager
+    def lock(self, shared: bool = False):
+        '''A context manager that holds a lock on the cache, so that
+        several builds can share a cache. An exclusive lock is needed to
+        add or remove entries, a shared lock prevents entries from being
+        removed while they are used.
+
+        :param shared: whether to take a shared instead of an exclusive
+            lock.
+        '''
+        with open(self._root / ".lock", "a", encoding="utf8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def lookup(self, key: str) -> Optional[Path]:
+        '''Looks up an entry, and marks it as used. Note that without a
+        lock the entry can be removed at any time by another build, see
+        `use`.
+
+        :returns: the data directory of the entry, or None if the entry
+            does not exist.
+        '''
+        entry = self._root / key
+        meta = entry / "entry.json"
+        if not meta.exists():
+            return None
+        try:
+            os.utime(meta)
+        except OSError:
+            # Entry was just removed by another build
+            return None
+        return entry / "data"
+
+    def store(self, key: str, populate: Callable[[Path], None],
+              metadata: Optional[Dict] = None) -> Path:
+        '''Creates a new entry. The data is created by calling `populate`
+        with a temporary directory, which is only moved into the cache
+        once `populate` has finished successfully. Afterwards old entries
+        are removed if the cache is too large.
+
+        :param key: the key of the entry.
+        :param populate: function that creates the data in the directory
+            it is called with.
+        :param metadata: additional information stored with the entry.
+
+        :returns: the data directory of the new entry.
+        '''
+        tmp_entry = (self._root /
+                     f".tmp-{key}-{os.getpid()}-{threading.get_ident()}")
+        if tmp_entry.exists():
+            shutil.rmtree(tmp_entry)
+        (tmp_entry / "data").mkdir(parents=True)
+        try:
+            populate(tmp_entry / "data")
+            meta = dict(metadata or {})
+            meta["size"] = get_tree_size(tmp_entry / "data")
+            meta["created"] = time.time()
+            with open(tmp_entry / "entry.json", "w",
+                      encoding="utf8") as f_out:
+                json.dump(meta, f_out, indent=2)
+            with self.lock():
+                entry = self._root / key
+                if entry.exists():
+                    # Another build created the same entry in the meantime
+                    shutil.rmtree(tmp_entry)
+                else:
+                    os.rename(tmp_entry, entry)
+                self._evict(keep=key)
+        except BaseException:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            raise
+        return self._root / key / "data"
+
+    @contextmanager
+    def use(self, key: str, populate: Callable[[Path], None],
+            metadata: Optional[Dict] = None):
+        '''A context manager that provides the data directory of an
+        entry, which is created (see `store`) if it does not exist. While
+        the context is active a shared lock is held, so the entry cannot
+        be removed by another build. New entries can only be stored once
+        the lock is released, so the context must not be held longer than
+        necessary (and `store` must not be called in it).
+
+        :param key: the key of the entry.
+        :param populate: function that creates the data in the directory
+            it is called with, if the entry does not exist.
+        :param metadata: additional information stored with the entry.
+        '''
+        while True:
+            with self.lock(shared=True):
+                data = self.lookup(key)
+                if data:
+                    yield data
+                    return
+            # The entry might be removed again before the lock is taken
+            # by another build that needs space, in which case it is
+            # created again.
+            self.store(key, populate, metadata)
+
+    def _evict(self, keep: str):
+        '''Removes the least recently used entries until the cache is
+        smaller than its maximum size. Must be called with the lock held.
+
+        :param keep: an entry that must not be removed.
+        '''
+        entries = []
+        total = 0
+        for meta in self._root.glob("*/entry.json"):
+            try:
+                with open(meta, encoding="utf8") as f_in:
+                    size = json.load(f_in).get("size", 0)
+                last_used = meta.stat().st_mtime
+            except (OSError, ValueError):
+                continue
+            entries.append((last_used, size, meta.parent))
+            total += size
+        entries.sort()
+        for _, size, entry in entries:
+            if total <= self._max_size:
+                break
+            if entry.name == keep:
+                continue
+            logger.info(f"Removing cache entry '{entry}' "
+                        f"({size / 1024**2:.1f}MB).")
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
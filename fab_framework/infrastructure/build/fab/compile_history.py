@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''This module stores the compilation time of each file across builds, and
+uses this information to compute the critical path through the compile
+dependency graph. The streaming compiler uses the length of the longest
+chain starting at a file as priority, so that the files on the critical
+path (and huge files) are compiled first instead of ending up at the tail
+of the build.
+'''
+
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger('fab')
+
+
+class CompileHistory:
+    '''Stores the compile time for each file in a JSON file. The times
+    are stored relative to a root directory (typically the build output),
+    so that they remain valid if the workspace is moved. A new measurement
+    is averaged with the previous one to smooth out noise on busy nodes.
+
+    :param fpath: the name of the JSON file to store the times in.
+    :param root: the directory to which the file names are relative.
+    '''
+    # Weight of a new measurement when updating the stored time
+    NEW_WEIGHT = 0.5
+    # Estimated compile time in seconds per byte of source code, used
+    # for files without history if no other data is available.
+    DEFAULT_SECONDS_PER_BYTE = 1.0e-5
+
+    def __init__(self, fpath: Path, root: Path):
+        self._fpath = fpath
+        self._root = root
+        self._times: Dict[str, float] = {}
+        if fpath.exists():
+            try:
+                with open(fpath, encoding="utf8") as f_in:
+                    self._times = json.load(f_in)
+            except (OSError, ValueError) as err:
+                logger.warning(f"Ignoring invalid compile history "
+                               f"'{fpath}': {err}")
+        self._seconds_per_byte = None
+
+    def _key(self, fpath: Path) -> str:
+        ''':returns: the key used to store the time for a file.'''
+        try:
+            return str(fpath.relative_to(self._root))
+        except ValueError:
+            return str(fpath)
+
+    def __len__(self):
+        return len(self._times)
+
+    def get(self, fpath: Path) -> Optional[float]:
+        ''':returns: the stored compile time for the file, or None.'''
+        return self._times.get(self._key(fpath))
+
+    def estimate(self, fpath: Path) -> float:
+        ''':returns: the stored compile time of the file, or an estimate
+            based on the file size for files without history.'''
+        seconds = self.get(fpath)
+        if seconds is not None:
+            return seconds
+        if self._seconds_per_byte is None:
+            self._seconds_per_byte = self._compute_seconds_per_byte()
+        try:
+            return fpath.stat().st_size * self._seconds_per_byte
+        except OSError:
+            return 0.0
+
+    def _compute_seconds_per_byte(self) -> float:
+        ''':returns: the average compile time per byte of all files with
+            history that still exist.'''
+        total_time = 0.0
+        total_size = 0
+        for key, seconds in self._times.items():
+            try:
+                total_size += (self._root / key).stat().st_size
+            except OSError:
+                continue
+            total_time += seconds
+        if total_size == 0:
+            return self.DEFAULT_SECONDS_PER_BYTE
+        return total_time / total_size
+
+    def update(self, fpath: Path, seconds: float):
+        '''Records a new compile time for a file.'''
+        key = self._key(fpath)
+        if key in self._times:
+            seconds = (self.NEW_WEIGHT * seconds +
+                       (1 - self.NEW_WEIGHT) * self._times[key])
+        self._times[key] = seconds
+
+    def save(self):
+        '''Writes the history to the JSON file.'''
+        tmp_fpath = self._fpath.with_suffix(".tmp")
+        with open(tmp_fpath, "w", encoding="utf8") as f_out:
+            json.dump(self._times, f_out, indent=0, sort_keys=True)
+        os.replace(tmp_fpath, self._fpath)
+
+
+def compute_critical_path(dependencies: Dict[Path, Set[Path]],
+                          costs: Dict[Path, float]) \
+        -> Tuple[Dict[Path, float], List[Path]]:
+    '''Computes for each file the length (sum of costs) of the longest
+    chain of files that can only be compiled after this file, including
+    the file itself. The file with the largest value starts the critical
+    path of the whole build.
+
+    :param dependencies: for each file the set of files it depends on.
+    :param costs: the (estimated) compile time of each file.
+
+    :returns: a tuple with the chain length of each file, and the
+        critical path (starting with the first file to compile).
+    '''
+    dependents: Dict[Path, List[Path]] = {fpath: [] for fpath in
+                                          dependencies}
+    for fpath, deps in dependencies.items():
+        for dep in deps:
+            dependents[dep].append(fpath)
+
+    # Process the files in reverse topological order, i.e. a file is
+    # handled once all files depending on it are done.
+    n_waiting = {fpath: len(deps) for fpath, deps in dependents.items()}
+    todo = [fpath for fpath, count in n_waiting.items() if count == 0]
+    chain_length: Dict[Path, float] = {}
+    next_on_path: Dict[Path, Optional[Path]] = {}
+    while todo:
+        fpath = todo.pop()
+        longest = max(dependents[fpath], default=None,
+                      key=lambda dep: chain_length[dep])
+        chain_length[fpath] = (costs.get(fpath, 0.0) +
+                               (chain_length[longest] if longest else 0.0))
+        next_on_path[fpath] = longest
+        for dep in dependencies[fpath]:
+            n_waiting[dep] -= 1
+            if n_waiting[dep] == 0:
+                todo.append(dep)
+
+    # Files in a dependency cycle are not handled above, the compiler
+    # will report these.
+    if not chain_length:
+        return chain_length, []
+    fpath = max(chain_length, key=lambda i: chain_length[i])
+    path = []
+    while fpath:
+        path.append(fpath)
+        fpath = next_on_path[fpath]
+    return chain_length, path
+
+
+def compute_actual_critical_path(dependencies: Dict[Path, Set[Path]],
+                                 timings: Dict[Path, Tuple[float, float]]) \
+        -> List[Path]:
+    '''Reconstructs the critical path of a finished compilation: starting
+    with the file that finished last, it repeatedly goes back to the
+    dependency of the current file that finished last.
+
+    :param dependencies: for each file the set of files it depends on.
+    :param timings: the start and end time of each compiled file.
+
+    :returns: the actual critical path, starting with the first file.
+    '''
+    if not timings:
+        return []
+    fpath = max(timings, key=lambda i: timings[i][1])
+    path = [fpath]
+    while True:
+        deps = [dep for dep in dependencies.get(fpath, [])
+                if dep in timings]
+        if not deps:
+            break
+        fpath = max(deps, key=lambda i: timings[i][1])
+        path.append(fpath)
+    return list(reversed(path))
+
+
+def log_critical_path(label: str, path: List[Path],
+                      times: Dict[Path, float]):
+    '''Logs a critical path together with the time of each file.
+
+    :param label: a description of the path, e.g. 'predicted'.
+    :param path: the list of files on the critical path.
+    :param times: the (estimated or measured) time of each file.
+    '''
+    total = sum(times.get(fpath, 0.0) for fpath in path)
+    logger.info(f"{label} critical path: {len(path)} files, "
+                f"{total:.1f}s")
+    for fpath in path:
+        logger.info(f"  {times.get(fpath, 0.0):8.2f}s  {fpath}")
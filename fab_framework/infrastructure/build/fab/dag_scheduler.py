@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''This module contains a simple scheduler for a directed acyclic graph
+(DAG) of tasks. Each task is started as soon as all tasks it depends on
+have finished, so independent tasks are executed concurrently (in threads).
+This is used to overlap build stages that do not depend on each other.
+'''
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import logging
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger('fab')
+
+
+class DagTask:
+    '''A single task in the DAG.
+
+    :param name: the (unique) name of this task.
+    :param func: the function to execute. It is called without arguments.
+    :param dependencies: the names of all tasks that must have finished
+        before this task can be started.
+    '''
+    def __init__(self, name: str, func: Callable,
+                 dependencies: Optional[Iterable[str]] = None):
+        self.name = name
+        self.func = func
+        self.dependencies = set(dependencies or [])
+        self.result = None
+        self.start = None
+        self.end = None
+
+    @property
+    def duration(self) -> Optional[float]:
+        ''':returns: the time in seconds this task took, or None if it
+            has not finished.'''
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+
+class DagScheduler:
+    '''Executes a set of tasks with dependencies. A task is submitted as
+    soon as all its dependencies are finished, using a thread pool of
+    the specified size. If a task fails, no new task will be started,
+    all running tasks are waited for, and then a RuntimeError is raised
+    that lists all failed tasks and all tasks that were not started.
+
+    :param name: a name for this scheduler, used in log messages.
+    :param max_workers: the maximum number of tasks to run concurrently.
+        If not specified, all tasks that are ready will be run.
+    '''
+    def __init__(self, name: str = "dag",
+                 max_workers: Optional[int] = None):
+        self._name = name
+        self._max_workers = max_workers
+        self._tasks: Dict[str, DagTask] = {}
+        self._start = None
+        self._end = None
+
+    @property
+    def tasks(self) -> Dict[str, DagTask]:
+        ''':returns: all tasks, indexed by name.'''
+        return self._tasks
+
+    def add_task(self, name: str, func: Callable,
+                 dependencies: Optional[Iterable[str]] = None) -> DagTask:
+        '''Adds a new task to the DAG.
+
+        :param name: the name of the task.
+        :param func: the function to call to execute this task.
+        :param dependencies: the names of tasks that must be finished
+            before this task can be started.
+
+        :returns: the newly created task.
+
+        :raises ValueError: if a task with the same name already exists.
+        '''
+        if name in self._tasks:
+            raise ValueError(f"Task '{name}' already exists in "
+                             f"'{self._name}'.")
+        task = DagTask(name, func, dependencies)
+        self._tasks[name] = task
+        return task
+
+    def add_dependency(self, name: str, dependency: str):
+        '''Adds an additional dependency to an existing task.
+
+        :param name: the name of the task.
+        :param dependency: the name of the task it depends on.
+        '''
+        self._tasks[name].dependencies.add(dependency)
+
+    def _check_dependencies(self):
+        '''Makes sure that all dependencies exist.
+
+        :raises ValueError: if a task depends on an unknown task.
+        '''
+        for task in self._tasks.values():
+            unknown = task.dependencies - set(self._tasks)
+            if unknown:
+                raise ValueError(f"Task '{task.name}' depends on unknown "
+                                 f"task(s) {sorted(unknown)}.")
+
+    def run(self) -> Dict[str, object]:
+        '''Executes all tasks.
+
+        :returns: the result of each task, indexed by task name.
+
+        :raises RuntimeError: if any task failed, or if the dependencies
+            contain a cycle.
+        '''
+        # pylint: disable=too-many-branches
+        self._check_dependencies()
+        finished = set()
+        pending = dict(self._tasks)
+        running = {}
+        errors: List[str] = []
+        first_error = None
+        max_workers = self._max_workers or max(1, len(self._tasks))
+
+        self._start = time.time()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                if not errors:
+                    ready = [task for task in pending.values()
+                             if task.dependencies <= finished]
+                    for task in ready:
+                        del pending[task.name]
+                        running[executor.submit(self._execute, task)] = task
+                if not running:
+                    if errors:
+                        break
+                    raise RuntimeError(
+                        f"{self._name}: cyclic dependencies between "
+                        f"{sorted(pending)}.")
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    try:
+                        task.result = future.result()
+                    # pylint: disable=broad-except
+                    except Exception as err:
+                        errors.append(f"'{task.name}': {err}")
+                        first_error = first_error or err
+                        logger.error(f"{self._name}: '{task.name}' failed "
+                                     f"after {task.duration:.2f}s.")
+                        continue
+                    finished.add(task.name)
+                    logger.info(f"{self._name}: finished '{task.name}' in "
+                                f"{task.duration:.2f}s")
+        self._end = time.time()
+
+        if errors:
+            message = (f"{self._name}: {len(errors)} task(s) failed:\n" +
+                       "\n".join(errors))
+            if pending:
+                logger.error(f"{self._name}: not started because of the "
+                             f"failure: {sorted(pending)}")
+                message += f"\nNot started: {sorted(pending)}"
+            raise RuntimeError(message) from first_error
+        self.log_timing()
+        return {name: task.result for name, task in self._tasks.items()}
+
+    def _execute(self, task: DagTask):
+        '''Executes a task in a worker thread. The start and end times
+        are recorded here, so that the time a task waits for a free
+        worker is not included in its duration.
+
+        :param task: the task to execute.
+
+        :returns: the result of the task.
+        '''
+        logger.info(f"{self._name}: starting '{task.name}'")
+        task.start = time.time()
+        try:
+            return task.func()
+        finally:
+            task.end = time.time()
+
+    def log_timing(self):
+        '''Logs the start time (relative to the start of the scheduler)
+        and duration of all finished tasks.
+        '''
+        if self._start is None:
+            return
+        logger.info(f"{self._name}: timing summary "
+                    f"(total {self._end - self._start:.2f}s)")
+        tasks = sorted((task for task in self._tasks.values()
+                        if task.duration is not None),
+                       key=lambda task: task.start)
+        for task in tasks:
+            logger.info(f"  {task.name:30s} start "
+                        f"{task.start - self._start:8.2f}s  "
+                        f"took {task.duration:8.2f}s")
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''This module exports the file dependency graph created by Fab's analysis
+into a compact JSON file (`dependency_graph.json` in the project
+workspace), and provides a command line tool to query it, e.g.:
+
+    dependency_graph.py GRAPH impact field_real64_mod.f90
+    dependency_graph.py GRAPH why bdy_impl3.f90
+    dependency_graph.py GRAPH longest
+    dependency_graph.py GRAPH fanout --top 20
+
+A file can be specified by its path relative to the build output
+directory (or any trailing part of it), or by the name of a module it
+defines.
+'''
+
+import argparse
+from collections import deque
+import json
+import logging
+from pathlib import Path
+import sys
+from typing import Dict, List, Optional
+
+logger = logging.getLogger('fab')
+
+
+def export_dependency_graph(config, fpath: Path):
+    '''Writes the dependency graph of all build trees in the artefact
+    store into a JSON file. Files are stored once in a list, and the
+    dependencies of a file are stored as indices into this list.
+
+    :param config: the Fab build config, after the analysis.
+    :param fpath: the file to write.
+    '''
+    # pylint: disable=import-outside-toplevel
+    from fab.artefacts import ArtefactSet
+
+    build_trees = config.artefact_store.get(ArtefactSet.BUILD_TREES, {})
+    analysed = {}
+    for build_tree in build_trees.values():
+        analysed.update(build_tree)
+
+    def get_name(path: Path) -> str:
+        try:
+            return str(Path(path).relative_to(config.build_output))
+        except ValueError:
+            return str(path)
+
+    files = sorted(analysed)
+    index = {path: i for i, path in enumerate(files)}
+    graph = {"build_output": str(config.build_output),
+             "files": [get_name(path) for path in files],
+             "modules": [sorted(getattr(analysed[path], "module_defs", []))
+                         for path in files],
+             "deps": [sorted(index[dep] for dep in analysed[path].file_deps
+                             if dep in index)
+                      for path in files],
+             "roots": {}}
+    for root, build_tree in build_trees.items():
+        for path in build_tree:
+            if root in getattr(analysed[path], "symbol_defs", []):
+                graph["roots"][root] = index[path]
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    with open(fpath, "w", encoding="utf8") as f_out:
+        json.dump(graph, f_out, separators=(",", ":"))
+    logger.info(f"Exported the dependency graph of {len(files)} files to "
+                f"'{fpath}'.")
+
+
+class DependencyGraph:
+    '''A dependency graph read from a file written by
+    `export_dependency_graph`.
+
+    :param fpath: the graph file.
+    '''
+    def __init__(self, fpath: Path):
+        with open(fpath, encoding="utf8") as f_in:
+            graph = json.load(f_in)
+        self.files: List[str] = graph["files"]
+        self.modules: List[List[str]] = graph["modules"]
+        self.deps: List[List[int]] = graph["deps"]
+        self.roots: Dict[str, int] = graph["roots"]
+        self.dependents: List[List[int]] = [[] for _ in self.files]
+        for i, deps in enumerate(self.deps):
+            for dep in deps:
+                self.dependents[dep].append(i)
+
+    def find(self, name: str) -> int:
+        '''Finds a file by its (trailing) path or by a module it defines.
+
+        :param name: the name to find.
+
+        :returns: the index of the file.
+
+        :raises KeyError: if the name is not found, or is ambiguous.
+        '''
+        matches = [i for i, fname in enumerate(self.files)
+                   if fname == name or fname.endswith("/" + name) or
+                   name.lower() in self.modules[i]]
+        if len(matches) != 1:
+            candidates = ", ".join(self.files[i] for i in matches[:10])
+            raise KeyError(f"'{name}' matches {len(matches)} files"
+                           f"{': ' + candidates if matches else ''}.")
+        return matches[0]
+
+    def impact(self, node: int) -> List[int]:
+        ''':returns: all files that depend (directly or indirectly) on the
+            file, i.e. that might need to be recompiled if it changes.'''
+        seen = {node}
+        todo = [node]
+        while todo:
+            for dependent in self.dependents[todo.pop()]:
+                if dependent not in seen:
+                    seen.add(dependent)
+                    todo.append(dependent)
+        seen.remove(node)
+        return sorted(seen)
+
+    def why(self, node: int,
+            root: Optional[str] = None) -> Optional[List[int]]:
+        ''':returns: the shortest chain of dependencies from a root to the
+            file, or None if the file is not needed by the root.'''
+        roots = [self.roots[root]] if root else list(self.roots.values())
+        parents = {start: None for start in roots}
+        todo = deque(roots)
+        while todo:
+            current = todo.popleft()
+            if current == node:
+                chain = []
+                while current is not None:
+                    chain.append(current)
+                    current = parents[current]
+                return chain[::-1]
+            for dep in self.deps[current]:
+                if dep not in parents:
+                    parents[dep] = current
+                    todo.append(dep)
+        return None
+
+    def longest(self) -> List[int]:
+        ''':returns: the longest chain of dependencies. Dependency cycles
+            (which can exist between files with external procedures) are
+            ignored.'''
+        length: Dict[int, int] = {}
+        following: Dict[int, Optional[int]] = {}
+        for start in range(len(self.files)):
+            if start in length:
+                continue
+            # Iterative depth-first search, computing the longest chain
+            # starting at each file once all its dependencies are done.
+            stack = [(start, iter(self.deps[start]))]
+            on_stack = {start}
+            while stack:
+                current, deps = stack[-1]
+                dep = next(deps, None)
+                if dep is None:
+                    stack.pop()
+                    on_stack.discard(current)
+                    best = max(((length[d], d) for d in self.deps[current]
+                                if d in length), default=(0, None))
+                    length[current] = best[0] + 1
+                    following[current] = best[1]
+                elif dep not in length and dep not in on_stack:
+                    stack.append((dep, iter(self.deps[dep])))
+                    on_stack.add(dep)
+        if not length:
+            return []
+        node = max(length, key=length.get)
+        chain = []
+        while node is not None:
+            chain.append(node)
+            node = following[node]
+        return chain
+
+    def fanout(self) -> List[tuple]:
+        ''':returns: for each file the number of files that depend on it
+            directly and indirectly, sorted by the latter. The indirect
+            dependents are computed for all files at once as bit sets,
+            dependency cycles are ignored.'''
+        bits: List[Optional[int]] = [None] * len(self.files)
+        for start in range(len(self.files)):
+            if bits[start] is not None:
+                continue
+            stack = [(start, iter(self.dependents[start]))]
+            on_stack = {start}
+            while stack:
+                current, dependents = stack[-1]
+                dependent = next(dependents, None)
+                if dependent is None:
+                    stack.pop()
+                    on_stack.discard(current)
+                    value = 0
+                    for i in self.dependents[current]:
+                        value |= (bits[i] or 0) | (1 << i)
+                    bits[current] = value & ~(1 << current)
+                elif bits[dependent] is None and dependent not in on_stack:
+                    stack.append((dependent,
+                                  iter(self.dependents[dependent])))
+                    on_stack.add(dependent)
+        return sorted(((len(self.dependents[i]), bin(bits[i]).count("1"), i)
+                       for i in range(len(self.files))),
+                      key=lambda item: (-item[1], -item[0]))
+
+
+def main(argv: Optional[List[str]] = None):
+    '''The command line interface for querying a dependency graph.'''
+    parser = argparse.ArgumentParser(
+        description="Queries the dependency graph exported by the LFRic "
+                    "build scripts (dependency_graph.json in the project "
+                    "workspace).")
+    parser.add_argument("graph", type=Path, help="The graph file.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    impact = commands.add_parser(
+        "impact", help="List the files that depend on a file, i.e. that "
+                       "might be recompiled if it changes.")
+    impact.add_argument("file", help="File path or module name.")
+    why = commands.add_parser(
+        "why", help="Show why a file is part of the build.")
+    why.add_argument("file", help="File path or module name.")
+    why.add_argument("--root", help="The root symbol to start from.")
+    commands.add_parser("longest", help="Show the longest dependency chain.")
+    fanout = commands.add_parser(
+        "fanout", help="List the files with the most dependent files.")
+    fanout.add_argument("--top", type=int, default=20,
+                        help="Number of files to list.")
+    args = parser.parse_args(argv)
+
+    graph = DependencyGraph(args.graph)
+    try:
+        if args.command == "impact":
+            dependents = graph.impact(graph.find(args.file))
+            for i in dependents:
+                print(graph.files[i])
+            print(f"{len(dependents)} files depend on '{args.file}'.")
+        elif args.command == "why":
+            chain = graph.why(graph.find(args.file), args.root)
+            if chain is None:
+                print(f"'{args.file}' is not needed.")
+                return 1
+            print("\n  uses ".join(graph.files[i] for i in chain))
+        elif args.command == "longest":
+            chain = graph.longest()
+            print("\n  uses ".join(graph.files[i] for i in chain))
+            print(f"Length: {len(chain)} files.")
+        else:
+            print(f"{'direct':>8} {'total':>8}  file")
+            for direct, total, i in graph.fanout()[:args.top]:
+                print(f"{direct:8d} {total:8d}  {graph.files[i]}")
+    except KeyError as err:
+        print(err.args[0], file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,16 +10,24 @@ only modify very few settings to have a working FAB build script.
 '''
 
 import argparse
+from contextlib import contextmanager
+import copy
+from datetime import timedelta
+from functools import partial
 from importlib import import_module
 import logging
 import os
+from pathlib import Path
 import sys
+import time
 from typing import List
 
+from fab.artefacts import ArtefactSet
 from fab.build_config import BuildConfig
 from fab.steps.analyse import analyse
 from fab.steps.archive_objects import archive_objects
 from fab.steps.c_pragma_injector import c_pragma_injector
+from fab.steps.cleanup_prebuilds import cleanup_prebuilds
 from fab.steps.compile_c import compile_c
 from fab.steps.compile_fortran import compile_fortran
 from fab.steps.find_source_files import find_source_files
@@ -28,6 +36,18 @@ from fab.steps.preprocess import preprocess_c, preprocess_fortran
 from fab.steps.grab.folder import grab_folder
 from fab.tools import Category, ToolBox, ToolRepository
 
+from analysis_db import AnalysisDatabase
+from cache_util import get_cache_root
+from dag_scheduler import DagScheduler
+from dependency_graph import export_dependency_graph
+from file_util import grab_folder_linked, list_tree
+from memory_budget import detect_memory_limit, parse_memory
+from parallelism import detect_n_procs, parse_stage_jobs, ProcessBudget
+from source_index import (FORTRAN_SUFFIXES, get_reachable_files,
+                          INCLUDE_SUFFIXES)
+from source_cache import SourceCache
+from streaming_compile import compile_fortran_streaming
+
 
 class FabBase:
     '''This is the base class for all FAB scripts.
@@ -36,6 +56,16 @@ class FabBase:
         the name of the compiler will be added to it.
     :param Optional[str] root_symbol:
     '''
+    # The stages for which the number of processes can be set using
+    # --stage-jobs. Derived classes can add their own stages.
+    STAGES = ["grab", "preprocess", "psyclone", "analyse", "compile"]
+
+    # If set, prebuild files (e.g. object files) that were not used by a
+    # build are only removed after this many days. This allows several
+    # build scripts to share one workspace. By default all unused prebuild
+    # files are removed at the end of a build.
+    KEEP_PREBUILDS_DAYS = None
+
     # pylint: disable=too-many-instance-attributes
     def __init__(self, name, root_symbol=None):
         self._logger = logging.getLogger('fab')
@@ -66,16 +96,31 @@ class FabBase:
         self._config = BuildConfig(tool_box=self._tool_box,
                                    project_label=f'{name}-$compiler',
                                    verbose=True,
-                                   n_procs=16,
+                                   n_procs=self._n_procs,
                                    mpi=self._args.mpi,
                                    openmp=self._args.openmp
                                    )
         self._preprocessor_flags = []
         self._compiler_flags = []
+        self._grab_scheduler = None
+        self._grab_targets = []
+        self._process_budget = None
 
         if self._site_config:
             self._site_config.update_toolbox(self._config)
 
+    def __getstate__(self):
+        '''The build object is pickled when a bound method (e.g.
+        `get_transformation_script`) is passed to worker processes. The
+        state that is only used in the main process (and contains locks,
+        which cannot be pickled) is not copied.
+        '''
+        state = self.__dict__.copy()
+        state["_process_budget"] = None
+        state["_grab_scheduler"] = None
+        state["_grab_targets"] = []
+        return state
+
     @property
     def site(self):
         ''':returns: the site.'''
@@ -103,6 +148,206 @@ class FabBase:
         '''
         return self._config
 
+    @property
+    def n_procs(self):
+        ''':returns: the number of processes to use by default.'''
+        return self._n_procs
+
+    @property
+    def memory_limit(self):
+        ''':returns: the memory (in bytes) available to stages that use
+            memory admission. It is detected when first used, unless
+            specified on the command line.
+        :rtype: int
+        '''
+        if self._memory_limit is None:
+            self._memory_limit = detect_memory_limit()
+        return self._memory_limit
+
+    @property
+    def source_cache(self):
+        ''':returns: the cache for exported source code, or None if
+            --no-source-cache was specified.
+        :rtype: Optional[:py:class:`SourceCache`]
+        '''
+        if not self._args.source_cache_enabled:
+            return None
+        if self._source_cache is None:
+            if self._args.source_cache:
+                root = Path(self._args.source_cache)
+            else:
+                root = get_cache_root() / "sources"
+            self.logger.info(f"Using the source cache '{root}'.")
+            self._source_cache = SourceCache(
+                root, parse_memory(self._args.source_cache_size))
+        return self._source_cache
+
+    def get_stage_jobs(self, stage):
+        ''':returns: the number of processes to use for the specified
+            stage.
+        :rtype: int
+        '''
+        return self._stage_jobs.get(stage, self._n_procs)
+
+    @contextmanager
+    def stage_jobs(self, stage):
+        '''A context manager that provides a copy of the config object
+        that uses the number of processes specified for the stage. The
+        copy shares everything else (e.g. the artefact store) with the
+        config object, and must be passed to the Fab steps of the stage.
+        The config object itself is not modified, so stages that run
+        concurrently in pipeline mode each use their own setting. In
+        pipeline mode the processes are taken from a budget shared by
+        all stages (see `ProcessBudget`), so a stage might get fewer
+        processes, or wait until another stage has finished.
+
+        :param str stage: the name of the stage.
+        '''
+        stage_config = copy.copy(self.config)
+        n_procs = self.get_stage_jobs(stage)
+        if self._process_budget is None:
+            stage_config.n_procs = n_procs
+            yield stage_config
+            return
+        with self._process_budget.reserve(n_procs, stage) as granted:
+            stage_config.n_procs = granted
+            yield stage_config
+
+    @contextmanager
+    def persistent_analysis(self):
+        '''A context manager for running the dependency analysis, which
+        restores the analysis results of unchanged files from the
+        analysis database (see analysis_db.py) and stores new results,
+        unless --no-analysis-db was specified.
+        '''
+        if not self._args.analysis_db_enabled:
+            yield
+            return
+        db_path = get_cache_root() / "analysis.sqlite"
+        self.logger.info(f"Using the analysis database '{db_path}'.")
+        database = AnalysisDatabase(db_path)
+        with database.restored(self.config):
+            yield
+
+    @contextmanager
+    def concurrent_grabs(self):
+        '''A context manager that collects all grabs added with `add_grab`
+        and runs them concurrently when the context is left, using the
+        number of processes of the grab stage. If this context is
+        entered again (e.g. by the grab_files method of a base class),
+        the grabs are added to the outermost context, so all grabs run
+        together. Grabs that write to the same files are run one after
+        another, in the order in which they were added, see `add_grab`.
+        '''
+        if self._grab_scheduler is not None:
+            yield
+            return
+        scheduler = DagScheduler(name="grab",
+                                 max_workers=self.get_stage_jobs("grab"))
+        self._grab_scheduler = scheduler
+        self._grab_targets = []
+        try:
+            yield
+        finally:
+            self._grab_scheduler = None
+        scheduler.run()
+
+    def add_grab(self, name, func, dst_label='', list_files=None):
+        '''Adds a grab of source files. Inside of `concurrent_grabs` it is
+        executed when the context is left, concurrently with all other
+        grabs, otherwise it is executed immediately. A grab that might
+        write to the same files as a grab added before is only started
+        once the earlier grab has finished, so that the last grab wins
+        (as when the grabs are executed one after another).
+
+        :param str name: a unique name of the grab, used in log messages.
+        :param func: the function that executes the grab. It is called
+            without arguments.
+        :param str dst_label: the destination folder relative to the
+            source folder.
+        :param list_files: a function that returns the paths (relative to
+            the destination folder) of the files the grab writes, or None
+            if they are not known (then the grab might write to any file
+            in the destination folder). It is only called if the
+            destination folder overlaps with the one of another grab.
+        '''
+        if self._grab_scheduler is None:
+            func()
+            return
+        target = {"dst": Path(dst_label), "list_files": list_files}
+        dependencies = [other_name
+                        for other_name, other in self._grab_targets
+                        if self._grabs_overlap(target, other)]
+        if dependencies:
+            self.logger.debug(f"Grab '{name}' overlaps with {dependencies} "
+                              f"and will be run after them.")
+        self._grab_scheduler.add_task(name, func, dependencies)
+        self._grab_targets.append((name, target))
+
+    @staticmethod
+    def _get_grab_files(target):
+        ''':returns: the paths (relative to the source folder) of the
+            files a grab writes, or None if they are not known. They are
+            only listed once.
+        :rtype: Optional[FrozenSet[Path]]
+        '''
+        if "files" not in target:
+            files = target["list_files"]() if target["list_files"] else None
+            target["files"] = (None if files is None else
+                               frozenset(target["dst"] / fpath
+                                         for fpath in files))
+        return target["files"]
+
+    @staticmethod
+    def _grabs_overlap(first, second):
+        ''':returns: whether two grabs might write to the same file. The
+            files of the grabs are only compared if one destination folder
+            contains the other.
+        :rtype: bool
+        '''
+        first_dst, second_dst = first["dst"], second["dst"]
+        if not (first_dst == second_dst or
+                first_dst in second_dst.parents or
+                second_dst in first_dst.parents):
+            return False
+        first_files = FabBase._get_grab_files(first)
+        second_files = FabBase._get_grab_files(second)
+        if first_files is None and second_files is None:
+            return True
+        if first_files is None:
+            first_files, second_files, second_dst = \
+                second_files, first_files, first_dst
+        if second_files is None:
+            return any(second_dst in fpath.parents
+                       for fpath in first_files)
+        return not first_files.isdisjoint(second_files)
+
+    def grab_folder(self, src, dst_label=''):
+        '''Grabs a folder into the source folder of the build, using the
+        grab mode specified on the command line: 'rsync' uses Fab's
+        grab_folder, all other modes populate the source folder with
+        reflinks or hardlinks (see file_util.grab_folder_linked). Inside
+        of `concurrent_grabs` this is executed concurrently with other
+        grabs.
+
+        :param src: the directory to grab.
+        :param str dst_label: the destination folder relative to the
+            source folder.
+        '''
+        grab_mode = self._args.grab_mode
+        if grab_mode == "rsync":
+            func = partial(grab_folder, self.config, src=src,
+                           dst_label=dst_label)
+        else:
+            # The grabbed folder is typically the user's checkout, so a
+            # hardlink is only used if explicitly requested.
+            if grab_mode == "auto":
+                grab_mode = "reflink"
+            func = partial(grab_folder_linked, self.config, src=src,
+                           dst_label=dst_label, mode=grab_mode)
+        self.add_grab(str(src), func, dst_label=dst_label,
+                      list_files=partial(list_tree, src))
+
     def define_site_platform_target(self):
         '''This method defines the attributes site, platform (and
         target=site-platform) based on the command line option --site
@@ -199,6 +444,78 @@ class FabBase:
         parser.add_argument(
             '--no-openmp', '-no-openmp', action="store_false",
             dest="openmp", help="Disable OpenMP")
+        parser.add_argument(
+            '--jobs', '-j', type=int, default=None,
+            help="Number of processes to use. Default is to detect the "
+                 "number of available CPUs from the CPU affinity, cgroup "
+                 "CPU quotas and $NCPUS (PBS)")
+        parser.add_argument(
+            '--stage-jobs', type=str, action="append", default=[],
+            metavar="STAGE=N",
+            help="Number of processes to use for a specific stage, e.g. "
+                 "'--stage-jobs psyclone=8'. Can be specified more than "
+                 f"once. Stages are: {', '.join(self.STAGES)}")
+        parser.add_argument(
+            '--memory', type=str, default=None,
+            help="Memory available to memory-hungry stages like PSyclone, "
+                 "e.g. '32GB'. Default is to detect it from PBS, cgroup "
+                 "limits and the physical memory")
+        parser.add_argument(
+            '--pipeline', default=False, action="store_true",
+            help="Run independent build stages (e.g. the C and the "
+                 "Fortran stages) at the same time, and compile each "
+                 "Fortran file as soon as its dependencies are compiled. "
+                 "Each stage still waits for all files of the stages it "
+                 "depends on, e.g. the analysis only starts once all "
+                 "files are preprocessed")
+        parser.add_argument(
+            '--critical-path', default=False, action="store_true",
+            help="Compile Fortran files as soon as their dependencies are "
+                 "compiled, prioritising the longest dependency chains "
+                 "based on the compile times of previous builds. This is "
+                 "always used with --pipeline")
+        parser.add_argument(
+            '--keep-prebuilds', type=float, default=self.KEEP_PREBUILDS_DAYS,
+            metavar="DAYS",
+            help="Only remove unused prebuild files (e.g. object files) "
+                 "that are older than this many days. Default is to "
+                 "remove all unused prebuild files")
+        parser.add_argument(
+            '--grab-mode', default="rsync",
+            choices=["rsync", "auto", "reflink", "link", "copy"],
+            help="How source folders are copied into the workspace: "
+                 "'rsync' uses Fab's grab_folder, 'reflink' and 'link' "
+                 "create reflinks or hardlinks (falling back to copies), "
+                 "'auto' is the same as 'reflink'. All modes except "
+                 "'rsync' keep a manifest, so that unchanged files are "
+                 "not touched. WARNING: with 'link' the files in the "
+                 "workspace are the files of your checkout, so a build "
+                 "step that modifies a file in place also modifies your "
+                 "source code")
+        parser.add_argument(
+            '--source-cache', type=str, default=None,
+            help="Directory of the cache for source code exported from "
+                 "repositories. Default is 'sources' in $LFRIC_FAB_CACHE, "
+                 "or in ~/.cache/lfric_fab")
+        parser.add_argument(
+            '--source-cache-size', type=str, default="50GB",
+            help="Maximum size of the source cache. The least recently "
+                 "used exports are removed if it is exceeded")
+        parser.add_argument(
+            '--no-source-cache', action="store_false",
+            dest="source_cache_enabled",
+            help="Always export source code from the repository")
+        parser.add_argument(
+            '--prune', action="store_true",
+            help="Before preprocessing, remove all Fortran (including .f) "
+                 "and x90 files that cannot be reached from the root symbol "
+                 "(based on a quick scan of use statements, calls and "
+                 "includes)")
+        parser.add_argument(
+            '--no-analysis-db', action="store_false",
+            dest="analysis_db_enabled",
+            help="Do not restore or store dependency analysis results in "
+                 "the analysis database shared between builds")
         parser.add_argument("--site", "-s", type=str,
                             default="$SITE or 'default'",
                             help="Name of the site to use.")
@@ -255,6 +572,28 @@ class FabBase:
             ld = tr.get_tool(Category.LINKER, self._args.ld)
             self._tool_box.add_tool(ld)
 
+        if self._args.jobs is not None and self._args.jobs < 1:
+            parser.error(f"Invalid number of jobs '{self._args.jobs}'.")
+        self._n_procs = self._args.jobs or detect_n_procs()
+        try:
+            self._stage_jobs = parse_stage_jobs(self._args.stage_jobs,
+                                                self.STAGES)
+        except ValueError as err:
+            parser.error(str(err))
+        self.logger.info(f"Using {self._n_procs} processes, stage "
+                         f"specific settings: {self._stage_jobs}.")
+        self._memory_limit = None
+        if self._args.memory:
+            try:
+                self._memory_limit = parse_memory(self._args.memory)
+            except ValueError as err:
+                parser.error(str(err))
+        self._source_cache = None
+        try:
+            parse_memory(self._args.source_cache_size)
+        except ValueError as err:
+            parser.error(str(err))
+
     def define_preprocessor_flags(self):
         '''Top level function that sets preprocessor flags
         by calling self.set_flags
@@ -302,28 +641,84 @@ class FabBase:
                 flag_group.append(flag)
 
     def grab_files(self):
-        grab_folder(self.config, src="", dst_label="")
+        self.grab_folder(src="", dst_label="")
 
     def find_source_files(self):
         find_source_files(self.config)
+        self.prune_source_files()
+
+    def get_prune_seeds(self):
+        ''':returns: the files that are never pruned (see
+            `prune_source_files`), which by default are the Fortran files
+            created before the preprocessing (e.g. generated files).
+        :rtype: Set[Path]
+        '''
+        return set(self.config.artefact_store.get(
+            ArtefactSet.FORTRAN_BUILD_FILES, set()))
+
+    def prune_source_files(self):
+        '''If --prune is specified, removes all Fortran and x90 files (with
+        any of the `FORTRAN_SUFFIXES`, e.g. `.f` or `.F90`) from the
+        initial source files that are not needed for the root symbol
+        (based on a conservative regular expression scan, see
+        source_index.py). Include files are scanned, but never removed.
+        The removed files are not preprocessed, PSycloned or analysed.
+        '''
+        if not self._args.prune:
+            return
+        initial = self.config.artefact_store[ArtefactSet.INITIAL_SOURCE]
+        suffixes = FORTRAN_SUFFIXES + INCLUDE_SUFFIXES
+        candidates = {fpath for fpath in initial
+                      if fpath.suffix.lower() in suffixes}
+        start = time.time()
+        needed = get_reachable_files(candidates, self._root_symbol,
+                                     seeds=self.get_prune_seeds())
+        pruned = {fpath for fpath in candidates - needed
+                  if fpath.suffix.lower() in FORTRAN_SUFFIXES}
+        initial.difference_update(pruned)
+        self.logger.info(f"Pruned {len(pruned)} of {len(candidates)} files "
+                         f"not needed for '{self._root_symbol}' in "
+                         f"{time.time() - start:.1f}s.")
 
     def preprocess_c(self, path_flags=None):
-        preprocess_c(self.config, common_flags=self._preprocessor_flags,
-                     path_flags=path_flags)
+        with self.stage_jobs("preprocess") as config:
+            preprocess_c(config, common_flags=self._preprocessor_flags,
+                         path_flags=path_flags)
 
     def preprocess_fortran(self, path_flags=None):
-        preprocess_fortran(self.config, common_flags=self._preprocessor_flags,
-                           path_flags=path_flags)
+        with self.stage_jobs("preprocess") as config:
+            preprocess_fortran(config,
+                               common_flags=self._preprocessor_flags,
+                               path_flags=path_flags)
 
     def analyse(self):
-        analyse(self.config, root_symbol=self._root_symbol)
+        with self.stage_jobs("analyse") as config, \
+                self.persistent_analysis():
+            analyse(config, root_symbol=self._root_symbol)
+        self.export_dependency_graph()
+
+    def export_dependency_graph(self):
+        '''Exports the dependency graph created by the analysis into
+        `dependency_graph.json` in the project workspace, which can be
+        queried with dependency_graph.py.
+        '''
+        export_dependency_graph(self.config, self.config.project_workspace /
+                                "dependency_graph.json")
 
     def compile_c(self):
-        compile_c(self.config)
+        with self.stage_jobs("compile") as config:
+            compile_c(config)
 
     def compile_fortran(self, path_flags=None):
-        compile_fortran(self.config, common_flags=self._compiler_flags,
-                        path_flags=path_flags)
+        with self.stage_jobs("compile") as config:
+            if self._args.pipeline or self._args.critical_path:
+                compile_fortran_streaming(config,
+                                          common_flags=self._compiler_flags,
+                                          path_flags=path_flags)
+            else:
+                compile_fortran(config,
+                                common_flags=self._compiler_flags,
+                                path_flags=path_flags)
 
     def archive_objects(self):
         archive_objects(self.config)
@@ -331,11 +726,86 @@ class FabBase:
     def link(self):
         link_exe(self.config, libs=self.get_linker_flags())
 
+    def housekeeping(self):
+        '''Removes old prebuild files if --keep-prebuilds is specified.
+        Otherwise nothing is done here, and Fab removes all unused
+        prebuild files at the end of the build.
+        '''
+        if self._args.keep_prebuilds is not None:
+            cleanup_prebuilds(self.config, older_than=timedelta(
+                days=self._args.keep_prebuilds))
+
+    def define_pipeline(self, scheduler):
+        '''Adds all build stages as tasks to the scheduler that is used
+        in pipeline mode. Each task only depends on the stages it really
+        needs, so e.g. C and Fortran files are preprocessed and compiled
+        at the same time. A task processes the complete set of files of
+        its stage, and starts only once the stages it depends on have
+        finished with all their files: the files are not streamed from
+        preprocessing to the analysis to the compilation. Only within
+        the Fortran compilation each file is compiled as soon as its
+        dependencies are compiled (see streaming_compile.py). Can be
+        overwritten by a derived class to add additional stages or
+        dependencies.
+
+        :param scheduler: the scheduler to add the tasks to.
+        :type scheduler: :py:class:`dag_scheduler.DagScheduler`
+        '''
+        scheduler.add_task("grab_files", self.grab_files)
+        scheduler.add_task("find_source_files", self.find_source_files,
+                           ["grab_files"])
+        scheduler.add_task("c_pragma_injector",
+                           lambda: c_pragma_injector(self.config),
+                           ["find_source_files"])
+        scheduler.add_task("preprocess_c", self.preprocess_c,
+                           ["c_pragma_injector"])
+        scheduler.add_task("preprocess_fortran", self.preprocess_fortran,
+                           ["find_source_files"])
+        # The analysis needs the C files to find symbols defined in C
+        scheduler.add_task("analyse", self.analyse,
+                           ["preprocess_c", "preprocess_fortran"])
+        scheduler.add_task("define_compiler_flags",
+                           self.define_compiler_flags, ["analyse"])
+        scheduler.add_task("compile_c", self.compile_c,
+                           ["define_compiler_flags"])
+        scheduler.add_task("compile_fortran", self.compile_fortran,
+                           ["define_compiler_flags"])
+        scheduler.add_task("link", self.link,
+                           ["compile_c", "compile_fortran"])
+        scheduler.add_task("housekeeping", self.housekeeping, ["link"])
+
+    def build_pipeline(self):
+        '''Builds the application using a DAG of build stages instead
+        of the fixed sequence of stages used in `build`. The stages run
+        in threads, and together use at most the number of processes of
+        the build (see `stage_jobs`).
+
+        Note that the worker processes of a stage are forked while other
+        threads are running. A lock that another thread holds at this
+        time stays locked in the child process, so the stages must not
+        share locks with code that runs in the worker processes (the
+        logging module resets its own locks after a fork). The 'fork'
+        start method is still used, since the workers rely on inheriting
+        the state of the parent (e.g. the memory budget and a preloaded
+        PSyclone).
+        '''
+        self.define_preprocessor_flags()
+        scheduler = DagScheduler(name="pipeline")
+        self.define_pipeline(scheduler)
+        self._process_budget = ProcessBudget(self._n_procs)
+        try:
+            scheduler.run()
+        finally:
+            self._process_budget = None
+
     def build(self):
         # We need to use with to trigger the entrance/exit functionality,
         # but otherwise the config object is used from this object, so no
         # need to use it anywhere.
         with self._config as _:
+            if self._args.pipeline:
+                self.build_pipeline()
+                return
             self.grab_files()
             self.find_source_files()
             c_pragma_injector(self.config)
@@ -353,6 +823,7 @@ class FabBase:
             # even if a newer one is available.
             # self.archive_objects()
             self.link()
+            self.housekeeping()
 
 
 # ==========================================================================
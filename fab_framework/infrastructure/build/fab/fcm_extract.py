@@ -4,24 +4,141 @@
 '''
 
 
+import json
+import os
 from pathlib import Path
 import re
 import sys
+from typing import Callable, Dict, List, Optional
+
+from cache_util import hash_file, hash_strings
+from path_filter_index import PathFilterIndex
 
 
 class FcmExtract(dict):
     '''A simple class that reads in an fcm extract.cfg file and stores
     the information about excluded and included file to be used in FAB.
+    Included files (`include = ...`) are read recursively, and their
+    rules are inserted at the position of the include statement. The
+    name of an included file can use `$HERE` (the directory of the
+    including file) and environment variables. Relative names are
+    searched in the directory of the including file, and then in all
+    directories specified with `include-path`.
+
+    If a cache directory is specified, the parsed result is stored there,
+    and reused as long as none of the files involved (and none of the
+    environment variables used in includes) have changed.
 
     :param str filename: the name of the fcm extract file to read.
+    :param Optional[Path] cache_dir: directory to cache the parsed result.
     '''
 
-    def __init__(self, filename):
+    def __init__(self, filename, cache_dir: Optional[Path] = None):
+        super().__init__()
+        filename = Path(filename).resolve()
+        # All files read, with their content hash, and all environment
+        # variables used in include statements, with their value.
+        self._files: Dict[str, Optional[str]] = {}
+        self._env: Dict[str, Optional[str]] = {}
+        cache_file = None
+        if cache_dir:
+            cache_file = (Path(cache_dir) /
+                          f"{hash_strings(filename)}.json")
+            if self._load_cache(cache_file):
+                return
+        self._include_paths: List[Path] = []
+        self._parse(filename, [])
+        if cache_file:
+            self._save_cache(cache_file)
+
+    @property
+    def files(self) -> List[Path]:
+        ''':returns: all files that were read (including the files read
+            when the result was cached).'''
+        return [Path(i) for i in self._files]
+
+    def _load_cache(self, cache_file: Path) -> bool:
+        '''Reads the cached result, if it is still valid.
+
+        :returns: whether a valid cached result was read.
+        '''
+        try:
+            with open(cache_file, encoding="utf8") as f_in:
+                cached = json.load(f_in)
+            for fname, file_hash in cached["files"].items():
+                # Included files that did not exist are stored as None
+                if Path(fname).exists():
+                    if hash_file(Path(fname)) != file_hash:
+                        return False
+                elif file_hash is not None:
+                    return False
+        except (OSError, ValueError, KeyError):
+            return False
+        if any(os.environ.get(name) != value
+               for name, value in cached["env"].items()):
+            return False
+        self._files = cached["files"]
+        self._env = cached["env"]
+        for section, rules in cached["sections"].items():
+            self[section] = [(line_type, [Path(i) for i in paths])
+                             for (line_type, paths) in rules]
+        return True
+
+    def _save_cache(self, cache_file: Path):
+        '''Stores the parsed result in the cache.'''
+        cached = {"files": self._files,
+                  "env": self._env,
+                  "sections": {section: [(line_type, [str(i) for i in paths])
+                                         for (line_type, paths) in rules]
+                               for section, rules in self.items()}}
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = cache_file.with_suffix(f".tmp{os.getpid()}")
+            with open(tmp_file, "w", encoding="utf8") as f_out:
+                json.dump(cached, f_out, indent=1)
+            os.replace(tmp_file, cache_file)
+        except OSError as err:
+            print(f"Cannot write cache file '{cache_file}': {err}")
+
+    def _expand(self, value: str, here: Path) -> str:
+        '''Replaces $HERE and environment variables in a value, and
+        records the environment variables used.'''
+        def replace(grp):
+            name = grp.group(1) or grp.group(2)
+            if name == "HERE":
+                return str(here)
+            self._env[name] = os.environ.get(name)
+            return os.environ.get(name, grp.group(0))
+        return re.sub(r"\$(?:\{(\w+)\}|(\w+))", replace, value)
+
+    def _find_include(self, name: str, here: Path) -> Optional[Path]:
+        ''':returns: the path of an included file, or None if it cannot
+            be found.'''
+        path = Path(name)
+        if path.is_absolute():
+            return path if path.exists() else None
+        for directory in [here] + self._include_paths:
+            if (directory / path).exists():
+                return (directory / path).resolve()
+        return None
+
+    def _parse(self, filename: Path, include_stack: List[Path]):
+        '''Reads one extract file.
+
+        :param filename: the name of the file.
+        :param include_stack: the files that are including this file, to
+            detect recursive includes.
+        '''
         # pylint: disable=too-many-branches, too-many-statements
         # pylint: disable=too-many-locals
-        super().__init__()
+        if filename in include_stack:
+            raise ValueError(f"Recursive include of '{filename}' from "
+                             f"'{include_stack[-1]}'.")
+        self._files[str(filename)] = hash_file(filename)
+        here = filename.parent
         re_comment = re.compile(r"( *#.*$)")
-        re_include = re.compile(r"^ *include", re.I)
+        re_include = re.compile(r"^ *include *= *(.*)$", re.I)
+        re_include_path = re.compile(r"^ *include-path *= *(.*)$", re.I)
         re_location = re.compile(r"^ *extract.location\{diff\}\[.*\] *=")
         re_files = re.compile(r"^ *(.*)_extract_files.* *= *(.*) *$")
         re_excl = re.compile(r"^ *extract\.path-excl\[(.*)\] *= *(.*) *$")
@@ -46,9 +163,26 @@ class FcmExtract(dict):
                 current_line = []
                 if not line:
                     continue
-                if not line or re_include.match(line):
-                    # Includes are not supported
-                    print(f"Ignoring include '{line}'.")
+                grp = re_include_path.match(line)
+                if grp:
+                    self._include_paths.extend(
+                        Path(self._expand(i, here))
+                        for i in grp.group(1).split())
+                    continue
+                grp = re_include.match(line)
+                if grp:
+                    for name in grp.group(1).split():
+                        include = self._find_include(
+                            self._expand(name, here), here)
+                        if include is None:
+                            # Store the file, so that the cache is not
+                            # used anymore once the file exists.
+                            self._files[str(here / self._expand(
+                                name, here))] = None
+                            print(f"Ignoring include '{name}' in "
+                                  f"'{filename}' - file not found.")
+                            continue
+                        self._parse(include, include_stack + [filename])
                     continue
                 if re_location.match(line):
                     # Ignore location info
@@ -78,6 +212,87 @@ class FcmExtract(dict):
                 else:
                     self[section] = [(line_type, list_of_paths)]
 
+    def get_included_paths(self, section: str) -> Optional[List[Path]]:
+        '''Returns the paths that are included in a section, with the
+        first directory (typically `src`) removed, since this directory is
+        not part of the exported source tree. If the section is not
+        excluded, all files of the section are used, indicated by
+        returning None.
+
+        :param section: the name of the section, e.g. 'um'.
+
+        :returns: the list of included paths, or None.
+        '''
+        rules = self.get(section.lower(), [])
+        if not any(list_type == "exclude" for (list_type, _) in rules):
+            return None
+        included = []
+        for (list_type, list_of_paths) in rules:
+            if list_type == "include":
+                included.extend(self.remove_first_dir(i)
+                                for i in list_of_paths)
+        return included
+
+    @staticmethod
+    def remove_first_dir(path: Path) -> Path:
+        ''':returns: the path without its first directory, e.g. `a/b`
+            for `src/a/b`. A path with a single component (e.g. `src`)
+            returns `.`, i.e. the whole exported source tree.'''
+        parts = path.relative_to(path.anchor).parts
+        return Path(*parts[1:])
+
+    def get_path_filter(self, section: str,
+                        keep_suffixes=(".h", ".inc")
+                        ) -> Optional[Callable[[Path], bool]]:
+        '''Returns a function that can be used to only copy the files of a
+        section that are included. It is called with the path of a file
+        relative to the exported source tree. Files in `include`
+        directories and files with one of the `keep_suffixes` are always
+        kept, since included source files might need them.
+
+        :param section: the name of the section, e.g. 'um'.
+        :param keep_suffixes: suffixes of files that are always kept.
+
+        :returns: the filter function, or None if all files are used.
+        '''
+        included = self.get_included_paths(section)
+        if included is None or Path(".") in included:
+            return None
+        # This matches the substring matching of Fab's path filters
+        prefixes = tuple(str(i) for i in included)
+
+        def path_filter(rel_path: Path) -> bool:
+            return (str(rel_path).startswith(prefixes) or
+                    rel_path.suffix in keep_suffixes or
+                    "include" in rel_path.parts[:-1])
+        return path_filter
+
+    def get_path_filter_index(self, science_root: Path) -> PathFilterIndex:
+        '''Creates a path filter for Fab's find_source_files from all
+        sections, assuming that each section is in the directory
+        `science_root/section`. An excluded section is excluded
+        completely, and then the included paths (without the leading
+        directory, see `get_included_paths`) are added again. All rules
+        are combined into a single PathFilterIndex, so checking a file
+        does not depend on the number of rules.
+
+        :param science_root: the directory containing all sections.
+
+        :returns: the path filter.
+        '''
+        index = PathFilterIndex(science_root)
+        for section, source_file_info in self.items():
+            for (list_type, list_of_paths) in source_file_info:
+                if list_type == "exclude":
+                    index.add_rule([science_root / section], False)
+                else:
+                    # Remove the 'src' which is the first part of the name
+                    for path in list_of_paths:
+                        index.add_rule([science_root / section /
+                                        self.remove_first_dir(path)],
+                                       True)
+        return index
+
 
 # ============================================================================
 def main():
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''This module contains file utilities used by the LFRic build scripts,
+e.g. to populate the workspace with hardlinks or reflinks instead of
+copies.
+'''
+
+import errno
+import fcntl
+import filecmp
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import tempfile
+from typing import Callable, Dict, List, Optional, Set, Union
+
+from cache_util import hash_strings
+
+logger = logging.getLogger('fab')
+
+# The ioctl to create a reflink (copy-on-write clone) of a file on Linux
+FICLONE = 0x40049409
+
+# The errors that indicate that a link cannot be created between two
+# file systems, or is not supported by a file system.
+_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP,
+                errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY}
+
+# The methods to try for each mode, in order
+_METHODS = {"copy": ["copy"],
+            "link": ["link", "copy"],
+            "reflink": ["reflink", "copy"],
+            "auto": ["reflink", "link", "copy"]}
+
+# Pairs of (source device, destination device) for which a method is
+# known to not work, so that it is not tried again for every file.
+_unsupported = set()
+
+
+def _reflink(src: Path, dst: Path):
+    '''Creates `dst` as a reflink (a copy-on-write clone) of `src`, and
+    copies the timestamps.
+
+    :raises OSError: if the file system does not support reflinks.
+    '''
+    try:
+        with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+    except OSError:
+        dst.unlink(missing_ok=True)
+        raise
+    shutil.copystat(src, dst)
+
+
+def link_or_copy(src: Path, dst: Path, mode: str = "link") -> str:
+    '''Creates `dst` as a hardlink to, or a reflink of, `src`. If this is
+    not possible (e.g. because they are on different file systems), the
+    file is copied (preserving the timestamps). An existing `dst` is
+    replaced, unless it is already the same file as `src`.
+
+    :param src: the source file.
+    :param dst: the destination file.
+    :param mode: "link" to use a hardlink, "reflink" to use a reflink,
+        "auto" to try a reflink first and then a hardlink, or "copy".
+
+    :returns: "unchanged", "reflink", "link" or "copy", indicating what
+        was done.
+    '''
+    try:
+        if os.path.samefile(src, dst):
+            return "unchanged"
+    except OSError:
+        pass
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+    devices = (os.stat(src).st_dev, os.stat(dst.parent).st_dev)
+    for method in _METHODS[mode]:
+        if method == "copy":
+            break
+        if (method, devices) in _unsupported:
+            continue
+        try:
+            if method == "link":
+                os.link(src, dst)
+            else:
+                _reflink(src, dst)
+            return method
+        except OSError as err:
+            if err.errno not in _UNSUPPORTED:
+                raise
+            _unsupported.add((method, devices))
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+def link_tree(src: Path, dst: Path,
+              path_filter: Optional[Callable[[Path], bool]] = None,
+              mode: str = "link") -> Dict[str, int]:
+    '''Populates the directory `dst` with links to (or copies of) all files
+    in `src`. Existing files in `dst` that are not in `src` are kept.
+
+    :param src: the source directory.
+    :param dst: the destination directory.
+    :param path_filter: optional function that is called with the path of
+        each file relative to `src`. Only files for which it returns True
+        are linked.
+    :param mode: how files are linked, see `link_or_copy`.
+
+    :returns: the number of files per action ("unchanged", "reflink",
+        "link", "copy", "skipped").
+    '''
+    counts = dict.fromkeys(["unchanged", "reflink", "link", "copy",
+                            "skipped"], 0)
+    for root, dirs, files in os.walk(src):
+        # Make the traversal order deterministic
+        dirs.sort()
+        rel_root = Path(root).relative_to(src)
+        for name in sorted(files):
+            rel_path = rel_root / name
+            if path_filter and not path_filter(rel_path):
+                counts["skipped"] += 1
+                continue
+            counts[link_or_copy(Path(root) / name, dst / rel_path,
+                                mode)] += 1
+    logger.info(f"Populated '{dst}' from '{src}': {counts}")
+    return counts
+
+
+def list_tree(src: Path) -> Optional[Set[Path]]:
+    ''':returns: the paths of all files in a directory (relative to the
+        directory), or None if it does not exist.'''
+    src = Path(src)
+    if not src.is_dir():
+        return None
+    fpaths = set()
+    for root, _, files in os.walk(src):
+        rel_root = Path(root).relative_to(src)
+        fpaths.update(rel_root / name for name in files)
+    return fpaths
+
+
+def replace_if_changed(new_file: Path, target: Path) -> bool:
+    '''Replaces `target` with `new_file`, but only if the content differs,
+    so that an unchanged target keeps its timestamps. Otherwise
+    `new_file` is removed.
+
+    :param new_file: the newly created file.
+    :param target: the file to replace.
+
+    :returns: whether the target was replaced.
+    '''
+    if target.exists() and filecmp.cmp(new_file, target, shallow=False):
+        new_file.unlink()
+        return False
+    os.replace(new_file, target)
+    return True
+
+
+def write_if_changed(target: Path, content: Union[str, bytes]) -> bool:
+    '''Writes the content to a temporary file, which then replaces
+    `target` only if the content differs (see `replace_if_changed`).
+
+    :param target: the file to write.
+    :param content: the new content.
+
+    :returns: whether the target was written.
+    '''
+    if isinstance(content, str):
+        content = content.encode()
+    target.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=target.parent, prefix=".",
+                                     suffix=".tmp", delete=False) as f_out:
+        f_out.write(content)
+    return replace_if_changed(Path(f_out.name), target)
+
+
+def copy_tree_if_changed(
+        src: Path, dst: Path,
+        transform: Optional[Callable[[Path, bytes], bytes]] = None
+        ) -> Dict[str, int]:
+    '''Copies all files in `src` to `dst`, but only writes files whose
+    content differs, so unchanged files keep their timestamps.
+
+    :param src: the source directory.
+    :param dst: the destination directory.
+    :param transform: optional function that is called with the path of
+        a file relative to `src` and its content, and returns the content
+        to write.
+
+    :returns: the number of "unchanged" and "written" files.
+    '''
+    counts = {"unchanged": 0, "written": 0}
+    for root, _, files in os.walk(src):
+        rel_root = Path(root).relative_to(src)
+        for name in files:
+            content = (Path(root) / name).read_bytes()
+            if transform:
+                content = transform(rel_root / name, content)
+            if write_if_changed(dst / rel_root / name, content):
+                counts["written"] += 1
+            else:
+                counts["unchanged"] += 1
+    logger.info(f"Updated '{dst}' from '{src}': {counts}")
+    return counts
+
+
+def _get_stat(fpath: Path) -> Optional[List[int]]:
+    ''':returns: the size, modification time and inode of a file, or
+        None if it does not exist.'''
+    try:
+        stat = os.stat(fpath)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def sync_tree(src: Path, dst: Path, manifest_path: Path,
+              mode: str = "reflink") -> Dict[str, int]:
+    '''Populates the directory `dst` with links to (or copies of) all files
+    in `src`, using a manifest of the previous sync: a file is not
+    touched at all (so it keeps its identity and timestamps) if neither
+    the source nor the destination file have changed since then. This is
+    determined by the size, modification time and inode of both files,
+    so a destination file that was replaced or modified is updated again.
+    Files that were created by a previous sync, but have been removed
+    from `src`, are removed from `dst`.
+
+    :param src: the source directory.
+    :param dst: the destination directory.
+    :param manifest_path: the file storing the manifest.
+    :param mode: how files are linked, see `link_or_copy`. The default
+        is a reflink, falling back to a copy. A hardlink ("link" or
+        "auto") shares the file with `src`, so any in-place modification
+        of a file in `dst` also modifies the file in `src`.
+
+    :returns: the number of files per action ("unchanged", "reflink",
+        "link", "copy", "removed").
+    '''
+    try:
+        with open(manifest_path, encoding="utf8") as f_in:
+            old_manifest = json.load(f_in)
+    except (OSError, ValueError):
+        old_manifest = {}
+    # Ignore a manifest written in an older format
+    if not all(isinstance(entry, dict) for entry in old_manifest.values()):
+        old_manifest = {}
+
+    counts = dict.fromkeys(["unchanged", "reflink", "link", "copy",
+                            "removed"], 0)
+    manifest = {}
+    for root, dirs, files in os.walk(src):
+        dirs.sort()
+        rel_root = Path(root).relative_to(src)
+        for name in sorted(files):
+            rel_path = str(rel_root / name)
+            entry = {"src": _get_stat(Path(root) / name),
+                     "dst": _get_stat(dst / rel_path)}
+            old_entry = old_manifest.get(rel_path, {})
+            if (entry["dst"] is not None and
+                    [old_entry.get("src"), old_entry.get("dst")] ==
+                    [entry["src"], entry["dst"]]):
+                counts["unchanged"] += 1
+            else:
+                counts[link_or_copy(Path(root) / name, dst / rel_path,
+                                    mode)] += 1
+                entry["dst"] = _get_stat(dst / rel_path)
+            manifest[rel_path] = entry
+
+    for rel_path, old_entry in old_manifest.items():
+        if rel_path in manifest:
+            continue
+        # Only remove the file if it has not been replaced by something
+        # else (e.g. a file with the same name grabbed from a different
+        # directory).
+        dst_stat = _get_stat(dst / rel_path)
+        if dst_stat is not None and dst_stat == old_entry.get("dst"):
+            (dst / rel_path).unlink()
+            counts["removed"] += 1
+
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = manifest_path.with_suffix(f".tmp{os.getpid()}")
+    with open(tmp_path, "w", encoding="utf8") as f_out:
+        json.dump(manifest, f_out)
+    os.replace(tmp_path, manifest_path)
+    logger.info(f"Synchronised '{dst}' with '{src}': {counts}")
+    return counts
+
+
+def grab_folder_linked(config, src: Path, dst_label: str = '',
+                       mode: str = "reflink") -> Dict[str, int]:
+    '''A replacement for Fab's grab_folder, which populates the source
+    folder of the build with reflinks or hardlinks (see `sync_tree`).
+    The manifest is stored in the project workspace.
+
+    :param config: the Fab build config.
+    :param src: the directory to grab.
+    :param dst_label: the destination folder relative to the source
+        folder of the build.
+    :param mode: how files are linked, see `sync_tree`.
+
+    :returns: the number of files per action.
+    '''
+    src = Path(src)
+    manifest_path = (config.project_workspace / "grab_manifests" /
+                     f"{hash_strings(src.resolve(), dst_label)}.json")
+    return sync_tree(src, config.source_root / dst_label, manifest_path,
+                     mode)
@@ -10,6 +10,8 @@ applications to only modify very few settings to have a working FAB build
 script.
 '''
 
+import copy
+from functools import partial
 import inspect
 import logging
 import os
@@ -20,14 +22,19 @@ from fab.artefacts import ArtefactSet, SuffixFilter
 from fab.steps.analyse import analyse
 from fab.steps.find_source_files import find_source_files, Exclude
 from fab.steps.psyclone import psyclone, preprocess_x90
-from fab.steps.grab.folder import grab_folder
 from fab.tools import Category
 from fab.util import input_to_output_fpath
 
+from cache_util import DirectoryCache, get_cache_root
 from fab_base import FabBase
+from fcm_extract import FcmExtract
+from dag_scheduler import DagScheduler
 from lfric_common import configurator, fparser_workaround_stop_concatenation
-from rose_picker_tool import get_rose_picker
+from memory_budget import memory_limited, parse_memory
+from psyclone_tool import LFRicPsyclone
+from rose_picker_tool import get_rose_picker, get_rose_picker_version
 from templaterator import Templaterator
+from transformation_script_index import TransformationScriptIndex
 
 
 class LFRicBase(FabBase):
@@ -37,6 +44,13 @@ class LFRicBase(FabBase):
         the name of the compiler will be added to it.
     :param Optional[str] root_symbol:
     '''
+    # The variants created from each template (.t90 file) by the
+    # templaterator, and the name of the output file for a variant.
+    TEMPLATE_VARIANTS = [{"kind": "real32", "type": "real"},
+                         {"kind": "real64", "type": "real"},
+                         {"kind": "int32", "type": "integer"}]
+    TEMPLATE_OUTPUT = "field_{kind}_mod.f90"
+
     # pylint: disable=too-many-instance-attributes
     def __init__(self, name, root_symbol=None):
 
@@ -70,6 +84,8 @@ class LFRicBase(FabBase):
 
         self._psyclone_config = (self.config.source_root / 'psyclone_config' /
                                  'psyclone.cfg')
+        self._extracts = {}
+        self._transformation_scripts = None
 
     def get_apps_root_dir(self, path):
         '''This identifies the root directory of the LFRic apps directory,
@@ -106,6 +122,34 @@ class LFRicBase(FabBase):
             '--rose_picker', '-rp', type=str, default="v2.0.0",
             help="Version of rose_picker. Use 'system' to use an installed "
                  "version.")
+        parser.add_argument(
+            '--rose-picker-subprocess', default=False, action="store_true",
+            help="Run a checked-out rose_picker in a subprocess instead of "
+                 "in the build process")
+        parser.add_argument(
+            '--no-configurator-cache', action="store_false",
+            dest="configurator_cache",
+            help="Always run the configurator tools, instead of restoring "
+                 "the configuration source files from the cache if neither "
+                 "the rose-meta.conf files nor the tools have changed")
+        parser.add_argument(
+            '--psyclone-in-process', action="store_true",
+            help="Run PSyclone in the (re-used) worker processes instead "
+                 "of starting a new PSyclone process for each file")
+        parser.add_argument(
+            '--no-psyclone-cache', action="store_false",
+            dest="psyclone_cache",
+            help="Always run PSyclone, instead of restoring its output "
+                 "from the cache shared between builds")
+        parser.add_argument(
+            '--psyclone-cache-size', type=parse_memory, default="10GB",
+            help="Maximum size of the PSyclone cache. The least recently "
+                 "used outputs are removed if it is exceeded")
+        parser.add_argument(
+            '--no-templaterator-cache', action="store_false",
+            dest="templaterator_cache",
+            help="Always run the templaterator, instead of using cached "
+                 "output for unchanged templates")
         parser.add_argument(
             '--profile', '-pro', type=str, default="fast-debug",
             help="Profie mode for compilation, choose from \
@@ -116,6 +160,23 @@ class LFRicBase(FabBase):
                 default is R_SOLVER_PRECISION=32 while others are 64")
         return parser
 
+    def read_extract(self, filename):
+        '''Reads an FCM extract file. The parsed result is cached in the
+        shared cache directory, and each file is only read once per build.
+
+        :param filename: the name of the extract file.
+        :type filename: Union[str, Path]
+
+        :returns: a deep copy of the parsed extract file, which can be
+            modified without affecting later calls.
+        :rtype: :py:class:`FcmExtract`
+        '''
+        filename = Path(filename)
+        if filename not in self._extracts:
+            self._extracts[filename] = FcmExtract(
+                filename, cache_dir=get_cache_root() / "fcm_extract")
+        return copy.deepcopy(self._extracts[filename])
+
     @property
     def lfric_core_root(self):
         return self._lfric_core_root
@@ -185,15 +246,15 @@ class LFRicBase(FabBase):
                 'components/coupling/source/',
                 ]
 
-        # pylint: disable=redefined-builtin
-        for dir in dirs:
-            grab_folder(self.config, src=self.lfric_core_root / dir,
-                        dst_label='')
+        with self.concurrent_grabs():
+            # pylint: disable=redefined-builtin
+            for dir in dirs:
+                self.grab_folder(src=self.lfric_core_root / dir,
+                                 dst_label='')
 
-        # Copy the PSyclone Config file into a separate directory
-        dir = "etc"
-        grab_folder(self.config, src=self.lfric_core_root / dir,
-                    dst_label='psyclone_config')
+            # Copy the PSyclone Config file into a separate directory
+            self.grab_folder(src=self.lfric_core_root / "etc",
+                             dst_label='psyclone_config')
 
         # Get the implementation of the PSyData API for profiling when using
         # TAU. wget requires internet, which gitlab runner does not have.
@@ -224,6 +285,28 @@ class LFRicBase(FabBase):
                                         path_filters))
 
         self.templaterator(self.config)
+        self.prune_source_files()
+
+    def get_prune_seeds(self):
+        ''':returns: the files that are never pruned. Besides the generated
+            files, these are all files of the LFRic infrastructure, since
+            the PSy-layer (which does not exist yet) uses them.
+        :rtype: Set[Path]
+        '''
+        seeds = super().get_prune_seeds()
+        infrastructure = self.lfric_core_root / "infrastructure" / "source"
+        infrastructure_files = set()
+        for root, _, files in os.walk(infrastructure):
+            rel_root = Path(root).relative_to(infrastructure)
+            infrastructure_files.update(rel_root / name for name in files)
+        source_root = self.config.source_root
+        for fpath in self.config.artefact_store[ArtefactSet.INITIAL_SOURCE]:
+            try:
+                if fpath.relative_to(source_root) in infrastructure_files:
+                    seeds.add(fpath)
+            except ValueError:
+                pass
+        return seeds
 
     def configurator(self):
         rose_meta = self.get_rose_meta()
@@ -233,38 +316,55 @@ class LFRicBase(FabBase):
             # TODO: Ideally we would just put this into the toolbox,
             # but atm we can't put several tools of one category in
             # (so ToolBox will need to support more than one MISC tool)
-            rp = get_rose_picker(self._args.rose_picker)
+            rp = get_rose_picker(
+                self._args.rose_picker,
+                in_process=not self._args.rose_picker_subprocess)
             # Ideally we would want to get all source files created in
             # the build directory, but then we need to know the list of
             # files to add them to the list of files to process
+            cache = None
+            if self._args.configurator_cache:
+                cache = DirectoryCache(get_cache_root() / "configurator",
+                                       max_size=1024**3)
             configurator(self.config, lfric_core_source=self.lfric_core_root,
                          lfric_apps_source=self.lfric_apps_root,
                          rose_meta_conf=rose_meta,
-                         rose_picker=rp)
+                         rose_picker=rp, cache=cache,
+                         rose_picker_version=get_rose_picker_version(
+                             self._args.rose_picker))
 
     def templaterator(self, config):
+        '''Creates the source files for all variants (TEMPLATE_VARIANTS)
+        of all templates (.t90 files). The variants are created
+        concurrently, and are cached by the hashes of template and
+        templaterator and the keys and values.
+        '''
         base_dir = self.lfric_core_root / "infrastructure" / "build" / "tools"
 
         templaterator = Templaterator(base_dir/"Templaterator")
+        cache = None
+        if self._args.templaterator_cache:
+            cache = DirectoryCache(get_cache_root() / "templaterator",
+                                   max_size=256 * 1024**2)
         config.artefact_store["template_files"] = set()
         t90_filter = SuffixFilter(ArtefactSet.INITIAL_SOURCE, [".t90", ".T90"])
         template_files = t90_filter(config.artefact_store)
-        # Don't bother with parallelising this, atm there is only one file:
         print("TEMPLATE", template_files)
+        scheduler = DagScheduler(name="templaterator",
+                                 max_workers=self.get_stage_jobs("preprocess"))
         for template_file in template_files:
             out_dir = input_to_output_fpath(config=config,
                                             input_path=template_file).parent
             print("OUTDIR IS", out_dir)
             out_dir.mkdir(parents=True, exist_ok=True)
-            templ_r32 = {"kind": "real32", "type": "real"}
-            templ_r64 = {"kind": "real64", "type": "real"}
-            templ_i32 = {"kind": "int32", "type": "integer"}
-            for key_values in [templ_r32, templ_r64, templ_i32]:
-                out_file = out_dir / f"field_{key_values['kind']}_mod.f90"
-                templaterator.run(template_file, out_file,
-                                  key_values=key_values)
+            for key_values in self.TEMPLATE_VARIANTS:
+                out_file = out_dir / self.TEMPLATE_OUTPUT.format(**key_values)
+                scheduler.add_task(str(out_file), partial(
+                    templaterator.run_cached, template_file, out_file,
+                    key_values=key_values, cache=cache))
                 config.artefact_store.add(ArtefactSet.FORTRAN_BUILD_FILES,
                                           out_file)
+        scheduler.run()
 
     def get_rose_meta(self):
         return ""
@@ -272,13 +372,42 @@ class LFRicBase(FabBase):
     def analyse(self):
         self.preprocess_x90()
         self.psyclone()
+        self.analyse_dependencies()
+
+    def analyse_dependencies(self):
+        '''Runs the Fab dependency analysis on all source files, including
+        the files created by PSyclone.
+        '''
         fparser_workaround_stop_concatenation(self.config)
-        analyse(self.config, root_symbol=self._root_symbol,
-                ignore_mod_deps=['netcdf', 'MPI', 'yaxt', 'pfunit_mod',
-                                 'xios', 'mod_wait'])
+        with self.stage_jobs("analyse") as config, \
+                self.persistent_analysis():
+            analyse(config, root_symbol=self._root_symbol,
+                    ignore_mod_deps=['netcdf', 'MPI', 'yaxt', 'pfunit_mod',
+                                     'xios', 'mod_wait'])
+        self.export_dependency_graph()
+
+    def define_pipeline(self, scheduler):
+        '''Splits the analysis stage of the base class into its parts,
+        so that x90 files are preprocessed at the same time as the other
+        Fortran files. PSyclone needs the preprocessed kernels, so it
+        only starts once all x90 and Fortran files are preprocessed, and
+        the analysis in turn waits for PSyclone to process all files.
+
+        :param scheduler: the scheduler to add the tasks to.
+        :type scheduler: :py:class:`dag_scheduler.DagScheduler`
+        '''
+        super().define_pipeline(scheduler)
+        scheduler.add_task("preprocess_x90", self.preprocess_x90,
+                           ["find_source_files"])
+        scheduler.add_task("psyclone", self.psyclone,
+                           ["preprocess_x90", "preprocess_fortran"])
+        scheduler.tasks["analyse"].func = self.analyse_dependencies
+        scheduler.add_dependency("analyse", "psyclone")
 
     def preprocess_x90(self):
-        preprocess_x90(self.config, common_flags=self._preprocessor_flags)
+        with self.stage_jobs("preprocess") as config:
+            preprocess_x90(config,
+                           common_flags=self._preprocessor_flags)
 
     def psyclone(self):
         psyclone_cli_args = self.get_psyclone_config()
@@ -288,10 +417,37 @@ class LFRicBase(FabBase):
         if "tau_f90.sh" in [compiler.exec_name, linker.exec_name]:
             psyclone_cli_args.extend(self.get_psyclone_profiling_option())
 
-        psyclone(self.config, kernel_roots=[self.config.build_output],
-                 transformation_script=self.get_transformation_script,
-                 api="dynamo0.3",
-                 cli_args=psyclone_cli_args)
+        # Use a PSyclone tool that waits for enough memory to be available
+        in_process = self._args.psyclone_in_process
+        if in_process:
+            # Import PSyclone before the worker processes are forked
+            LFRicPsyclone.preload(self._psyclone_config)
+        cache = None
+        if self._args.psyclone_cache:
+            cache = DirectoryCache(get_cache_root() / "psyclone",
+                                   max_size=self._args.psyclone_cache_size)
+        tool = LFRicPsyclone(in_process=in_process, cache=cache)
+        if cache:
+            tool.index_modules([self.config.build_output])
+        self.config.tool_box.add_tool(tool, silent_replace=True)
+        # Scan the optimisation directory once, before the worker
+        # processes are created.
+        self._transformation_scripts = self.get_transformation_script_index(
+            self.config)
+        with self.stage_jobs("psyclone") as config, \
+                memory_limited(config, LFRicPsyclone.MEMORY_LABEL,
+                               self.memory_limit):
+            psyclone(config, kernel_roots=[config.build_output],
+                     transformation_script=self.get_transformation_script,
+                     api="dynamo0.3",
+                     cli_args=psyclone_cli_args)
+        # Only report the scripts if they are selected by the index (and
+        # not by an overwritten get_transformation_script).
+        if (self.get_transformation_script.__func__ is
+                LFRicBase.get_transformation_script):
+            self._transformation_scripts.report(
+                self.config.artefact_store[ArtefactSet.X90_BUILD_FILES],
+                self.config.project_workspace / "transformation_scripts.txt")
 
     def get_psyclone_config(self):
         return ["--config", self._psyclone_config]
@@ -299,28 +455,24 @@ class LFRicBase(FabBase):
     def get_psyclone_profiling_option(self):
         return ["--profile", "kernels"]
 
+    def get_transformation_script_index(self, config):
+        ''':returns: the index of the transformation scripts in the
+            optimisation directory for this site and platform.
+        :rtype: :py:class:`TransformationScriptIndex`
+        '''
+        optimisation_path = (config.source_root / 'optimisation' /
+                             f"{self.site}-{self.platform}")
+        return TransformationScriptIndex(
+            optimisation_path, [config.source_root, config.build_output])
+
     def get_transformation_script(self, fpath, config):
         ''':returns: the transformation script to be used by PSyclone.
         :rtype: Path
         '''
-        optimisation_path = (config.source_root / 'optimisation' /
-                             f"{self.site}-{self.platform}")
-        relative_path = None
-        for base_path in [config.source_root, config.build_output]:
-            try:
-                relative_path = fpath.relative_to(base_path)
-            except ValueError:
-                pass
-        if relative_path:
-            local_transformation_script = (optimisation_path /
-                                           (relative_path.with_suffix('.py')))
-            if local_transformation_script.exists():
-                return local_transformation_script
-
-        global_transformation_script = optimisation_path / 'global.py'
-        if global_transformation_script.exists():
-            return global_transformation_script
-        return ""
+        if self._transformation_scripts is None:
+            self._transformation_scripts = \
+                self.get_transformation_script_index(config)
+        return self._transformation_scripts.get_script(fpath)
 
 
 # ==========================================================================
@@ -1,12 +1,19 @@
 import logging
-import shutil
+import os
 from pathlib import Path
+import re
+from tempfile import TemporaryDirectory
+from typing import Dict, List, Optional
 
 from fab.artefacts import ArtefactSet
 from fab.steps import step
 from fab.steps.find_source_files import find_source_files
 from fab.tools import Category, Tool
 
+from cache_util import DirectoryCache, hash_files, hash_strings
+from dag_scheduler import DagScheduler
+from file_util import copy_tree_if_changed, write_if_changed
+
 logger = logging.getLogger('fab')
 
 
@@ -22,57 +29,224 @@ class Script(Tool):
         return True
 
 
-@step
-def configurator(config, lfric_core_source: Path,
-                 lfric_apps_source: Path,
-                 rose_meta_conf: Path,
-                 rose_picker: Tool,
-                 config_dir=None):
-    # pylint: disable=too-many-arguments
+def get_rose_meta_imports(rose_meta_conf: Path) -> List[str]:
+    ''':returns: the metadata imported by a rose-meta.conf file, e.g.
+        ['lfric-driver/HEAD'].'''
+    imports = []
+    in_import = False
+    with open(rose_meta_conf, encoding="utf8") as f_in:
+        for line in f_in:
+            if line.startswith("["):
+                # The import statement is at the top of the file
+                break
+            grp = re.match(r"^\s*import\s*=(.*)$", line)
+            if grp:
+                in_import = True
+                imports.extend(grp.group(1).split())
+                continue
+            grp = re.match(r"^\s*=(.*)$", line)
+            if in_import and grp:
+                imports.extend(grp.group(1).split())
+            else:
+                in_import = False
+    return imports
+
+
+def get_rose_meta_closure(rose_meta_conf: Path,
+                          include_dirs: List[Path]) -> Optional[List[Path]]:
+    '''Returns all rose-meta.conf files that are (directly or indirectly)
+    imported by the specified file, searching for the imports in the
+    include directories.
+
+    :param rose_meta_conf: the top-level rose-meta.conf file.
+    :param include_dirs: the directories to search for imports.
+
+    :returns: the sorted list of all rose-meta.conf files (including
+        the top-level one), or None if an import could not be found.
+    '''
+    # Index all rose-meta.conf files by their '<name>/<version>' suffix
+    index: Dict[str, List[Path]] = {}
+    for include_dir in include_dirs:
+        for root, dirs, files in os.walk(include_dir):
+            dirs[:] = [i for i in dirs if not i.startswith(".")]
+            if "rose-meta.conf" in files:
+                fpath = Path(root) / "rose-meta.conf"
+                key = f"{fpath.parent.parent.name}/{fpath.parent.name}"
+                index.setdefault(key, []).append(fpath)
+
+    closure = set()
+    todo = [Path(rose_meta_conf)]
+    while todo:
+        fpath = todo.pop()
+        if fpath in closure:
+            continue
+        closure.add(fpath)
+        for name in get_rose_meta_imports(fpath):
+            if name not in index:
+                logger.warning(f"Cannot find rose-meta import '{name}' "
+                               f"of '{fpath}'.")
+                return None
+            todo.extend(index[name])
+    return sorted(closure)
+
+
+def get_configurator_key(lfric_core_source: Path,
+                         lfric_apps_source: Path,
+                         rose_meta_conf: Path,
+                         rose_picker_version: str) -> str:
+    '''Computes a hash of everything that determines the output of the
+    configurator: the rose-meta.conf files imported by `rose_meta_conf`,
+    the LFRic configuration tools and the rose_picker version. If an
+    import cannot be found, all rose-meta.conf files in the core and
+    apps directories are used instead.
+
+    :returns: the hash.
+    '''
+    include_dirs = [lfric_apps_source, lfric_core_source]
+    rose_metas = get_rose_meta_closure(rose_meta_conf, include_dirs)
+    if rose_metas is None:
+        rose_metas = sorted(fpath for include_dir in include_dirs
+                            for fpath in include_dir.rglob("rose-meta.conf"))
     tools = lfric_core_source / 'infrastructure' / 'build' / 'tools'
-    config_dir = config_dir or config.build_output / 'configuration'
-    config_dir.mkdir(parents=True, exist_ok=True)
+    tool_files = sorted(fpath for fpath in tools.rglob("*")
+                        if fpath.is_file())
+    return hash_strings(rose_meta_conf, rose_picker_version,
+                        hash_files(rose_metas), hash_files(tool_files))
+
+
+def run_configurator_tools(lfric_core_source: Path,
+                           lfric_apps_source: Path,
+                           rose_meta_conf: Path,
+                           rose_picker: Tool,
+                           config_dir: Path):
+    '''Runs rose_picker and the LFRic tools that create the configuration
+    source files in the specified directory. rose_picker creates the two
+    files used by all other tools (rose-meta.json and
+    config_namelists.txt), so the other tools are run concurrently
+    afterwards.
+    '''
+    tools = lfric_core_source / 'infrastructure' / 'build' / 'tools'
+    rose_meta = config_dir / 'rose-meta.json'
 
     # rose picker
     # -----------
     # creates rose-meta.json and config_namelists.txt in
     # gungho/build
-    logger.info('rose_picker')
-
-    rose_picker.run(additional_parameters=[
-        rose_meta_conf,
-        '-directory', config_dir,
-        '-include_dirs', lfric_apps_source,
-        '-include_dirs', lfric_core_source])
-    rose_meta = config_dir / 'rose-meta.json'
+    def run_rose_picker():
+        rose_picker.run(additional_parameters=[
+            rose_meta_conf,
+            '-directory', config_dir,
+            '-include_dirs', lfric_apps_source,
+            '-include_dirs', lfric_core_source])
 
     # build_config_loaders
     # --------------------
     # builds a bunch of f90s from the json
-    logger.info('GenerateNamelist')
-    gen_namelist = Script(tools / 'GenerateNamelist')
-    gen_namelist.run(additional_parameters=['-verbose', rose_meta,
-                                            '-directory', config_dir],
-                     cwd=config_dir)
+    def generate_namelist():
+        gen_namelist = Script(tools / 'GenerateNamelist')
+        gen_namelist.run(additional_parameters=['-verbose', rose_meta,
+                                                '-directory', config_dir],
+                         cwd=config_dir)
 
     # create configuration_mod.f90 in source root
     # -------------------------------------------
-    logger.info('GenerateLoader')
-    names = [name.strip() for name in
-             open(config_dir / 'config_namelists.txt').readlines()]
-    configuration_mod_fpath = config_dir / 'configuration_mod.f90'
-    gen_loader = Script(tools / 'GenerateLoader')
-    gen_loader.run(additional_parameters=[configuration_mod_fpath,
-                                          *names])
+    def generate_loader():
+        with open(config_dir / 'config_namelists.txt',
+                  encoding="utf8") as f_in:
+            names = [name.strip() for name in f_in.readlines()]
+        configuration_mod_fpath = config_dir / 'configuration_mod.f90'
+        gen_loader = Script(tools / 'GenerateLoader')
+        gen_loader.run(additional_parameters=[configuration_mod_fpath,
+                                              *names])
 
     # create feign_config_mod.f90 in source root
     # ------------------------------------------
-    logger.info('GenerateFeigns')
-    feign_config_mod_fpath = config_dir / 'feign_config_mod.f90'
-    gft = Tool("GenerateFeignsTool", exec_name=str(tools / 'GenerateFeigns'),
-               category=Category.MISC)
-    gft.run(additional_parameters=[rose_meta,
-                                   '-output', feign_config_mod_fpath])
+    def generate_feigns():
+        feign_config_mod_fpath = config_dir / 'feign_config_mod.f90'
+        gft = Tool("GenerateFeignsTool",
+                   exec_name=str(tools / 'GenerateFeigns'),
+                   category=Category.MISC)
+        gft.run(additional_parameters=[rose_meta,
+                                       '-output', feign_config_mod_fpath])
+
+    scheduler = DagScheduler(name="configurator")
+    scheduler.add_task("rose_picker", run_rose_picker)
+    scheduler.add_task("GenerateNamelist", generate_namelist,
+                       ["rose_picker"])
+    scheduler.add_task("GenerateLoader", generate_loader, ["rose_picker"])
+    scheduler.add_task("GenerateFeigns", generate_feigns, ["rose_picker"])
+    scheduler.run()
+
+
+def fix_feign_stop_concatenation(content: str) -> str:
+    '''fparser can't handle string concat in a stop statement, which
+    GenerateFeigns creates (https://github.com/stfc/fparser/issues/330).
+
+    :param content: the content of feign_config_mod.f90.
+
+    :returns: the fixed content.
+    '''
+    bad = "_config: '// &\n        'Unable to close temporary file'"
+    good = "_config: Unable to close temporary file'"
+    return content.replace(bad, good)
+
+
+def _fix_generated_file(rel_path: Path, content: bytes) -> bytes:
+    '''Applies fixes to the files created by the configurator tools.'''
+    if rel_path.name == 'feign_config_mod.f90':
+        return fix_feign_stop_concatenation(content.decode()).encode()
+    return content
+
+
+@step
+def configurator(config, lfric_core_source: Path,
+                 lfric_apps_source: Path,
+                 rose_meta_conf: Path,
+                 rose_picker: Tool,
+                 config_dir=None,
+                 cache: Optional[DirectoryCache] = None,
+                 rose_picker_version: str = ""):
+    '''Creates the configuration source files. If a cache is specified,
+    the generated files are stored in the cache, keyed by a hash of the
+    rose-meta.conf files, the tools and the rose_picker version (see
+    `get_configurator_key`). If this hash has not changed, the files are
+    restored from the cache instead of running the tools again.
+
+    The files are always generated in a separate directory, and only
+    copied into the configuration directory if their content has changed,
+    so that unchanged files keep their timestamps. The fparser workaround
+    for feign_config_mod.f90 is applied when copying.
+    '''
+    # pylint: disable=too-many-arguments
+    config_dir = config_dir or config.build_output / 'configuration'
+    config_dir.mkdir(parents=True, exist_ok=True)
+
+    if cache is None:
+        with TemporaryDirectory(dir=config_dir.parent) as tmp_dir:
+            run_configurator_tools(lfric_core_source, lfric_apps_source,
+                                   rose_meta_conf, rose_picker,
+                                   Path(tmp_dir))
+            copy_tree_if_changed(Path(tmp_dir), config_dir,
+                                 transform=_fix_generated_file)
+    else:
+        key = get_configurator_key(lfric_core_source, lfric_apps_source,
+                                   rose_meta_conf, rose_picker_version)
+        created = False
+
+        def populate(dst: Path):
+            nonlocal created
+            run_configurator_tools(lfric_core_source, lfric_apps_source,
+                                   rose_meta_conf, rose_picker, dst)
+            created = True
+
+        with cache.use(key, populate,
+                       metadata={"rose_meta_conf": str(rose_meta_conf)}) \
+                as generated:
+            if not created:
+                logger.info(f"Restoring configuration for "
+                            f"'{rose_meta_conf}' from cache.")
+            copy_tree_if_changed(generated, config_dir,
+                                 transform=_fix_generated_file)
 
     find_source_files(config, source_root=config_dir)
 
@@ -85,6 +259,10 @@ def fparser_workaround_stop_concatenation(config):
 
     https://github.com/stfc/fparser/issues/330
 
+    The configurator already applies this fix, so this step only changes
+    a feign_config_mod.f90 that was created otherwise. It keeps the
+    original file as `.broken`, and does not modify any file if the fix
+    has already been applied.
     """
     feign_path = None
     for file_path in config.artefact_store[ArtefactSet.FORTRAN_BUILD_FILES]:
@@ -94,13 +272,11 @@ def fparser_workaround_stop_concatenation(config):
     else:
         raise RuntimeError("Could not find 'feign_config_mod.f90'.")
 
-    # rename "broken" version
-    broken_version = feign_path.with_suffix('.broken')
-    shutil.move(feign_path, broken_version)
-
-    # make fixed version
-    bad = "_config: '// &\n        'Unable to close temporary file'"
-    good = "_config: Unable to close temporary file'"
+    content = feign_path.read_text()
+    fixed = fix_feign_stop_concatenation(content)
+    if fixed == content:
+        return
 
-    open(feign_path, 'wt').write(
-        open(broken_version, 'rt').read().replace(bad, good))
+    # keep the "broken" version, and make fixed version
+    write_if_changed(feign_path.with_suffix('.broken'), content)
+    write_if_changed(feign_path, fixed)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''This module contains a mixin for LFRic build scripts that use PSyclone
+to extract kernels (e.g. lfric_atm_extract, gungho_model_extract). The
+extraction driver needs access to the private data of the modules used
+by the kernels, so `private` is removed from these modules before
+PSyclone is run:
+
+    class FabGunghoExtract(LFRicExtractMixin, FabGungho):
+        pass
+'''
+
+import logging
+
+from fab.artefacts import ArtefactSet
+from fab.steps import step
+from fab.util import TimerLogger
+
+from source_index import SourceIndex
+from source_rewrite import (get_rewriter_version, remove_private_rewriter,
+                            REMOVE_PRIVATE_MODULES, rewrite_sources)
+
+logger = logging.getLogger('fab')
+
+
+class LFRicExtractMixin:
+    '''A mixin for an LFRic build script, which must be listed before the
+    build script class in the base classes. It adds the `remove_private`
+    stage, which runs before PSyclone, and uses the extract
+    transformation script for all files.
+    '''
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Allow --stage-jobs to be used for the new stage
+        if "remove_private" not in cls.STAGES:
+            cls.STAGES = cls.STAGES + ["remove_private"]
+
+    def define_command_line_options(self, parser=None):
+        parser = super().define_command_line_options(parser)
+        parser.add_argument(
+            '--remove-private-all', action="store_true",
+            help="Remove private from all Fortran files, not only from the "
+                 "files used by the algorithm files (and therefore by the "
+                 "extracted kernels)")
+        return parser
+
+    @step
+    def remove_private(self):
+        '''Removes private from all modules that are (directly or
+        indirectly) used by the algorithm files, or from all Fortran files
+        if --remove-private-all is specified.
+        '''
+        state = self.config
+        input_files = state.artefact_store[ArtefactSet.FORTRAN_BUILD_FILES]
+        if not self._args.remove_private_all:
+            # The extraction applies to the kernels called in the algorithm
+            # files, so only the modules (directly or indirectly) used by
+            # the algorithm files need to be modified.
+            x90_files = state.artefact_store[ArtefactSet.X90_BUILD_FILES]
+            all_files = len(input_files)
+            input_files = SourceIndex(input_files).get_closure(x90_files)
+            logger.info(f"remove-private: {len(input_files)} of {all_files} "
+                        f"files are used by the algorithm files.")
+        with TimerLogger(f"running remove-private on {len(input_files)} "
+                         f"f90 files"), \
+                self.stage_jobs("remove_private") as config:
+            rewrite_sources(config, input_files, remove_private_rewriter,
+                            name="no-private",
+                            version=get_rewriter_version(
+                                *REMOVE_PRIVATE_MODULES),
+                            memory_limit=self.memory_limit)
+
+    def psyclone(self):
+        self.remove_private()
+        super().psyclone()
+
+    def get_transformation_script(self, fpath, config):
+        ''':returns: the transformation script to be used by PSyclone.
+        :rtype: Path
+        '''
+        return config.source_root / 'optimisation' / 'extract' / 'global.py'
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''This module implements memory-aware admission of tasks that are run
+in a process pool (e.g. PSyclone or fparser-based source rewrites). Each
+task reserves its expected peak memory from a budget shared by all worker
+processes, and has to wait until enough memory is available. The peak
+memory of each task is measured and stored across builds, so that the
+estimates improve over time.
+
+The budgets are module-level objects, indexed by a label for each kind
+of task. They are created in the main process before the process pool is
+created, so they are inherited by the (forked) worker processes. Using a
+label allows several stages to run at the same time, each with its own
+budget:
+
+    with memory_limited(config, "psyclone", limit):
+        run_mp(...)     # Workers use `memory_admission("psyclone", key)`
+'''
+
+from contextlib import contextmanager
+import json
+import logging
+import multiprocessing
+import os
+from pathlib import Path
+import re
+import statistics
+import subprocess
+import tempfile
+from typing import Dict, List, Optional, Union
+
+logger = logging.getLogger('fab')
+
+# The budget and history used by `memory_admission` for each label. They
+# are set by `memory_limited` in the main process, and inherited by the
+# workers.
+_active: Dict[str, "_ActiveBudget"] = {}
+
+
+def parse_memory(value: str) -> int:
+    '''Converts a memory specification like "32GB", "500mb" or "190gb"
+    (as used by PBS) into bytes. A plain number is taken as bytes.
+
+    :param value: the memory specification.
+
+    :returns: the number of bytes.
+
+    :raises ValueError: if the value cannot be parsed.
+    '''
+    grp = re.match(r"^\s*([0-9.]+)\s*([kmgt]?)(i?b|w)?\s*$", value, re.I)
+    if not grp:
+        raise ValueError(f"Cannot parse memory specification '{value}'.")
+    factor = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3,
+              "t": 1024**4}[grp.group(2).lower()]
+    return int(float(grp.group(1)) * factor)
+
+
+def get_pbs_memory() -> Optional[int]:
+    ''':returns: the memory requested from PBS (`-l mem`), or None if
+        not running in a PBS job or if it cannot be determined.'''
+    job_id = os.environ.get("PBS_JOBID")
+    if not job_id:
+        return None
+    try:
+        res = subprocess.run(["qstat", "-f", job_id], capture_output=True,
+                             check=True, text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    grp = re.search(r"Resource_List\.mem\s*=\s*(\S+)", res.stdout)
+    if not grp:
+        return None
+    try:
+        return parse_memory(grp.group(1))
+    except ValueError:
+        return None
+
+
+def get_cgroup_memory() -> Optional[int]:
+    ''':returns: the memory limit of the cgroup of this process, or None
+        if there is no limit.'''
+    candidates = []
+    try:
+        with open("/proc/self/cgroup", encoding="utf8") as f_in:
+            for line in f_in:
+                if line.startswith("0::"):
+                    relative = line[3:].strip().lstrip("/")
+                    candidates.append(Path("/sys/fs/cgroup") / relative /
+                                      "memory.max")
+    except OSError:
+        pass
+    candidates.extend([Path("/sys/fs/cgroup/memory.max"),
+                       Path("/sys/fs/cgroup/memory/memory.limit_in_bytes")])
+    for path in candidates:
+        try:
+            value = path.read_text().strip()
+        except OSError:
+            continue
+        # v1 uses a huge number to indicate 'unlimited'
+        if value == "max" or int(value) >= 2**60:
+            return None
+        return int(value)
+    return None
+
+
+def get_physical_memory() -> Optional[int]:
+    ''':returns: the physical memory of this node, or None.'''
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def detect_memory_limit() -> int:
+    '''Determines the memory available to the build, which is the minimum
+    of the memory requested from PBS, a cgroup memory limit, and the
+    physical memory.
+
+    :returns: the available memory in bytes.
+    '''
+    sources = {"pbs": get_pbs_memory(),
+               "cgroup": get_cgroup_memory(),
+               "physical": get_physical_memory()}
+    available = {name: value for name, value in sources.items() if value}
+    if not available:
+        logger.warning("Cannot detect available memory, assuming 4GB.")
+        return 4 * 1024**3
+    limit = min(available.values())
+    logger.info(f"Detected {limit / 1024**3:.1f}GB of memory "
+                f"({', '.join(available)}).")
+    return limit
+
+
+class MemoryHistory:
+    '''Stores the peak memory use of tasks across builds in a JSON file.
+    Worker processes cannot update the dictionary of the main process,
+    so they append their measurements to a separate records file, which
+    is merged into the history by `merge_records`.
+
+    When updating the value for a key, a higher measurement is taken as
+    is, while a lower measurement only reduces the stored value slowly.
+    This avoids underestimating tasks after a single low measurement.
+
+    :param fpath: the JSON file to store the history in.
+    '''
+    # Factor by which a stored value can decrease per build.
+    DECAY = 0.8
+    # The estimate for tasks if no history is available at all.
+    DEFAULT_ESTIMATE = 1024**3
+
+    def __init__(self, fpath: Path):
+        self._fpath = fpath
+        self._records_fpath = fpath.with_suffix(".records")
+        self._peaks: Dict[str, int] = {}
+        if fpath.exists():
+            try:
+                with open(fpath, encoding="utf8") as f_in:
+                    self._peaks = json.load(f_in)
+            except (OSError, ValueError) as err:
+                logger.warning(f"Ignoring invalid memory history "
+                               f"'{fpath}': {err}")
+        self._default = (int(statistics.median(self._peaks.values()))
+                         if self._peaks else self.DEFAULT_ESTIMATE)
+
+    def estimate(self, key: str) -> int:
+        ''':returns: the expected peak memory of the task in bytes.'''
+        return self._peaks.get(key, self._default)
+
+    def record(self, key: str, peak: int):
+        '''Appends a measurement to the records file. This is called in
+        the worker processes. Each record is written with a single
+        `write` to a file opened in append mode, so records of different
+        processes do not get mixed up.'''
+        line = json.dumps({"key": key, "peak": peak}) + "\n"
+        fd = os.open(self._records_fpath,
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+    def merge_records(self):
+        '''Merges the measurements from the records file into the
+        history, and saves the history.'''
+        if not self._records_fpath.exists():
+            return
+        with open(self._records_fpath, encoding="utf8") as f_in:
+            for line in f_in:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                key, peak = record["key"], record["peak"]
+                old = self._peaks.get(key, 0)
+                self._peaks[key] = int(max(peak, self.DECAY * old))
+        tmp_fpath = self._fpath.with_suffix(".tmp")
+        with open(tmp_fpath, "w", encoding="utf8") as f_out:
+            json.dump(self._peaks, f_out, indent=0, sort_keys=True)
+        os.replace(tmp_fpath, self._fpath)
+        self._records_fpath.unlink()
+
+
+class MemoryBudget:
+    '''A memory budget that is shared between processes. A task can only
+    start if its expected memory fits into the remaining budget, or if no
+    other task is running (so a task larger than the budget will still
+    be executed, just on its own).
+
+    :param limit: the budget in bytes.
+    '''
+    def __init__(self, limit: int):
+        self._limit = limit
+        self._condition = multiprocessing.Condition()
+        self._used = multiprocessing.Value('d', 0.0, lock=False)
+        self._running = multiprocessing.Value('i', 0, lock=False)
+
+    @property
+    def limit(self) -> int:
+        ''':returns: the budget in bytes.'''
+        return self._limit
+
+    @contextmanager
+    def reserve(self, nbytes: int):
+        '''A context manager that waits till the specified amount of
+        memory is available, and releases it at the end.
+
+        :param nbytes: the amount of memory to reserve.
+        '''
+        with self._condition:
+            while (self._running.value > 0 and
+                   self._used.value + nbytes > self._limit):
+                self._condition.wait()
+            self._used.value += nbytes
+            self._running.value += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._used.value -= nbytes
+                self._running.value -= 1
+                self._condition.notify_all()
+
+
+class _ActiveBudget:
+    '''Combines a budget and a history while `memory_limited` is active.
+    '''
+    # pylint: disable=too-few-public-methods
+    def __init__(self, label: str, budget: MemoryBudget,
+                 history: MemoryHistory):
+        self.label = label
+        self.budget = budget
+        self.history = history
+
+
+@contextmanager
+def memory_limited(config, label: str, limit: Optional[int]):
+    '''A context manager that activates memory admission for all tasks
+    that use `memory_admission` and that are started in processes
+    created in this context. The measured peak memory is stored in
+    `memory_<label>.json` in the project workspace.
+
+    :param config: the Fab build config.
+    :param label: a name for this kind of task, e.g. 'psyclone'.
+    :param limit: the memory budget in bytes. If not specified, memory
+        admission is disabled.
+
+    :raises RuntimeError: if memory admission is already active for
+        this label.
+    '''
+    if not limit:
+        yield
+        return
+    if label in _active:
+        raise RuntimeError(f"Memory admission for '{label}' is already "
+                           f"active.")
+    history = MemoryHistory(config.project_workspace /
+                            f"memory_{label}.json")
+    _active[label] = _ActiveBudget(label, MemoryBudget(limit), history)
+    logger.info(f"{label}: memory budget {limit / 1024**3:.1f}GB")
+    try:
+        yield
+    finally:
+        del _active[label]
+        history.merge_records()
+
+
+def _read_status_kb(field: str) -> Optional[int]:
+    ''':returns: the value of a field in /proc/self/status (in kB).'''
+    try:
+        with open("/proc/self/status", encoding="utf8") as f_in:
+            for line in f_in:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _reset_peak_rss() -> bool:
+    '''Resets the peak resident set size (VmHWM) of this process, which
+    is supported by Linux 4.0 and later.
+
+    :returns: whether the peak could be reset.
+    '''
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="utf8") as f_out:
+            f_out.write("5")
+    except OSError:
+        return False
+    return True
+
+
+@contextmanager
+def memory_admission(label: str, key: str):
+    '''A context manager used in a worker process to execute a task with
+    memory admission. It waits till the expected memory of the task is
+    available, and then measures the peak memory used. Tasks that start
+    a subprocess should store the peak memory of the subprocess in the
+    dictionary returned by this context manager using the key 'peak'
+    (see `run_measured`). If memory admission is not active for the
+    label, this does nothing.
+
+    :param label: the label used in `memory_limited`, e.g. 'psyclone'.
+    :param key: the name used to identify the task across builds,
+        e.g. the name of the file to process.
+    '''
+    active = _active.get(label)
+    if active is None:
+        yield {}
+        return
+    measurement = {}
+    with active.budget.reserve(active.history.estimate(key)):
+        start_rss = _read_status_kb("VmRSS")
+        can_measure = start_rss is not None and _reset_peak_rss()
+        yield measurement
+        peak = 0
+        if can_measure:
+            peak = max(0, (_read_status_kb("VmHWM") or 0) - start_rss) * 1024
+        peak = max(peak, measurement.get("peak", 0))
+    if peak:
+        active.history.record(key, peak)
+
+
+def run_measured(command: List[Union[str, Path]],
+                 measurement: Dict,
+                 env: Optional[Dict[str, str]] = None,
+                 cwd: Optional[Union[Path, str]] = None,
+                 capture_output: bool = True) -> str:
+    '''Runs a command and stores the peak memory use of the command
+    in `measurement["peak"]`. The output is written to temporary files
+    (instead of pipes), so that the process can be waited for with
+    `os.wait4`, which returns the resource usage of the process.
+
+    :param command: the command to run.
+    :param measurement: dictionary to store the peak memory in.
+    :param env: optional environment for the command.
+    :param cwd: optional working directory for the command.
+    :param capture_output: whether to return the output of the command.
+
+    :returns: the standard output if capture_output is set.
+
+    :raises RuntimeError: if the command cannot be executed, or returns
+        an error.
+    '''
+    command = [str(i) for i in command]
+    logger.debug(f'run_command: {" ".join(command)}')
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        try:
+            proc = subprocess.Popen(command, stdout=out, stderr=err,
+                                    env=env, cwd=cwd)
+        except FileNotFoundError as error:
+            raise RuntimeError(f"Command '{command}' could not be "
+                               f"executed.") from error
+        _, status, rusage = os.wait4(proc.pid, 0)
+        # Avoid that Popen tries to wait for the process again
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        # ru_maxrss is in kB on Linux
+        measurement["peak"] = rusage.ru_maxrss * 1024
+        out.seek(0)
+        err.seek(0)
+        stdout = out.read().decode()
+        stderr = err.read().decode()
+    if proc.returncode != 0:
+        msg = (f'Command failed with return code {proc.returncode}:\n'
+               f'{command}')
+        if stdout:
+            msg += f'\n{stdout}'
+        if stderr:
+            msg += f'\n{stderr}'
+        raise RuntimeError(msg)
+    return stdout if capture_output else ""
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''This module contains functions to detect the number of CPUs that a
+build can actually use. This takes into account the CPU affinity of the
+process, CPU quotas set by cgroups (e.g. by PBS or a container runtime),
+and the number of CPUs requested from PBS. It also contains a budget
+that limits the number of processes used by concurrently running stages.
+'''
+
+from contextlib import contextmanager
+import logging
+import math
+import os
+from pathlib import Path
+import threading
+from typing import Dict, List, Optional
+
+logger = logging.getLogger('fab')
+
+
+def get_affinity_cpus() -> Optional[int]:
+    ''':returns: the number of CPUs this process is allowed to run on,
+        or None if this cannot be determined.'''
+    try:
+        return len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return os.cpu_count()
+
+
+def _get_cgroup_v2_path() -> Optional[Path]:
+    ''':returns: the cgroup (v2) directory of this process, or None.'''
+    try:
+        with open("/proc/self/cgroup", encoding="utf8") as f_in:
+            for line in f_in:
+                # The v2 entry has the format "0::/path"
+                if line.startswith("0::"):
+                    relative = line[3:].strip().lstrip("/")
+                    return Path("/sys/fs/cgroup") / relative
+    except OSError:
+        pass
+    return None
+
+
+def get_cgroup_cpus() -> Optional[int]:
+    ''':returns: the number of CPUs according to a cgroup CPU quota
+        (rounded up), or None if there is no quota.'''
+    # cgroup v2: cpu.max contains "$QUOTA $PERIOD" or "max $PERIOD"
+    cgroup_path = _get_cgroup_v2_path()
+    for path in [cgroup_path, Path("/sys/fs/cgroup")]:
+        if not path:
+            continue
+        try:
+            quota, period = (path / "cpu.max").read_text().split()[:2]
+        except (OSError, ValueError):
+            continue
+        if quota == "max":
+            return None
+        return max(1, math.ceil(int(quota) / int(period)))
+
+    # cgroup v1
+    try:
+        quota = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_quota_us").read_text())
+        period = int(Path("/sys/fs/cgroup/cpu/cpu.cfs_period_us").read_text())
+    except (OSError, ValueError):
+        return None
+    if quota <= 0 or period <= 0:
+        return None
+    return max(1, math.ceil(quota / period))
+
+
+def get_pbs_cpus() -> Optional[int]:
+    ''':returns: the number of CPUs requested from PBS ($NCPUS), or None
+        if not running in a PBS job.'''
+    ncpus = os.environ.get("NCPUS")
+    if not ncpus:
+        return None
+    try:
+        return max(1, int(ncpus))
+    except ValueError:
+        logger.warning(f"Ignoring invalid value of $NCPUS '{ncpus}'.")
+        return None
+
+
+def detect_n_procs() -> int:
+    '''Determines the number of processes to use for the build. This is
+    the minimum of the CPU affinity, a cgroup CPU quota and $NCPUS of
+    a PBS job.
+
+    :returns: the number of processes to use.
+    '''
+    sources = {"affinity": get_affinity_cpus(),
+               "cgroup": get_cgroup_cpus(),
+               "pbs": get_pbs_cpus()}
+    available = {name: value for name, value in sources.items() if value}
+    if not available:
+        logger.warning("Cannot detect number of CPUs, using 1.")
+        return 1
+    n_procs = min(available.values())
+    logger.info(f"Detected {n_procs} CPUs ({available}).")
+    return n_procs
+
+
+def parse_stage_jobs(stage_jobs: Optional[List[str]],
+                     stages: Optional[List[str]] = None) -> Dict[str, int]:
+    '''Converts a list of "stage=N" settings into a dictionary.
+
+    :param stage_jobs: the list of settings from the command line.
+    :param stages: the valid stage names, or None to accept all names.
+
+    :returns: the number of processes for each stage.
+
+    :raises ValueError: if a setting has the wrong format, or refers to
+        an unknown stage.
+    '''
+    result = {}
+    for setting in stage_jobs or []:
+        try:
+            stage, n_procs = setting.split("=")
+            result[stage.strip()] = int(n_procs)
+        except ValueError as err:
+            raise ValueError(f"Invalid stage-jobs setting '{setting}', "
+                             f"expected 'STAGE=N'.") from err
+        if stages is not None and stage.strip() not in stages:
+            raise ValueError(f"Unknown stage in stage-jobs setting "
+                             f"'{setting}', stages are: "
+                             f"{', '.join(stages)}.")
+        if result[stage.strip()] < 1:
+            raise ValueError(f"Invalid number of processes in stage-jobs "
+                             f"setting '{setting}'.")
+    return result
+
+
+class ProcessBudget:
+    '''A budget of processes that is shared by the build stages that
+    run concurrently (in threads) in pipeline mode, so that together
+    they do not use more processes than available. A stage is granted
+    as many of the processes it asks for as are free, but at least one,
+    so it might have to wait until another stage has finished.
+
+    :param n_procs: the total number of processes.
+    '''
+    def __init__(self, n_procs: int):
+        self._n_procs = n_procs
+        self._free = n_procs
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, n_procs: int, label: str = ""):
+        '''A context manager that reserves processes from the budget, and
+        releases them at the end.
+
+        :param n_procs: the number of processes to ask for.
+        :param label: a name for log messages, e.g. the stage.
+
+        :returns: the number of granted processes.
+        '''
+        with self._condition:
+            if not self._free:
+                logger.info(f"{label}: waiting for free processes.")
+            while not self._free:
+                self._condition.wait()
+            granted = min(n_procs, self._free)
+            self._free -= granted
+        if granted < n_procs:
+            logger.info(f"{label}: using {granted} of {n_procs} processes, "
+                        f"the others are used by concurrent stages.")
+        try:
+            yield granted
+        finally:
+            with self._condition:
+                self._free += granted
+                self._condition.notify_all()
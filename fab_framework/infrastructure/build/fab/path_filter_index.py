@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''This module contains an index for a large number of include/exclude
+path filters. Fab's find_source_files evaluates each filter for each file,
+and each filter checks if one of its strings is a substring of the path.
+With hundreds of filters (e.g. created from an FCM extract.cfg) this
+becomes slow for large source trees.
+
+A PathFilterIndex behaves like a single Fab path filter (it has a `check`
+method returning True, False or None), and gives the same result as
+evaluating all its rules in order (the last matching rule wins). Rules
+that are absolute paths in the source root can only match as a prefix of
+a (absolute) file path, so they are stored in a character trie. Checking
+a file then takes time proportional to the length of the path. All other
+rules are checked with a substring search as in Fab.
+'''
+
+import logging
+from pathlib import Path
+import time
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+logger = logging.getLogger('fab')
+
+
+class PathFilterIndex:
+    '''An index of include/exclude rules, which can be used in the list of
+    path filters of Fab's find_source_files.
+
+    :param root: the source root. Rules starting with this directory are
+        matched as prefix using a trie.
+    '''
+    # The key used in a trie node to store the rule ending at this node
+    _RULE = ""
+
+    def __init__(self, root: Optional[Union[Path, str]] = None):
+        self._root = str(root) if root else None
+        self._trie: Dict = {}
+        self._substring_rules: List[Tuple[int, str, bool]] = []
+        self._n_rules = 0
+
+    @classmethod
+    def from_filters(cls, path_filters: Iterable,
+                     root: Optional[Union[Path, str]] = None):
+        '''Creates an index from Fab path filters (Include and Exclude
+        objects), preserving their order.
+
+        :param path_filters: the Fab path filters.
+        :param root: the source root.
+
+        :returns: the new index.
+        :rtype: :py:class:`PathFilterIndex`
+        '''
+        index = cls(root)
+        for path_filter in path_filters:
+            index.add_rule(path_filter.filter_strings, path_filter.include)
+        return index
+
+    def __len__(self) -> int:
+        return self._n_rules
+
+    def add_rule(self, filter_strings: Iterable[Union[Path, str]],
+                 include: bool):
+        '''Adds a rule, which takes precedence over all previously added
+        rules.
+
+        :param filter_strings: the rule matches a path if one of these
+            strings is a substring of the path.
+        :param include: whether matching files are included or excluded.
+        '''
+        rule = (self._n_rules, include)
+        self._n_rules += 1
+        for filter_string in filter_strings:
+            filter_string = str(filter_string)
+            if self._root and filter_string.startswith(self._root):
+                node = self._trie
+                for char in filter_string:
+                    node = node.setdefault(char, {})
+                # A later rule for the same string overwrites the earlier
+                node[self._RULE] = rule
+            else:
+                self._substring_rules.append((rule[0], filter_string,
+                                              include))
+
+    def check(self, path: Union[Path, str]) -> Optional[bool]:
+        '''Checks a path against all rules.
+
+        :param path: the path to check.
+
+        :returns: whether the last rule that matches includes the path,
+            or None if no rule matches.
+        '''
+        path = str(path)
+        best = -1
+        result = None
+        node = self._trie
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+            rule = node.get(self._RULE)
+            if rule and rule[0] > best:
+                best, result = rule
+        for number, filter_string, include in self._substring_rules:
+            if number > best and filter_string in path:
+                best, result = number, include
+        return result
+
+
+# ============================================================================
+def _benchmark(n_files: int = 100000, n_rules: int = 900):
+    '''Compares the index with linear evaluation of the same rules for a
+    synthetic source tree, similar to the UM with an extract.cfg.
+    '''
+    # pylint: disable=import-outside-toplevel
+    import random
+    random.seed(0)
+    root = "/workspace/source"
+    dirs = [f"{root}/science/um/dir{i // 20}/sub{i % 20}"
+            for i in range(2000)]
+    files = [f"{random.choice(dirs)}/file_{i}.F90" for i in range(n_files)]
+
+    rules = [([f"{root}/science/um"], False)]
+    rules.extend(([random.choice(dirs)], True) for _ in range(n_rules))
+    rules.append((["/test/"], False))
+
+    def linear_check(path):
+        wanted = None
+        for filter_strings, include in rules:
+            if any(i in path for i in filter_strings):
+                wanted = include
+        return wanted
+
+    start = time.time()
+    index = PathFilterIndex(root)
+    for filter_strings, include in rules:
+        index.add_rule(filter_strings, include)
+    build_time = time.time() - start
+
+    for count in [n_files // 100, n_files // 10, n_files]:
+        subset = files[:count]
+        start = time.time()
+        expected = [linear_check(path) for path in subset]
+        linear_time = time.time() - start
+        start = time.time()
+        actual = [index.check(path) for path in subset]
+        index_time = time.time() - start
+        assert expected == actual
+        print(f"{count:7d} files, {len(rules)} rules: linear "
+              f"{linear_time:7.3f}s, index {index_time:7.3f}s "
+              f"(+{build_time:.3f}s to build)")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''This module contains a PSyclone tool for the LFRic build scripts. It
+behaves like Fab's PSyclone tool, but each PSyclone run is admitted against
+the memory budget (see memory_budget.py), and its peak memory is measured.
+
+Optionally PSyclone can be run in-process: Fab executes the PSyclone runs
+in a pool of worker processes, which are re-used for many files. If
+PSyclone and fparser are imported in the main process before the pool is
+created (see `LFRicPsyclone.preload`), each (forked) worker starts with
+all modules already imported, and keeps the PSyclone configuration and
+the parsed kernel modules between files. This avoids starting a new
+Python interpreter and importing PSyclone for each of the several
+hundred algorithm files of an application.
+
+The output of PSyclone can also be stored in a persistent cache, which is
+shared between builds (e.g. the different variants of an application).
+The key of a cache entry covers everything that affects the output: the
+x90 file, the sources of all modules it uses (directly or indirectly),
+the transformation script (and the Python modules next to it, which it
+might import), the PSyclone configuration file, the PSyclone version, and
+all other command line options.
+'''
+
+import contextlib
+import importlib
+from importlib import metadata
+import io
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Union
+
+from fab.tools import Psyclone
+
+from cache_util import DirectoryCache, hash_file, hash_strings
+from file_util import write_if_changed
+from memory_budget import memory_admission, run_measured
+from source_index import scan_source
+
+logger = logging.getLogger('fab')
+
+# The PSyclone options whose value is an output path. They are removed
+# from the cache key.
+_OUTPUT_OPTIONS = {"-o", "-opsy", "-oalg", "-okern"}
+# The PSyclone options whose value is a directory that is searched for
+# kernels and modules. The directory is replaced by the content of the
+# modules found in it in the cache key.
+_SEARCH_OPTIONS = {"-d", "-I", "--include"}
+# The PSyclone options whose value is an input file. The file is replaced
+# by the hash of its content in the cache key.
+_FILE_OPTIONS = {"-s", "--config"}
+
+
+class LFRicPsyclone(Psyclone):
+    '''A PSyclone tool that uses memory admission. The name of the file
+    that is processed is used as key to learn the memory requirements.
+
+    :param in_process: whether to run PSyclone in the calling process
+        (instead of a new subprocess for each file).
+    :param cache: the cache for the PSyclone output, or None.
+    '''
+    # The label of the memory budget used for PSyclone
+    MEMORY_LABEL = "psyclone"
+
+    def __init__(self, in_process: bool = False,
+                 cache: Optional[DirectoryCache] = None):
+        super().__init__()
+        self._in_process = in_process
+        self._cache = cache
+        self._version = ""
+        # Maps the (lower case) module names to the files in the
+        # kernel roots, see `index_modules`.
+        self._module_files: Dict[str, Path] = {}
+        # The directories that have been added to the module index
+        self._indexed_roots: Set[Path] = set()
+        # The used modules and the hash of each file, per process
+        self._file_info: Dict[Path, tuple] = {}
+        # The hash of the Python files in a directory, per process
+        self._directory_hashes: Dict[Path, str] = {}
+
+    @staticmethod
+    def preload(config_file: Optional[Path] = None):
+        '''Imports PSyclone and fparser, and optionally loads the PSyclone
+        configuration file. This is called in the main process before the
+        worker processes are created, so that they inherit the imported
+        modules.
+
+        :param config_file: the PSyclone configuration file to load.
+        '''
+        generator = importlib.import_module("psyclone.generator")
+        configuration = importlib.import_module("psyclone.configuration")
+        if config_file:
+            configuration.Config.get(do_not_load_file=True).load(
+                str(config_file))
+        logger.info(f"Preloaded PSyclone from '{generator.__file__}'.")
+
+    def index_modules(self, kernel_roots: List[Path]):
+        '''Finds all Fortran files in the kernel roots, and records the
+        file that defines each module. The PSyclone version is determined
+        as well. This is called in the main process before the worker
+        processes are created, so that they inherit this information.
+
+        :param kernel_roots: the directories to search.
+        '''
+        self._module_files = {}
+        self._indexed_roots = set()
+        for kernel_root in kernel_roots:
+            self._index_root(kernel_root)
+        try:
+            self._version = metadata.version("psyclone")
+        except metadata.PackageNotFoundError:
+            self._version = super().run(additional_parameters="--version")
+        logger.info(f"Indexed {len(self._module_files)} modules for the "
+                    f"PSyclone cache (PSyclone {self._version.strip()}).")
+
+    def _index_root(self, kernel_root: Path):
+        '''Adds the modules defined in the Fortran files of a directory
+        tree to the module index, unless the directory was already
+        indexed. Modules that are already in the index are not replaced,
+        so the directories searched first take precedence.
+
+        :param kernel_root: the directory to search.
+        '''
+        kernel_root = Path(os.path.abspath(kernel_root))
+        if kernel_root in self._indexed_roots:
+            return
+        self._indexed_roots.add(kernel_root)
+        for root, _, files in os.walk(kernel_root):
+            for name in files:
+                if os.path.splitext(name)[1].lower() in [".f90", ".x90"]:
+                    fpath = Path(root) / name
+                    for module in scan_source(fpath)[0]:
+                        self._module_files.setdefault(module, fpath)
+
+    def _get_file_info(self, fpath: Path) -> tuple:
+        ''':returns: the hash of a file, and the names of all modules it
+            uses. This is cached in the process.'''
+        if fpath not in self._file_info:
+            self._file_info[fpath] = (hash_file(fpath),
+                                      scan_source(fpath)[1])
+        return self._file_info[fpath]
+
+    def get_used_modules(self, fpath: Path) -> Dict[str, Path]:
+        ''':returns: the names and files of all modules that are used
+            (directly or indirectly) by the specified file, as far as they
+            are found in the kernel roots.'''
+        used: Dict[str, Path] = {}
+        todo = [fpath]
+        while todo:
+            _, uses = self._get_file_info(todo.pop())
+            for name in uses:
+                module_file = self._module_files.get(name)
+                if module_file and name not in used:
+                    used[name] = module_file
+                    todo.append(module_file)
+        return used
+
+    def get_script_hash(self, script: Path) -> str:
+        '''Computes the hash of a transformation script, including the
+        Python modules it might import: all Python files in the directory
+        of the script, and in all parent directories up to the
+        `optimisation` directory (if the script is in one).
+
+        :param script: the transformation script.
+
+        :returns: the hash.
+        '''
+        directories = []
+        for directory in script.parents:
+            directories.append(directory)
+            if directory.name == "optimisation":
+                break
+        else:
+            directories = [script.parent]
+        parts = [hash_file(script)]
+        for directory in directories:
+            if directory not in self._directory_hashes:
+                self._directory_hashes[directory] = hash_strings(
+                    *(f"{fpath.name}:{hash_file(fpath)}"
+                      for fpath in sorted(directory.glob("*.py"))))
+            parts.append(self._directory_hashes[directory])
+        return hash_strings(*parts)
+
+    def get_cache_key(self, params: List[str]) -> Optional[str]:
+        '''Computes the cache key for a PSyclone run.
+
+        :param params: the command line parameters for PSyclone.
+
+        :returns: the cache key, or None if the parameters do not
+            process an x90 file.
+        '''
+        if not params or Path(params[-1]).suffix.lower() != ".x90":
+            return None
+        x90_file = Path(params[-1])
+        parts = ["psyclone", self._version, hash_file(x90_file)]
+        path_options = _OUTPUT_OPTIONS | _SEARCH_OPTIONS | _FILE_OPTIONS
+        i = 0
+        while i < len(params) - 1:
+            param = params[i]
+            i += 1
+            # The value of an option can be the next parameter, or be
+            # separated by '=' (e.g. --config=psyclone.cfg)
+            option, _, value = param.partition("=")
+            if option not in path_options or \
+                    (not value and i == len(params) - 1):
+                parts.append(param)
+                continue
+            if not value:
+                value = params[i]
+                i += 1
+            if option == "-s":
+                parts.append(f"-s={self.get_script_hash(Path(value))}")
+            elif option in _FILE_OPTIONS:
+                parts.append(f"{option}={hash_file(Path(value))}")
+            elif option in _SEARCH_OPTIONS:
+                # The modules found in the directory are part of the key
+                self._index_root(Path(value))
+                parts.append(option)
+        parts.extend(sorted(f"{name}:{self._get_file_info(fpath)[0]}"
+                            for name, fpath in
+                            self.get_used_modules(x90_file).items()))
+        return hash_strings(*parts)
+
+    @staticmethod
+    def get_memory_key(params: List[str]) -> str:
+        ''':returns: the key used for the memory history, which is the
+            name of the (last) Fortran file in the parameters.'''
+        for param in reversed(params):
+            if Path(param).suffix.lower() in [".x90", ".f90"]:
+                return Path(param).name
+        return "psyclone"
+
+    def run(self,
+            additional_parameters: Optional[
+                Union[str, List[Union[Path, str]]]] = None,
+            env: Optional[Dict[str, str]] = None,
+            cwd: Optional[Union[Path, str]] = None,
+            capture_output=True,
+            profile: Optional[str] = None) -> str:
+        '''Runs PSyclone with the given parameters once enough memory is
+        available.
+
+        :param profile: the compilation profile, which selects the flags
+            of the tool (supported by Fab 2.0 and later).
+        '''
+        if isinstance(additional_parameters, str):
+            params = [additional_parameters]
+        else:
+            params = [str(i) for i in additional_parameters or []]
+        if hasattr(self, "get_flags"):
+            flags = self.get_flags(profile)
+        else:
+            flags = self.flags
+        params = [str(i) for i in flags] + params
+        if self._cache is not None and env is None and cwd is None:
+            key = self.get_cache_key(params)
+            if key:
+                return self._run_cached(key, params, capture_output)
+        return self._run(params, env, cwd, capture_output)
+
+    def _run(self, params: List[str],
+             env: Optional[Dict[str, str]],
+             cwd: Optional[Union[Path, str]],
+             capture_output: bool) -> str:
+        '''Runs PSyclone once enough memory is available, either in this
+        process or in a subprocess.
+
+        :param params: all command line parameters (including the flags
+            of the tool).
+        '''
+        key = self.get_memory_key(params)
+        if self._in_process and env is None and cwd is None:
+            with memory_admission(self.MEMORY_LABEL, key):
+                return self._run_in_process(params, capture_output)
+        command = [self.exec_name] + params
+        with memory_admission(self.MEMORY_LABEL, key) as measurement:
+            return run_measured(command, measurement, env=env, cwd=cwd,
+                                capture_output=capture_output)
+
+    def _run_in_process(self, params: List[str],
+                        capture_output: bool) -> str:
+        '''Runs PSyclone's main function in this process.
+
+        :param params: the command line parameters for PSyclone.
+        :param capture_output: whether to return the output of PSyclone.
+
+        :returns: the standard output if capture_output is set.
+
+        :raises RuntimeError: if PSyclone fails.
+        '''
+        # pylint: disable=import-outside-toplevel
+        from fparser.two.symbol_table import SYMBOL_TABLES
+        from psyclone.generator import main
+
+        logger.debug(f"Running in-process: psyclone {' '.join(params)}")
+        # The symbol tables of fparser are global, and must not contain
+        # the symbols of a previously processed file.
+        SYMBOL_TABLES.clear()
+        stdout = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(stdout):
+                main(params)
+        except SystemExit as err:
+            if err.code not in [None, 0]:
+                raise RuntimeError(
+                    f"Command 'psyclone {' '.join(params)}' failed with "
+                    f"exit code {err.code}:\n{stdout.getvalue()}") from err
+        except Exception as err:
+            raise RuntimeError(f"Command 'psyclone {' '.join(params)}' "
+                               f"failed: {err}") from err
+        return stdout.getvalue() if capture_output else ""
+
+    def _run_cached(self, key: str, params: List[str],
+                    capture_output: bool) -> str:
+        '''Restores the output files of PSyclone from the cache. If they
+        are not cached, PSyclone is run to create them in the cache. Output
+        files are only written if their content changes.
+
+        :param key: the cache key.
+        :param params: the command line parameters for PSyclone.
+        :param capture_output: whether to return the output of PSyclone.
+
+        :returns: the standard output if capture_output is set and
+            PSyclone was run.
+        '''
+        outputs = {option: Path(params[params.index(option) + 1])
+                   for option in ["-opsy", "-oalg"] if option in params}
+        stdout = ""
+        created = False
+
+        def populate(dst: Path):
+            nonlocal stdout, created
+            cache_params = list(params)
+            for option in outputs:
+                cache_params[cache_params.index(option) + 1] = \
+                    str(dst / option.lstrip("-"))
+            stdout = self._run(cache_params, None, None, capture_output)
+            created = True
+
+        with self._cache.use(key, populate,
+                             metadata={"x90": params[-1]}) as cached:
+            if not created:
+                logger.debug(f"PSyclone cache hit for '{params[-1]}'.")
+            for option, output in outputs.items():
+                cached_file = cached / option.lstrip("-")
+                if cached_file.exists():
+                    write_if_changed(output, cached_file.read_bytes())
+        return stdout
@@ -9,11 +9,17 @@ If required, a version of rose_picker will be checked out.
 import logging
 import os
 from pathlib import Path
+import runpy
+import shutil
+import sys
+import threading
 from typing import Optional
 
 from fab.tools import Category, Tool, ToolRepository
 from fab.util import get_fab_workspace
 
+from cache_util import hash_file, hash_files, hash_strings
+
 logger = logging.getLogger('fab')
 
 
@@ -22,36 +28,112 @@ class RosePicker(Tool):
     adding the required PYTHONPATH to the environment in case that rose_picker
     is not installed, but downloaded.
 
+    By default rose_picker is executed in the current Python process, which
+    avoids starting a new interpreter and importing all modules for each
+    run. The result of the availability check is stored in a marker file
+    in the checkout, together with the tag and a hash of the checked-out
+    files, so it only needs to be done once per checkout.
+
     :param path: the path to the rose picker binary.
+    :param tag: the tag of the checkout, used for the availability marker.
+    :param in_process: whether to run rose_picker in this process.
     '''
-    def __init__(self, path: Path):
+    # Running in-process modifies sys.argv and sys.path, so only one
+    # thread can do this at a time.
+    _in_process_lock = threading.Lock()
+
+    def __init__(self, path: Path, tag: str = "", in_process: bool = True):
         super().__init__("rose_picker", exec_name=str(path))
         # This is the required PYTHONPATH for running rose_picker
-        self._pythonpath = path / "lib" / "python"
+        self._pythonpath = path.parent.parent / "lib" / "python"
+        self._tag = tag
+        self._in_process = in_process
+        self._marker = path.parent.parent / ".fab_rose_picker_available"
+
+    def get_checkout_hash(self) -> str:
+        ''':returns: a hash of the tag, the rose_picker script and all
+            files in its Python library.'''
+        files = [Path(self.exec_name)]
+        if self._pythonpath.is_dir():
+            files.extend(sorted(fpath for fpath in
+                                self._pythonpath.rglob("*.py")))
+        return hash_strings(self._tag, hash_files(files))
 
     def check_available(self):
-        ''':returns: whether rose_picker works by running `rose_picker -help`.
+        ''':returns: whether rose_picker works by running `rose_picker -help`,
+        unless this was already verified for this checkout.
         '''
+        if not Path(self.exec_name).exists():
+            return False
+        checkout_hash = self.get_checkout_hash()
+        try:
+            if self._marker.read_text().strip() == checkout_hash:
+                return True
+        except OSError:
+            pass
+
         try:
             self.run(additional_parameters="-help")
         except RuntimeError:
             return False
 
+        try:
+            self._marker.write_text(checkout_hash)
+        except OSError as err:
+            logger.warning(f"Cannot write '{self._marker}': {err}")
         return True
 
-    def run(self, *args, **kwargs):
-        '''This wrapper adds the required PYTHONPATH, and passes all
-        parameters through to the tool's run function.
+    def run(self, additional_parameters=None, env=None, cwd=None,
+            capture_output=True):
+        '''Runs rose_picker. If running in-process is enabled (and
+        no special environment or working directory is requested), the
+        rose_picker script is executed in this process. Otherwise this
+        wrapper adds the required PYTHONPATH, and passes all parameters
+        through to the tool's run function.
         '''
-        env = os.environ.copy()
+        if self._in_process and env is None and cwd is None:
+            self._run_in_process(additional_parameters)
+            return
+        env = dict(env or os.environ)
         env["PYTHONPATH"] = (f"{env.get('PYTHONPATH', '')}:"
                              f"{self._pythonpath}")
 
-        super().run(*args, **kwargs, env=env)
+        super().run(additional_parameters=additional_parameters, env=env,
+                    cwd=cwd, capture_output=capture_output)
+
+    def _run_in_process(self, additional_parameters):
+        '''Executes the rose_picker script in this process.
+
+        :raises RuntimeError: if rose_picker fails.
+        '''
+        if isinstance(additional_parameters, str):
+            params = [additional_parameters]
+        else:
+            params = [str(i) for i in additional_parameters or []]
+        logger.debug(f"Running in-process: {self.exec_name} {params}")
+        with self._in_process_lock:
+            old_argv = sys.argv
+            old_path = list(sys.path)
+            sys.argv = [self.exec_name] + params
+            sys.path.insert(0, str(self._pythonpath))
+            try:
+                runpy.run_path(self.exec_name, run_name="__main__")
+            except SystemExit as err:
+                if err.code not in [None, 0]:
+                    raise RuntimeError(f"Command '{self.exec_name} "
+                                       f"{' '.join(params)}' failed with "
+                                       f"exit code {err.code}.") from err
+            except Exception as err:
+                raise RuntimeError(f"Command '{self.exec_name} "
+                                   f"{' '.join(params)}' failed: "
+                                   f"{err}") from err
+            finally:
+                sys.argv = old_argv
+                sys.path[:] = old_path
 
 
 # =============================================================================
-def get_rose_picker(tag: Optional[str] = "v2.0.0"):
+def get_rose_picker(tag: Optional[str] = "v2.0.0", in_process: bool = True):
     '''Returns a Fab RosePicker tool. It can either be a version installed
     in the system, which is requested by setting tag to `system`, or a
     newly installed version via an FCM checkout. If there is already a
@@ -60,6 +142,8 @@ def get_rose_picker(tag: Optional[str] = "v2.0.0"):
 
     :param tag: either the tag in the repository to use, or 'system' to
         indicate to use a version installed in the system.
+    :param in_process: whether to run a checked-out rose_picker in this
+        process instead of in a subprocess.
     '''
 
     if tag.lower() == "system":
@@ -73,7 +157,7 @@ def get_rose_picker(tag: Optional[str] = "v2.0.0"):
 
     gpl_utils = get_fab_workspace() / f"gpl-utils-{tag}" / "source"
     rp_path = gpl_utils / "bin" / "rose_picker"
-    rp = RosePicker(rp_path)
+    rp = RosePicker(rp_path, tag, in_process)
 
     # If the tool is not available (the class will run `rose_picker -help`
     # to verify this ), install it
@@ -93,7 +177,7 @@ def get_rose_picker(tag: Optional[str] = "v2.0.0"):
 
         # We need to create a new instance, since `is_available` is
         # cached (I.e. it's always false in the previous instance)
-        rp = RosePicker(rp_path)
+        rp = RosePicker(rp_path, tag, in_process)
 
     if not rp.is_available:
         msg = f"Cannot run rose_picker tag '{tag}'."
@@ -102,6 +186,24 @@ def get_rose_picker(tag: Optional[str] = "v2.0.0"):
     return rp
 
 
+# =============================================================================
+def get_rose_picker_version(tag: Optional[str] = "v2.0.0") -> str:
+    '''Returns a string that identifies the version of rose_picker that
+    `get_rose_picker` returns for the tag, e.g. to be used in a cache key.
+    A tag identifies a version uniquely, but for a rose_picker installed in
+    the system the path and a hash of the executable are used.
+
+    :param tag: either the tag in the repository to use, or 'system' to
+        indicate to use a version installed in the system.
+    '''
+    if tag.lower() != "system":
+        return tag
+    exec_path = shutil.which("rose_picker")
+    if not exec_path:
+        return "system"
+    return f"system:{exec_path}:{hash_file(Path(exec_path))}"
+
+
 # =============================================================================
 if __name__ == "__main__":
     rose_picker = get_rose_picker("v1.0.0")
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''This module contains a persistent cache for source code exported from
+a repository. Each export is stored once per (repository URL, path,
+revision), and the build workspace is populated with reflinks to (or
+copies of) the cached files. This avoids exporting the same revision of
+e.g. the UM or JULES on every build. Hardlinks are only used if requested,
+since an in-place modification of a file in the workspace would then
+also modify the cache.
+'''
+
+from contextlib import contextmanager
+import logging
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import time
+from typing import Callable, Optional, Union
+
+from fab.steps.grab.fcm import fcm_export
+from fab.tools import Category
+
+from cache_util import DirectoryCache, hash_strings
+from file_util import link_tree
+
+logger = logging.getLogger('fab')
+
+
+class SourceCache(DirectoryCache):
+    '''A cache of exported source trees.
+
+    :param root: the root directory of the cache.
+    :param max_size: the maximum size of the cache in bytes.
+    '''
+
+    @staticmethod
+    def is_cacheable(revision: Optional[Union[int, str]]) -> bool:
+        ''':returns: whether an export of this revision can be cached.
+            This is not the case if no revision is specified, or if
+            the revision is HEAD, since the content can then change.'''
+        return (revision is not None and str(revision).strip() != "" and
+                str(revision).strip().upper() != "HEAD")
+
+    @staticmethod
+    def get_key(url: str, path: str, revision: Union[int, str]) -> str:
+        ''':returns: the cache key for the specified export.'''
+        return hash_strings(url, path.strip("/"), str(revision).strip())
+
+    @contextmanager
+    def get_tree(self, config, url: str, path: str,
+                 revision: Union[int, str]):
+        '''A context manager that provides the cached source tree for the
+        specified export. If it is not cached yet, it will be exported
+        (using the FCM tool of the config's tool box) into the cache. The
+        tree is not removed from the cache while the context is active.
+
+        :param config: the Fab build config.
+        :param url: the repository URL, e.g. 'fcm:um.xm_tr'.
+        :param path: the path in the repository, e.g. 'src'.
+        :param revision: the revision to export.
+
+        :returns: the directory containing the exported files.
+        '''
+        src = f"{url}/{path}"
+        exported = False
+
+        def export(dst: Path):
+            nonlocal exported
+            start = time.time()
+            config.tool_box[Category.FCM].export(src, dst, revision)
+            exported = True
+            logger.info(f"Exported '{src}' revision '{revision}' into the "
+                        f"source cache in {time.time() - start:.1f}s.")
+
+        with self.use(self.get_key(url, path, revision), export,
+                      metadata={"url": url, "path": path,
+                                "revision": str(revision)}) as tree:
+            if not exported:
+                logger.info(f"Source cache hit for '{src}' revision "
+                            f"'{revision}'.")
+            yield tree
+
+
+def fcm_export_cached(config, source_cache: Optional[SourceCache],
+                      url: str, path: str, dst_label: str,
+                      revision: Optional[Union[int, str]] = None,
+                      path_filter: Optional[Callable[[Path], bool]] = None,
+                      mode: str = "reflink"):
+    '''Exports a path from an FCM repository into the source folder of the
+    build. If a source cache is specified and the revision is fixed, the
+    files are taken from the cache. Otherwise, Fab's fcm_export is used.
+
+    :param config: the Fab build config.
+    :param source_cache: the source cache to use, or None.
+    :param url: the repository URL, e.g. 'fcm:um.xm_tr'.
+    :param path: the path in the repository, e.g. 'src'.
+    :param dst_label: the destination folder relative to the source
+        folder of the build.
+    :param revision: the revision to export.
+    :param path_filter: optional function that is called with the path of
+        each exported file (relative to the exported path). Only files
+        for which it returns True are copied into the source folder.
+    :param mode: how the files are copied from the source cache, see
+        `link_or_copy`. The default is a reflink, falling back to a copy.
+        A hardlink ("link") must only be used if no step modifies the
+        source files in place, since this would also modify the cache.
+    '''
+    src = f"{url}/{path}"
+    dst = config.source_root / dst_label
+    if source_cache is None or not SourceCache.is_cacheable(revision):
+        if not path_filter:
+            fcm_export(config, src=src, dst_label=dst_label,
+                       revision=revision)
+            return
+        # Export into a temporary directory in the workspace (so that
+        # hardlinks can be used), and only keep the selected files.
+        config.project_workspace.mkdir(parents=True, exist_ok=True)
+        with TemporaryDirectory(dir=config.project_workspace) as tmp_dir:
+            config.tool_box[Category.FCM].export(src, tmp_dir, revision)
+            link_tree(Path(tmp_dir), dst, path_filter=path_filter)
+        return
+    with source_cache.get_tree(config, url, path, revision) as tree:
+        link_tree(tree, dst, path_filter=path_filter, mode=mode)
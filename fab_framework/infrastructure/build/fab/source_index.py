@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''This module contains a light-weight index of Fortran source files,
+which records the modules each file defines and uses. It is created with
+regular expressions (instead of a full parse with fparser as done by Fab's
+analyse step), so it is fast enough to be used before the analysis, e.g.
+to restrict a step to the files that are (directly or indirectly) used by
+some other files, or to find the files that can be reached from the
+root symbols before any file is preprocessed (see `get_reachable_files`).
+'''
+
+import logging
+import re
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Union
+
+logger = logging.getLogger('fab')
+
+# Matches the module name in a Fortran use statement
+USE_PATTERN = re.compile(
+    r"^\s*use\s*(?:,\s*(?:non_)?intrinsic\s*::)?\s*(?:::)?\s*(\w+)",
+    re.IGNORECASE | re.MULTILINE)
+
+# Matches the name in a module statement (but not 'module procedure' or
+# 'module function' etc.)
+MODULE_PATTERN = re.compile(
+    r"^\s*module\s+(?!(?:procedure|function|subroutine|pure|elemental|"
+    r"recursive|impure)\b)(\w+)\s*(?:!.*)?$",
+    re.IGNORECASE | re.MULTILINE)
+
+# Matches the name in a program statement
+PROGRAM_PATTERN = re.compile(r"^\s*program\s+(\w+)",
+                             re.IGNORECASE | re.MULTILINE)
+
+# Matches the name of a subroutine or function that is defined (or
+# declared in an interface block), but not 'end subroutine' etc.
+PROCEDURE_PATTERN = re.compile(
+    r"^(?!\s*end\b)[^!'\"\n]*?\b(subroutine|function)\s+(\w+)",
+    re.IGNORECASE | re.MULTILINE)
+
+# Matches the ancestor module in a submodule statement
+SUBMODULE_PATTERN = re.compile(r"^\s*submodule\s*\(\s*(\w+)",
+                               re.IGNORECASE | re.MULTILINE)
+
+# Matches any name (including names in comments, e.g. in the '! DEPENDS
+# ON:' comments used by the UM)
+NAME_PATTERN = re.compile(r"\b[a-z_]\w*", re.IGNORECASE)
+
+# Matches the file in a Fortran include or a preprocessor #include
+INCLUDE_PATTERN = re.compile(
+    r"^\s*(?:#\s*include|include)\s*[\"'<]([^\"'>]+)[\"'>]",
+    re.IGNORECASE | re.MULTILINE)
+
+# Matches the C binding of a procedure
+BIND_C_PATTERN = re.compile(r"\bbind\s*\(\s*c\b", re.IGNORECASE)
+
+# The (lower case) suffixes of Fortran files (including fixed form files
+# and PSyclone algorithm files)
+FORTRAN_SUFFIXES = [".f", ".for", ".f77", ".f90", ".f95", ".f03", ".f08",
+                    ".x90"]
+
+# The suffixes of files that are included by other files
+INCLUDE_SUFFIXES = [".h", ".inc"]
+
+
+def scan_source(fpath: Path):
+    ''':returns: the (lower case) names of the modules defined in and used
+        by a Fortran file.
+    :rtype: Tuple[Set[str], Set[str]]
+    '''
+    content = fpath.read_text(encoding="utf8", errors="replace")
+    defined = {name.lower() for name in MODULE_PATTERN.findall(content)}
+    used = {name.lower() for name in USE_PATTERN.findall(content)}
+    return defined, used - defined
+
+
+class SourceIndex:
+    '''An index of the modules defined and used by a set of files.
+
+    :param fpaths: the files to index.
+    '''
+    def __init__(self, fpaths: Iterable[Path]):
+        self._uses: Dict[Path, Set[str]] = {}
+        self._module_files: Dict[str, Path] = {}
+        for fpath in fpaths:
+            self.add_file(fpath)
+
+    def add_file(self, fpath: Path):
+        '''Adds a file to the index.
+
+        :param fpath: the file to add.
+        '''
+        defined, used = scan_source(fpath)
+        self._uses[fpath] = used
+        for name in defined:
+            if name in self._module_files:
+                logger.debug(f"Module '{name}' is defined in "
+                             f"'{self._module_files[name]}' and '{fpath}'.")
+            self._module_files.setdefault(name, fpath)
+
+    def get_module_file(self, name: str) -> Path:
+        ''':returns: the file that defines the module, or None.'''
+        return self._module_files.get(name.lower())
+
+    def get_used_modules(self, fpath: Path) -> Set[str]:
+        ''':returns: the names of the modules used by a file, which is
+            scanned if it is not in the index.'''
+        if fpath not in self._uses:
+            self._uses[fpath] = scan_source(fpath)[1]
+        return self._uses[fpath]
+
+    def get_closure(self, seeds: Iterable[Path]) -> Set[Path]:
+        '''Computes all files in the index that define modules which are
+        used (directly or indirectly) by the seeds. Modules that are not
+        defined in the index (e.g. intrinsic modules or modules of
+        external libraries) are ignored.
+
+        :param seeds: the files to start from. These do not need to be in
+            the index.
+
+        :returns: the used files, plus the seeds that are in the index.
+        '''
+        closure = {seed for seed in seeds if seed in self._uses}
+        todo = list(seeds)
+        while todo:
+            for name in self.get_used_modules(todo.pop()):
+                module_file = self._module_files.get(name)
+                if module_file and module_file not in closure:
+                    closure.add(module_file)
+                    todo.append(module_file)
+        return closure
+
+
+def get_reachable_files(fpaths: Iterable[Path],
+                        root_symbols: Union[str, List[str]],
+                        seeds: Iterable[Path] = ()) -> Set[Path]:
+    '''Computes a conservative estimate of the source files that are
+    needed to build the root symbols, using only regular expressions on
+    the (not yet preprocessed) source files. A file is needed if it
+    defines a root program, or if a needed file mentions anything the
+    file defines: a module, a subroutine or function (e.g. in a call, an
+    EXTERNAL statement, or as actual argument), the name of the file
+    without suffix (e.g. in a '! DEPENDS ON:' comment), or the file name
+    in an include. A submodule is needed if its ancestor module is
+    needed. All preprocessor branches, comments and strings are scanned.
+    Files that define functions outside of a module, or C bindings
+    (which might only be called from C), are always kept.
+
+    :param fpaths: the source files (including x90 and include files).
+    :param root_symbols: the name(s) of the root program(s).
+    :param seeds: files that are always needed (e.g. generated files).
+
+    :returns: the needed files, or all files if no root program is found.
+    '''
+    if isinstance(root_symbols, str):
+        root_symbols = [root_symbols]
+    root_symbols = {name.lower() for name in root_symbols}
+    fpaths = list(fpaths)
+    seeds = list(seeds)
+    definitions: Dict[str, Set[Path]] = {}
+    dependencies: Dict[Path, Set[str]] = {}
+    todo = list(seeds)
+    found_root = False
+    for fpath in set(fpaths) | set(seeds):
+        content = fpath.read_text(encoding="utf8", errors="replace")
+        modules = {name.lower() for name in MODULE_PATTERN.findall(content)}
+        procedures = {(kind.lower(), name.lower()) for kind, name in
+                      PROCEDURE_PATTERN.findall(content)}
+        # A file can be included with its full name (e.g. "x.F90")
+        for name in (modules | {name for _, name in procedures} |
+                     {name.lower()
+                      for name in SUBMODULE_PATTERN.findall(content)} |
+                     {fpath.stem.lower(), fpath.name.lower()}):
+            definitions.setdefault(name, set()).add(fpath)
+        dependencies[fpath] = (
+            {name.lower() for name in NAME_PATTERN.findall(content)} |
+            {Path(name).name.lower()
+             for name in INCLUDE_PATTERN.findall(content)})
+        programs = {name.lower() for name in PROGRAM_PATTERN.findall(content)}
+        if programs & root_symbols:
+            found_root = True
+            todo.append(fpath)
+        elif BIND_C_PATTERN.search(content) or (
+                not modules and any(kind == "function"
+                                    for kind, _ in procedures)):
+            todo.append(fpath)
+
+    if not found_root:
+        logger.warning(f"Cannot find the root symbols {sorted(root_symbols)}, "
+                       f"all files are needed.")
+        return set(fpaths)
+
+    needed: Set[Path] = set(todo)
+    while todo:
+        for name in dependencies.get(todo.pop(), set()):
+            for fpath in definitions.get(name, set()) - needed:
+                needed.add(fpath)
+                todo.append(fpath)
+    return needed
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''This module contains a generic step that rewrites source files in the
+build directory in place (e.g. to remove `private` statements using
+fparser). The result for each file is stored as a prebuild, keyed by the
+hash of the input file and the version of the rewriter, so a file is only
+rewritten (and parsed) if it or the rewriter has changed:
+
+    rewrite_sources(config, files, remove_private_rewriter,
+                    name="no-private",
+                    version=get_rewriter_version(*REMOVE_PRIVATE_MODULES))
+
+A rewriter is a function that takes the path of a file and returns the
+new content. Since the files are rewritten in parallel, it must be a
+module-level function (so that it can be pickled).
+'''
+
+import importlib
+from importlib import metadata
+import logging
+import os
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional
+
+from fab.steps import run_mp
+from fab.util import log_or_dot
+
+from cache_util import hash_file, hash_strings
+from file_util import link_or_copy
+from memory_budget import memory_admission, memory_limited
+
+logger = logging.getLogger('fab')
+
+# The modules that determine the result of `remove_private_rewriter`
+REMOVE_PRIVATE_MODULES = ["remove_private", "fparser", "psyclone"]
+
+
+def get_rewriter_version(*module_names: str) -> str:
+    '''Creates a version string for a rewriter from the modules it uses.
+    For an installed package its version is used, otherwise the hash of
+    the module's source file.
+
+    :param module_names: the names of the modules.
+
+    :returns: the version string.
+    '''
+    versions = []
+    for name in module_names:
+        try:
+            versions.append(f"{name}={metadata.version(name)}")
+        except metadata.PackageNotFoundError:
+            module = importlib.import_module(name)
+            versions.append(f"{name}:{hash_file(Path(module.__file__))}")
+    return hash_strings(*versions)
+
+
+def remove_private_rewriter(fpath: Path) -> str:
+    ''':returns: the content of the file without `private` statements and
+        attributes, and with lines limited to the length allowed by the
+        Fortran standard.'''
+    # pylint: disable=import-outside-toplevel
+    from remove_private import remove_private
+    from psyclone.line_length import FortLineLength
+    tree = remove_private(str(fpath))
+    return FortLineLength().process(str(tree))
+
+
+def rewrite_one_file(args) -> Path:
+    '''Rewrites one file, or restores the result from its prebuild.
+    This is called in the worker processes.
+
+    :returns: the prebuild file.
+    '''
+    config, fpath, rewrite, name, version, mode = args
+    key = hash_strings(hash_file(fpath), version)
+    prebuild = (config.prebuild_folder /
+                f'{name}-{fpath.stem}.{key}{fpath.suffix}')
+
+    if prebuild.exists():
+        log_or_dot(logger, f'{name}: using prebuild {prebuild}')
+    else:
+        log_or_dot(logger, f'{name}: rewriting {fpath}')
+        # Large files can need a lot of memory in fparser
+        with memory_admission(name, fpath.name):
+            code = rewrite(fpath)
+        tmp_prebuild = prebuild.with_suffix(f".tmp{os.getpid()}")
+        with open(tmp_prebuild, "wt", encoding="utf8") as f_out:
+            f_out.write(code)
+        os.replace(tmp_prebuild, prebuild)
+    link_or_copy(prebuild, fpath, mode)
+    return prebuild
+
+
+def rewrite_sources(config, fpaths: Iterable[Path],
+                    rewrite: Callable[[Path], str],
+                    name: str, version: str,
+                    memory_limit: Optional[int] = None,
+                    mode: str = "reflink") -> List[Path]:
+    '''Rewrites files in parallel, using the prebuilds of files that have
+    not changed. The prebuilds used are added to the current prebuilds,
+    so that they are not removed by the clean-up at the end of the build.
+
+    :param config: the Fab build config.
+    :param fpaths: the files to rewrite in place.
+    :param rewrite: the rewriter, a module-level function that returns
+        the new content of the file it is called with.
+    :param name: the name of the rewrite, used as prefix for the
+        prebuilds and as label for memory admission.
+    :param version: the version of the rewriter. Changing it invalidates
+        all prebuilds.
+    :param memory_limit: the memory budget for the rewrites, or None.
+    :param mode: how a file is restored from its prebuild, see
+        `link_or_copy`. A hardlink ("link") must only be used if no
+        later step modifies the files in place, since this would also
+        modify the prebuild. The default is a reflink, falling back to a
+        copy.
+
+    :returns: the prebuild files.
+    '''
+    args = [(config, fpath, rewrite, name, version, mode)
+            for fpath in sorted(fpaths)]
+    with memory_limited(config, name, memory_limit):
+        prebuilds = run_mp(config, args, rewrite_one_file)
+    config.add_current_prebuilds(prebuilds)
+    return prebuilds
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''This module contains a Fortran compilation step that does not compile
+in dependency 'waves'. Fab's compile_fortran step compiles all files whose
+dependencies are available, waits until all of them are finished, and then
+starts the next wave. This step instead submits each file to the process
+pool as soon as all modules it depends on have been compiled, so a single
+slow file only delays the files that actually depend on it.
+
+The compile time of each file is stored across builds (see
+compile_history.py), and files that start the longest chains of dependent
+compilations are submitted first. The predicted and the actual critical
+path are logged.
+'''
+
+from concurrent.futures import (FIRST_COMPLETED, Future,
+                                ProcessPoolExecutor, wait)
+import heapq
+import logging
+from pathlib import Path
+import time
+from typing import Dict, List, Optional, Set
+
+from fab.steps import check_for_errors, step
+from fab.steps.compile_fortran import (compile_fortran, DEFAULT_SOURCE_GETTER,
+                                       get_mod_hashes, handle_compiler_args,
+                                       MpCommonArgs, process_file,
+                                       store_artefacts)
+from fab.util import log_or_dot_finish
+
+from compile_history import (CompileHistory, compute_actual_critical_path,
+                             compute_critical_path, log_critical_path)
+
+logger = logging.getLogger('fab')
+
+
+def get_compile_dependencies(analysed_files) -> Dict[Path, Set[Path]]:
+    '''Determines for each file the set of files that must be compiled
+    before the file can be compiled. Like Fab, only dependencies on .f90
+    files are taken into account.
+
+    :param analysed_files: the analysed Fortran files to compile.
+    :type analysed_files: Iterable[:py:class:`fab.dep_tree.AnalysedFortran`]
+
+    :returns: the compile dependencies for each file.
+
+    :raises ValueError: if a file depends on a file that will not be
+        compiled.
+    '''
+    all_files = {af.fpath for af in analysed_files}
+    dependencies = {}
+    missing = {}
+    for af in analysed_files:
+        deps = {dep for dep in af.file_deps if dep.suffix == '.f90'}
+        deps.discard(af.fpath)
+        if deps - all_files:
+            missing[af.fpath] = deps - all_files
+        dependencies[af.fpath] = deps
+    if missing:
+        msg = "\n".join(f"{fpath}: {sorted(map(str, deps))}"
+                        for fpath, deps in missing.items())
+        raise ValueError(f"Nothing more can be compiled due to unfulfilled "
+                         f"dependencies:\n{msg}")
+    return dependencies
+
+
+class StreamingCompiler:
+    '''Compiles a set of analysed Fortran files, submitting each file as
+    soon as its dependencies are compiled. The order in which ready files
+    are submitted is determined by `priority`, which is a dictionary
+    mapping file paths to a number (larger means compiled earlier). Files
+    without priority are compiled in the order in which they become ready.
+
+    :param config: the Fab build config.
+    :param mp_common_args: the arguments shared by all compilations.
+    :param analysed_files: the files to compile.
+    :param priority: optional priorities of the files.
+    '''
+    def __init__(self, config, mp_common_args: MpCommonArgs,
+                 analysed_files, priority: Optional[Dict[Path, float]] = None):
+        self._config = config
+        self._mp_common_args = mp_common_args
+        self._files = {af.fpath: af for af in analysed_files}
+        self._priority = priority or {}
+        self._dependencies = get_compile_dependencies(analysed_files)
+        # The dependencies that are not yet compiled for each file
+        self._waiting = {fpath: set(deps)
+                         for fpath, deps in self._dependencies.items()}
+        # The reverse dependencies: which files are waiting for a file
+        self._dependents: Dict[Path, List[Path]] = {fpath: []
+                                                    for fpath in self._files}
+        for fpath, deps in self._dependencies.items():
+            for dep in deps:
+                self._dependents[dep].append(fpath)
+        self._mod_hashes: Dict[str, int] = {}
+        self._ready: List = []
+        self._counter = 0
+
+    @property
+    def dependencies(self) -> Dict[Path, Set[Path]]:
+        ''':returns: for each file the set of files it depends on.'''
+        return self._dependencies
+
+    @property
+    def priority(self) -> Dict[Path, float]:
+        ''':returns: the priority of each file.'''
+        return self._priority
+
+    @priority.setter
+    def priority(self, priority: Dict[Path, float]):
+        '''Sets the priority of each file.'''
+        self._priority = priority
+
+    def _make_ready(self, fpath: Path):
+        '''Adds a file to the queue of files that can be compiled.'''
+        # The counter keeps the order stable for equal priorities
+        self._counter += 1
+        heapq.heappush(self._ready, (-self._priority.get(fpath, 0),
+                                     self._counter, fpath))
+
+    def _get_args(self, fpath: Path):
+        '''Creates the arguments for Fab's process_file function. Only the
+        hashes of modules this file depends on are passed to the worker,
+        which avoids copying the full (and growing) dictionary of module
+        hashes for each file.'''
+        af = self._files[fpath]
+        mod_hashes = {mod: self._mod_hashes[mod] for mod in af.module_deps
+                      if mod in self._mod_hashes}
+        common_args = MpCommonArgs(config=self._mp_common_args.config,
+                                   flags=self._mp_common_args.flags,
+                                   mod_hashes=mod_hashes,
+                                   syntax_only=False)
+        return (af, common_args)
+
+    def _on_compiled(self, fpath: Path):
+        '''Updates the module hashes after a file was compiled, and
+        releases all files that were only waiting for this file.'''
+        af = self._files[fpath]
+        self._mod_hashes.update(get_mod_hashes({af}, self._config))
+        for dependent in self._dependents[fpath]:
+            deps = self._waiting[dependent]
+            deps.discard(fpath)
+            if not deps:
+                self._make_ready(dependent)
+
+    def run(self, submit, max_running: int,
+            on_result=None) -> Dict[Path, object]:
+        '''Compiles all files. At most `max_running` files are submitted
+        at the same time, so that the order in which files are compiled
+        is decided here (based on priorities), and not by the queue of
+        the process pool.
+
+        :param submit: a function that takes the arguments for Fab's
+            `process_file` and returns a future, which returns the
+            result of `timed_process_file`.
+        :param max_running: the maximum number of files submitted at the
+            same time. This should be the number of processes used.
+        :param on_result: optional function that is called with the
+            file path, the result of `process_file`, and the start and
+            end time of the compilation for every successfully compiled
+            file.
+
+        :returns: the compiled files, indexed by source path.
+        '''
+        compiled = {}
+        errors = []
+        running = {}
+        for fpath, deps in self._waiting.items():
+            if not deps:
+                self._make_ready(fpath)
+
+        while self._ready or running:
+            # Stop submitting new files once we have an error, but wait
+            # for the running compilations to finish.
+            while (self._ready and not errors and
+                   len(running) < max_running):
+                _, _, fpath = heapq.heappop(self._ready)
+                running[submit(self._get_args(fpath))] = fpath
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                fpath = running.pop(future)
+                result, artefacts, start, end = future.result()
+                if isinstance(result, Exception):
+                    errors.append(result)
+                    continue
+                compiled[fpath] = result
+                self._config.add_current_prebuilds(artefacts)
+                if on_result:
+                    on_result(fpath, result, start, end)
+                self._on_compiled(fpath)
+
+        check_for_errors(errors, caller_label="compile_fortran_streaming")
+        if len(compiled) != len(self._files):
+            # Can only happen with a dependency cycle
+            remaining = sorted(str(i) for i in
+                               set(self._files) - set(compiled))
+            raise RuntimeError(f"Could not compile {len(remaining)} file(s) "
+                               f"due to cyclic dependencies: {remaining}")
+        return compiled
+
+
+@step
+def compile_fortran_streaming(config, common_flags: Optional[List[str]] = None,
+                              path_flags: Optional[List] = None):
+    '''Compiles all Fortran files of all build trees. It takes the same
+    arguments as Fab's `compile_fortran`, and also creates the same
+    artefacts. The two-stage compilation of Fab is not supported, if
+    requested this falls back to Fab's `compile_fortran`.
+
+    :param config: the Fab build config.
+    :param common_flags: flags used for all files.
+    :param path_flags: flags used for files that match a path.
+    '''
+    if config.two_stage:
+        logger.warning("Two-stage compilation is not supported by the "
+                       "streaming compiler, using Fab's compile_fortran.")
+        compile_fortran(config, common_flags=common_flags,
+                        path_flags=path_flags)
+        return
+
+    compiler, flags_config = handle_compiler_args(config, common_flags,
+                                                  path_flags=path_flags)
+    compiler.set_module_output_path(config.build_output)
+
+    build_lists = DEFAULT_SOURCE_GETTER(config.artefact_store)
+    analysed_files = set(sum(build_lists.values(), []))
+    logger.info(f"streaming compile of {len(analysed_files)} fortran files")
+    mp_common_args = MpCommonArgs(config=config, flags=flags_config,
+                                  mod_hashes={}, syntax_only=False)
+    streaming = StreamingCompiler(config, mp_common_args, analysed_files)
+
+    # Prioritise the files using the compile times of previous builds
+    history = CompileHistory(config.project_workspace / "compile_times.json",
+                             root=config.build_output)
+    logger.info(f"compile history contains {len(history)} files")
+    estimates = {fpath: history.estimate(fpath)
+                 for fpath in streaming.dependencies}
+    streaming.priority, predicted_path = \
+        compute_critical_path(streaming.dependencies, estimates)
+    log_critical_path("predicted", predicted_path, estimates)
+
+    timings = {}
+
+    def record(fpath, result, start, end):
+        timings[fpath] = (start, end)
+        # Only record the time if the file was actually compiled, and
+        # the object file was not just taken from the prebuild folder.
+        try:
+            compiled_now = result.output_fpath.stat().st_mtime >= start - 1
+        except OSError:
+            compiled_now = False
+        if compiled_now:
+            history.update(fpath, end - start)
+
+    if config.multiprocessing:
+        with ProcessPoolExecutor(max_workers=config.n_procs) as executor:
+            compiled = streaming.run(
+                lambda args: executor.submit(timed_process_file, args),
+                max_running=config.n_procs, on_result=record)
+    else:
+        compiled = streaming.run(_run_serially, max_running=1,
+                                 on_result=record)
+    log_or_dot_finish(logger)
+
+    actual_path = compute_actual_critical_path(streaming.dependencies,
+                                               timings)
+    log_critical_path("actual", actual_path,
+                      {fpath: end - start
+                       for fpath, (start, end) in timings.items()})
+    history.save()
+
+    store_artefacts(compiled, build_lists, config.artefact_store)
+
+
+def timed_process_file(args):
+    '''Calls Fab's `process_file` and measures the time it takes.
+
+    :returns: the compilation result and the list of prebuild files (as
+        returned by `process_file`), and the start and end time.
+    '''
+    start = time.time()
+    result, artefacts = process_file(args)
+    return result, artefacts, start, time.time()
+
+
+def _run_serially(args) -> Future:
+    ''':returns: a completed future with the result of
+        `timed_process_file`.'''
+    future = Future()
+    future.set_result(timed_process_file(args))
+    return future
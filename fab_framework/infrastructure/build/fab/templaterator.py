@@ -1,17 +1,18 @@
 #!/usr/bin/python3
 
-'''This module contains a function that returns a working version of a
-rose_picker tool. It can either be a version installed in the system,
-or otherwise a checked-out version in the fab-workspace will be used.
-If required, a version of rose_picker will be checked out.
+'''This module contains the LFRic templaterator as a Fab tool, which can
+optionally cache the files it creates.
 '''
 
 import logging
 from pathlib import Path
-from typing import Dict
+from typing import Dict, Optional
 
 from fab.tools import Tool
 
+from cache_util import DirectoryCache, hash_file, hash_strings
+from file_util import replace_if_changed, write_if_changed
+
 logger = logging.getLogger('fab')
 
 
@@ -50,6 +51,42 @@ class Templaterator(Tool):
         params = [input_template, "-o", output_file]+replace
         super().run(additional_parameters=params)
 
+    def run_cached(self, input_template: Path,
+                   output_file: Path,
+                   key_values: Dict,
+                   cache: Optional[DirectoryCache] = None) -> bool:
+        '''Creates the output file from the template, but only replaces
+        an existing output file if its content has changed. If a cache is
+        specified, the output is stored in the cache, keyed by the hashes
+        of the template and the templaterator and the keys and values, and
+        the templaterator is only run if there is no cached output.
+
+        :param input_template: the input template.
+        :param output_file: the output filename.
+        :param key_values: the keys and values for the keys to define as
+            a dictionary.
+        :param cache: the cache to use.
+
+        :returns: whether the output file was written.
+        '''
+        if cache is None:
+            tmp_file = output_file.parent / f".{output_file.name}.tmp"
+            self.run(input_template, tmp_file, key_values=key_values)
+            return replace_if_changed(tmp_file, output_file)
+
+        key = hash_strings(hash_file(input_template),
+                           hash_file(Path(self.exec_name)),
+                           *sorted(f"{name}={value}" for name, value
+                                   in key_values.items()))
+        with cache.use(key,
+                       lambda dst: self.run(input_template,
+                                            dst / "output.f90",
+                                            key_values=key_values),
+                       metadata={"template": str(input_template),
+                                 "key_values": key_values}) as cached:
+            return write_if_changed(output_file,
+                                    (cached / "output.f90").read_bytes())
+
 
 # =============================================================================
 if __name__ == "__main__":
@@ -0,0 +1,15 @@
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''The build script modules are not a package, they are imported from the
+directory containing them (as the build scripts do). Tests of modules
+that need Fab are skipped if Fab is not installed.
+'''
+
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,68 @@
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''Tests for analysis_db.py.'''
+
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("fab.artefacts")
+# pylint: disable=wrong-import-position
+from analysis_db import AnalysisDatabase  # noqa: E402
+
+
+def make_config(workspace: Path):
+    ''':returns: the parts of a Fab build config used by the database.'''
+    build_output = workspace / "build_output"
+    return SimpleNamespace(build_output=build_output,
+                           prebuild_folder=build_output / "_prebuild")
+
+
+def test_harvest_and_restore(tmp_path, monkeypatch):
+    '''Analysis results are stored with a placeholder for the build
+    output, and are restored into another workspace.'''
+    monkeypatch.setattr(AnalysisDatabase, "BATCH_SIZE", 2)
+    database = AnalysisDatabase(tmp_path / "analysis.sqlite")
+
+    first = make_config(tmp_path / "first")
+    first.prebuild_folder.mkdir(parents=True)
+    file_hashes = {}
+    for i in range(5):
+        fpath = first.build_output / f"file{i}.f90"
+        file_hashes[fpath] = 100 + i
+        database.get_analysis_fpath(first, fpath, 100 + i).write_text(
+            f"{fpath} uses {first.build_output}/mod.mod", encoding="utf8")
+    assert database.harvest(first, file_hashes) == 5
+
+    second = make_config(tmp_path / "second")
+    second_hashes = {second.build_output / fpath.name: file_hash
+                     for fpath, file_hash in file_hashes.items()}
+    # A changed file is not restored
+    second_hashes[second.build_output / "file4.f90"] = 999
+    assert database.restore(second, second_hashes) == 4
+    restored = database.get_analysis_fpath(
+        second, second.build_output / "file1.f90", 101)
+    assert restored.read_text(encoding="utf8") == (
+        f"{second.build_output}/file1.f90 uses "
+        f"{second.build_output}/mod.mod")
+    # Existing prebuilds are kept
+    assert database.restore(second, second_hashes) == 0
+
+
+def test_old_entries_are_removed(tmp_path):
+    '''Entries that have not been used for too long are removed.'''
+    database = AnalysisDatabase(tmp_path / "analysis.sqlite",
+                                max_age_days=-1)
+    config = make_config(tmp_path)
+    config.prebuild_folder.mkdir(parents=True)
+    fpath = config.build_output / "a.f90"
+    database.get_analysis_fpath(config, fpath, 1).write_text(
+        "analysis", encoding="utf8")
+    assert database.harvest(config, {fpath: 1}) == 1
+    database.get_analysis_fpath(config, fpath, 1).unlink()
+    assert database.restore(config, {fpath: 1}) == 0
@@ -0,0 +1,105 @@
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+
+'''Tests for the DirectoryCache in cache_util.py.'''
+
+import os
+import threading
+import time
+
+from cache_util import DirectoryCache
+
+
+def writer(size, content="x"):
+    ''':returns: a populate function that writes a file of `size`
+        bytes.'''
+    def populate(data):
+        (data / "file").write_text(content * size)
+    return populate
+
+
+def set_last_used(cache, key, last_used):
+    '''Sets the time an entry was last used.'''
+    os.utime(cache.root / key / "entry.json", (last_used, last_used))
+
+
+def test_store_and_lookup(tmp_path):
+    '''Stored entries can be looked up, missing entries return None.'''
+    cache = DirectoryCache(tmp_path / "cache", max_size=1000)
+    data = cache.store("a", writer(10), metadata={"source": "test"})
+    assert data == cache.lookup("a")
+    assert (data / "file").read_text() == "x" * 10
+    assert cache.lookup("b") is None
+
+
+def test_lru_eviction(tmp_path):
+    '''The least recently used entries are removed once the cache is too
+    large, but never the entry that was just stored.'''
+    cache = DirectoryCache(tmp_path / "cache", max_size=250)
+    now = time.time()
+    cache.store("a", writer(100))
+    set_last_used(cache, "a", now - 30)
+    cache.store("b", writer(100))
+    set_last_used(cache, "b", now - 20)
+    # Using 'a' makes 'b' the least recently used entry
+    assert cache.lookup("a")
+    cache.store("c", writer(100))
+    assert cache.lookup("a")
+    assert cache.lookup("b") is None
+    assert cache.lookup("c")
+
+    cache.store("huge", writer(1000))
+    assert cache.lookup("huge")
+    assert cache.lookup("a") is None
+    assert cache.lookup("c") is None
+
+
+def test_concurrent_use(tmp_path):
+    '''Several threads using the same entry all get its data, and only
+    one entry is created.'''
+    cache = DirectoryCache(tmp_path / "cache", max_size=1000)
+    results = []
+    lock = threading.Lock()
+
+    def task():
+        with cache.use("a", writer(10)) as data:
+            content = (data / "file").read_text()
+        with lock:
+            results.append(content)
+
+    threads = [threading.Thread(target=task) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ["x" * 10] * 8
+    assert sorted(path.name for path in cache.root.iterdir()) == \
+        [".lock", "a"]
+
+
+def test_used_entry_is_not_evicted(tmp_path):
+    '''An entry held by `use` is not removed while it is used: storing
+    a new entry waits until the entry is released.'''
+    cache = DirectoryCache(tmp_path / "cache", max_size=150)
+    cache.store("a", writer(100))
+    set_last_used(cache, "a", time.time() - 60)
+    stored = threading.Event()
+
+    def store():
+        cache.store("b", writer(100))
+        stored.set()
+
+    with cache.use("a", writer(100)) as data:
+        set_last_used(cache, "a", time.time() - 60)
+        thread = threading.Thread(target=store)
+        thread.start()
+        assert not stored.wait(0.2)
+        assert (data / "file").read_text() == "x" * 100
+    thread.join()
+    assert stored.is_set()
+    assert cache.lookup("a") is None
+    assert cache.lookup("b")
@@ -0,0 +1,89 @@
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''Tests for compile_history.py.'''
+
+from pathlib import Path
+
+import pytest
+
+from compile_history import (CompileHistory, compute_actual_critical_path,
+                             compute_critical_path)
+
+
+def test_history_averages_and_persists(tmp_path):
+    '''New times are averaged with the stored time, and the times are
+    stored relative to the root directory.'''
+    root = tmp_path / "build"
+    root.mkdir()
+    history_file = tmp_path / "times.json"
+    history = CompileHistory(history_file, root)
+    history.update(root / "a.f90", 4.0)
+    assert history.get(root / "a.f90") == 4.0
+    history.update(root / "a.f90", 2.0)
+    assert history.get(root / "a.f90") == pytest.approx(3.0)
+    history.save()
+
+    moved = tmp_path / "moved"
+    root.rename(moved)
+    history = CompileHistory(history_file, moved)
+    assert len(history) == 1
+    assert history.get(moved / "a.f90") == pytest.approx(3.0)
+
+
+def test_invalid_history_is_ignored(tmp_path):
+    '''A corrupt history file results in an empty history.'''
+    history_file = tmp_path / "times.json"
+    history_file.write_text("{not json")
+    assert len(CompileHistory(history_file, tmp_path)) == 0
+
+
+def test_estimate(tmp_path):
+    '''Files without history are estimated from their size, using the
+    average time per byte of the files with history.'''
+    (tmp_path / "known.f90").write_text("x" * 100)
+    (tmp_path / "new.f90").write_text("x" * 50)
+    history = CompileHistory(tmp_path / "times.json", tmp_path)
+    assert history.estimate(tmp_path / "new.f90") == pytest.approx(
+        50 * CompileHistory.DEFAULT_SECONDS_PER_BYTE)
+
+    history = CompileHistory(tmp_path / "times.json", tmp_path)
+    history.update(tmp_path / "known.f90", 2.0)
+    history.update(tmp_path / "deleted.f90", 100.0)
+    assert history.estimate(tmp_path / "known.f90") == 2.0
+    assert history.estimate(tmp_path / "new.f90") == pytest.approx(1.0)
+    assert history.estimate(tmp_path / "missing.f90") == 0.0
+
+
+def test_critical_path():
+    '''The chain length of a file includes the longest chain of files
+    depending on it, and the critical path follows the longest chain.'''
+    a, b, c, d = (Path(f"{name}.f90") for name in "abcd")
+    # b and c use a, d uses b and c
+    dependencies = {a: set(), b: {a}, c: {a}, d: {b, c}}
+    costs = {a: 1.0, b: 5.0, c: 2.0, d: 1.0}
+    chain_length, path = compute_critical_path(dependencies, costs)
+    assert chain_length == {a: 7.0, b: 6.0, c: 3.0, d: 1.0}
+    assert path == [a, b, d]
+
+
+def test_critical_path_cycle():
+    '''Files in a dependency cycle get no chain length.'''
+    a, b = Path("a.f90"), Path("b.f90")
+    chain_length, path = compute_critical_path({a: {b}, b: {a}},
+                                               {a: 1.0, b: 1.0})
+    assert chain_length == {}
+    assert path == []
+
+
+def test_actual_critical_path():
+    '''The actual critical path goes back from the file that finished
+    last through the dependencies that finished last.'''
+    a, b, c, d = (Path(f"{name}.f90") for name in "abcd")
+    dependencies = {a: set(), b: {a}, c: {a}, d: {b, c}}
+    timings = {a: (0.0, 1.0), b: (1.0, 3.0), c: (1.0, 5.0), d: (5.0, 6.0)}
+    assert compute_actual_critical_path(dependencies, timings) == [a, c, d]
+    assert compute_actual_critical_path(dependencies, {}) == []
@@ -0,0 +1,109 @@
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''Tests for dag_scheduler.py.'''
+
+import threading
+import time
+
+import pytest
+
+from dag_scheduler import DagScheduler
+
+
+def test_dependencies_are_respected():
+    '''Tasks only start once their dependencies have finished.'''
+    order = []
+    lock = threading.Lock()
+
+    def task(name):
+        with lock:
+            order.append(name)
+        return name
+
+    scheduler = DagScheduler(max_workers=4)
+    scheduler.add_task("c", lambda: task("c"), ["a", "b"])
+    scheduler.add_task("a", lambda: task("a"))
+    scheduler.add_task("b", lambda: task("b"), ["a"])
+    scheduler.add_task("d", lambda: task("d"))
+    results = scheduler.run()
+    assert results == {"a": "a", "b": "b", "c": "c", "d": "d"}
+    assert order.index("a") < order.index("b") < order.index("c")
+    assert all(task.duration is not None
+               for task in scheduler.tasks.values())
+
+
+def test_add_dependency():
+    '''A dependency can be added after the task was created.'''
+    order = []
+    scheduler = DagScheduler(max_workers=2)
+    scheduler.add_task("a", lambda: order.append("a"))
+    scheduler.add_task("b", lambda: order.append("b"))
+    scheduler.add_dependency("a", "b")
+    scheduler.run()
+    assert order == ["b", "a"]
+
+
+def test_duplicate_task():
+    '''A task name can only be used once.'''
+    scheduler = DagScheduler(name="test")
+    scheduler.add_task("a", lambda: None)
+    with pytest.raises(ValueError, match="'a' already exists in 'test'"):
+        scheduler.add_task("a", lambda: None)
+
+
+def test_unknown_dependency():
+    '''Unknown dependencies are reported before any task runs.'''
+    called = []
+    scheduler = DagScheduler()
+    scheduler.add_task("a", lambda: called.append("a"), ["missing"])
+    with pytest.raises(ValueError, match="unknown task"):
+        scheduler.run()
+    assert not called
+
+
+def test_cycle():
+    '''A cycle is detected once no task can be started.'''
+    called = []
+    scheduler = DagScheduler(name="test")
+    scheduler.add_task("a", lambda: called.append("a"))
+    scheduler.add_task("b", lambda: called.append("b"), ["a", "c"])
+    scheduler.add_task("c", lambda: called.append("c"), ["b"])
+    with pytest.raises(RuntimeError, match="cyclic dependencies") as err:
+        scheduler.run()
+    assert "['b', 'c']" in str(err.value)
+    assert called == ["a"]
+
+
+def test_failure():
+    '''A failure stops the scheduling of new tasks, and is reported with
+    the tasks that were not started.'''
+    called = []
+
+    def fail():
+        raise OSError("broken")
+
+    scheduler = DagScheduler(name="test", max_workers=1)
+    scheduler.add_task("a", fail)
+    scheduler.add_task("b", lambda: called.append("b"), ["a"])
+    with pytest.raises(RuntimeError) as err:
+        scheduler.run()
+    assert "1 task(s) failed" in str(err.value)
+    assert "'a': broken" in str(err.value)
+    assert "Not started: ['b']" in str(err.value)
+    assert isinstance(err.value.__cause__, OSError)
+    assert not called
+
+
+def test_duration_excludes_queueing():
+    '''The duration of a task does not include the time it waited for a
+    free worker.'''
+    scheduler = DagScheduler(max_workers=1)
+    for name in ["a", "b", "c"]:
+        scheduler.add_task(name, lambda: time.sleep(0.05))
+    scheduler.run()
+    for task in scheduler.tasks.values():
+        assert task.duration < 0.09
@@ -0,0 +1,107 @@
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''Tests for the queries of dependency_graph.py on a synthetic graph.'''
+
+import json
+
+import pytest
+
+from dependency_graph import DependencyGraph, main
+
+# main uses a and b, a uses c, b uses c and d, c uses e; e and f form a
+# cycle (as external procedures can), and nothing uses g.
+FILES = ["main.f90", "a.f90", "b.f90", "util/c.f90", "d.f90", "e.f90",
+         "f.f90", "g.f90"]
+DEPS = {"main.f90": ["a.f90", "b.f90"],
+        "a.f90": ["util/c.f90"],
+        "b.f90": ["util/c.f90", "d.f90"],
+        "util/c.f90": ["e.f90"],
+        "e.f90": ["f.f90"],
+        "f.f90": ["e.f90"]}
+
+
+@pytest.fixture(name="graph_file")
+def fixture_graph_file(tmp_path):
+    ''':returns: a graph file in the format of export_dependency_graph.'''
+    graph = {"build_output": "/build",
+             "files": FILES,
+             "modules": [[f"{name.split('/')[-1][:-4]}_mod"]
+                         for name in FILES],
+             "deps": [[FILES.index(dep) for dep in DEPS.get(name, [])]
+                      for name in FILES],
+             "roots": {"main": 0}}
+    fpath = tmp_path / "dependency_graph.json"
+    fpath.write_text(json.dumps(graph), encoding="utf8")
+    return fpath
+
+
+def names(graph, indices):
+    ''':returns: the file names for a list of indices.'''
+    return [graph.files[i] for i in indices]
+
+
+def test_find(graph_file):
+    '''Files are found by path, trailing path or module name.'''
+    graph = DependencyGraph(graph_file)
+    assert graph.find("util/c.f90") == 3
+    assert graph.find("c.f90") == 3
+    assert graph.find("D_MOD") == 4
+    with pytest.raises(KeyError, match="matches 0 files"):
+        graph.find("missing.f90")
+
+
+def test_impact(graph_file):
+    '''All direct and indirect dependents are reported.'''
+    graph = DependencyGraph(graph_file)
+    assert names(graph, graph.impact(graph.find("c.f90"))) == [
+        "main.f90", "a.f90", "b.f90"]
+    assert names(graph, graph.impact(graph.find("f.f90"))) == [
+        "main.f90", "a.f90", "b.f90", "util/c.f90", "e.f90"]
+    assert graph.impact(graph.find("main.f90")) == []
+
+
+def test_why(graph_file):
+    '''The shortest chain from the root is reported.'''
+    graph = DependencyGraph(graph_file)
+    assert names(graph, graph.why(graph.find("e.f90"))) == [
+        "main.f90", "a.f90", "util/c.f90", "e.f90"]
+    assert names(graph, graph.why(graph.find("main.f90"), "main")) == [
+        "main.f90"]
+    assert graph.why(graph.find("g.f90")) is None
+
+
+def test_longest(graph_file):
+    '''The longest chain is found, ignoring the cycle.'''
+    graph = DependencyGraph(graph_file)
+    chain = names(graph, graph.longest())
+    assert len(chain) == 5
+    assert chain[0] == "main.f90"
+    assert chain[2:4] == ["util/c.f90", "e.f90"]
+    # Each file in the chain depends on the next one
+    for first, second in zip(chain, chain[1:]):
+        assert second in DEPS[first]
+
+
+def test_fanout(graph_file):
+    '''The direct and total number of dependents are counted.'''
+    graph = DependencyGraph(graph_file)
+    fanout = {graph.files[i]: (direct, total)
+              for direct, total, i in graph.fanout()}
+    assert fanout["util/c.f90"] == (2, 3)
+    assert fanout["main.f90"] == (0, 0)
+    assert fanout["g.f90"] == (0, 0)
+    assert fanout["d.f90"] == (1, 2)
+
+
+def test_main(graph_file, capsys):
+    '''The command line interface prints the query results.'''
+    assert main([str(graph_file), "why", "d_mod"]) == 0
+    assert capsys.readouterr().out == (
+        "main.f90\n  uses b.f90\n  uses d.f90\n")
+    assert main([str(graph_file), "why", "g.f90"]) == 1
+    assert main([str(graph_file), "impact", "missing"]) == 1
+    assert "matches 0 files" in capsys.readouterr().err
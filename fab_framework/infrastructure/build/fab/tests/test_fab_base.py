@@ -0,0 +1,102 @@
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''Tests for the pipeline mode of fab_base.py.'''
+
+import logging
+from pathlib import Path
+import pickle
+
+import pytest
+
+pytest.importorskip("fab.tools")
+# pylint: disable=wrong-import-position
+from lfric_base import LFRicBase  # noqa: E402
+
+
+class PipelineProbe(LFRicBase):
+    '''An LFRic build whose pipeline only pickles the transformation
+    script callable, as Fab's psyclone step does for its worker
+    processes.'''
+
+    def define_preprocessor_flags(self):
+        pass
+
+    def define_pipeline(self, scheduler):
+        scheduler.add_task("pickle", lambda: pickle.loads(
+            pickle.dumps(self.get_transformation_script)))
+
+    def get_transformation_script(self, fpath, config):
+        return None
+
+
+def make_build(cls):
+    ''':returns: a build object without parsing the command line.'''
+    build = cls.__new__(cls)
+    build._n_procs = 2  # pylint: disable=protected-access
+    build._process_budget = None  # pylint: disable=protected-access
+    build._grab_scheduler = None  # pylint: disable=protected-access
+    build._stage_jobs = {}  # pylint: disable=protected-access
+    build._logger = logging.getLogger('fab')  # pylint: disable=W0212
+    return build
+
+
+def test_pickle_during_pipeline():
+    '''The build object can be pickled while the pipeline is running.'''
+    build = make_build(PipelineProbe)
+    build.build_pipeline()
+    # pylint: disable=protected-access
+    assert build._process_budget is None
+
+
+def test_stage_jobs_outside_pipeline():
+    '''Outside of the pipeline a stage uses its configured processes,
+    without modifying the shared config.'''
+    build = make_build(PipelineProbe)
+    # pylint: disable=protected-access
+    build._stage_jobs = {"psyclone": 3}
+    build._config = type("Config", (), {"n_procs": 2})()
+    with build.stage_jobs("psyclone") as config:
+        assert config.n_procs == 3
+    with build.stage_jobs("compile") as config:
+        assert config.n_procs == 2
+    assert build.config.n_procs == 2
+
+
+def test_overlapping_grabs():
+    '''Grabs that write to the same files run one after another, and
+    the files are only listed if the destination folders overlap.'''
+    build = make_build(PipelineProbe)
+    listed = []
+    grabbed = []
+
+    def lister(name, files):
+        def list_files():
+            listed.append(name)
+            return [Path(fpath) for fpath in files]
+        return list_files
+
+    def add_grab(name, dst_label, files):
+        build.add_grab(name, lambda: grabbed.append(name), dst_label,
+                       lister(name, files) if files is not None else None)
+
+    with build.concurrent_grabs():
+        add_grab("a", "x", ["a.f90"])
+        add_grab("b", "y", ["a.f90"])
+        assert not listed
+        add_grab("c", "x", ["sub/b.f90"])
+        assert sorted(listed) == ["a", "c"]
+        add_grab("d", "x/sub", ["b.f90"])
+        add_grab("e", "", None)
+        # pylint: disable=protected-access
+        tasks = build._grab_scheduler.tasks
+        assert tasks["a"].dependencies == set()
+        assert tasks["b"].dependencies == set()
+        assert tasks["c"].dependencies == set()
+        assert tasks["d"].dependencies == {"c"}
+        assert tasks["e"].dependencies == {"a", "b", "c", "d"}
+    assert sorted(grabbed) == ["a", "b", "c", "d", "e"]
+    assert grabbed.index("c") < grabbed.index("d") < grabbed.index("e")
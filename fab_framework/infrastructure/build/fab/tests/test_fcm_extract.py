@@ -0,0 +1,133 @@
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+
+'''Tests for fcm_extract.py.'''
+
+from pathlib import Path
+
+import pytest
+
+from fcm_extract import FcmExtract
+
+
+@pytest.fixture(name="extract")
+def fixture_extract(tmp_path, monkeypatch):
+    '''Creates an extract file, which includes a file using $HERE, which
+    in turn includes a file found in an include path given by an
+    environment variable.
+
+    :returns: the name of the main extract file.
+    '''
+    monkeypatch.setenv("EXTRACT_INCLUDES", str(tmp_path / "includes"))
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "includes").mkdir()
+    main = tmp_path / "extract.cfg"
+    main.write_text(
+        "include-path = $EXTRACT_INCLUDES\n"
+        "extract.path-excl[um] = /   # exclude everything\n"
+        "include = $HERE/sub/first.cfg\n"
+        "extract.path-incl[um] = src/main\n")
+    (tmp_path / "sub" / "first.cfg").write_text(
+        "extract.path-incl[um] = src/first \\\n"
+        "    src/first_too\n"
+        "include = second.cfg\n")
+    (tmp_path / "includes" / "second.cfg").write_text(
+        "extract.path-incl[um] = src/second\n"
+        "include = ${EXTRACT_INCLUDES}/third.cfg\n")
+    (tmp_path / "includes" / "third.cfg").write_text(
+        "extract.path-excl[jules] = /\n")
+    return main
+
+
+def test_nested_includes(extract):
+    '''The rules of included files are inserted at the position of the
+    include statement.'''
+    fcm_extract = FcmExtract(extract)
+    assert fcm_extract["um"] == [
+        ("exclude", [Path("/")]),
+        ("include", [Path("src/first"), Path("src/first_too")]),
+        ("include", [Path("src/second")]),
+        ("include", [Path("src/main")])]
+    assert fcm_extract["jules"] == [("exclude", [Path("/")])]
+    assert fcm_extract.get_included_paths("um") == [
+        Path("first"), Path("first_too"), Path("second"), Path("main")]
+    assert sorted(fpath.name for fpath in fcm_extract.files) == [
+        "extract.cfg", "first.cfg", "second.cfg", "third.cfg"]
+
+
+def test_recursive_include(tmp_path):
+    '''A file that includes itself (indirectly) is an error.'''
+    (tmp_path / "a.cfg").write_text("include = b.cfg\n")
+    (tmp_path / "b.cfg").write_text("include = $HERE/a.cfg\n")
+    with pytest.raises(ValueError, match="Recursive include"):
+        FcmExtract(tmp_path / "a.cfg")
+
+
+def test_missing_include(tmp_path, capsys):
+    '''A missing included file is ignored.'''
+    (tmp_path / "a.cfg").write_text("include = missing.cfg\n"
+                                    "extract.path-excl[um] = /\n")
+    assert FcmExtract(tmp_path / "a.cfg")["um"] == [("exclude", [Path("/")])]
+    assert "missing.cfg" in capsys.readouterr().out
+
+
+def parse_cached(extract, cache_dir, monkeypatch):
+    ''':returns: the extract, and whether it was read from the cache.'''
+    parsed = []
+    original = FcmExtract._parse  # pylint: disable=protected-access
+
+    def parse(self, filename, include_stack):
+        parsed.append(filename)
+        original(self, filename, include_stack)
+    monkeypatch.setattr(FcmExtract, "_parse", parse)
+    fcm_extract = FcmExtract(extract, cache_dir=cache_dir)
+    monkeypatch.setattr(FcmExtract, "_parse", original)
+    return fcm_extract, not parsed
+
+
+def test_cache(extract, tmp_path, monkeypatch):
+    '''The cached result is used until an included file or a used
+    environment variable changes.'''
+    cache_dir = tmp_path / "cache"
+    expected = FcmExtract(extract)
+    fcm_extract, cached = parse_cached(extract, cache_dir, monkeypatch)
+    assert not cached
+    assert fcm_extract == expected
+    fcm_extract, cached = parse_cached(extract, cache_dir, monkeypatch)
+    assert cached
+    assert fcm_extract == expected
+    assert fcm_extract.files == expected.files
+
+    # Change a file that is included by an included file
+    third = tmp_path / "includes" / "third.cfg"
+    third.write_text("extract.path-excl[socrates] = /\n")
+    fcm_extract, cached = parse_cached(extract, cache_dir, monkeypatch)
+    assert not cached
+    assert "socrates" in fcm_extract and "jules" not in fcm_extract
+    assert parse_cached(extract, cache_dir, monkeypatch)[1]
+
+    # Change an environment variable used in an include
+    other = tmp_path / "other"
+    other.mkdir()
+    (other / "second.cfg").write_text("extract.path-incl[um] = src/other\n")
+    monkeypatch.setenv("EXTRACT_INCLUDES", str(other))
+    fcm_extract, cached = parse_cached(extract, cache_dir, monkeypatch)
+    assert not cached
+    assert ("include", [Path("src/other")]) in fcm_extract["um"]
+
+
+def test_cache_missing_include(tmp_path, monkeypatch):
+    '''The cached result is not used once a missing include exists.'''
+    cache_dir = tmp_path / "cache"
+    extract = tmp_path / "a.cfg"
+    extract.write_text("include = later.cfg\n")
+    assert parse_cached(extract, cache_dir, monkeypatch)[1] is False
+    assert parse_cached(extract, cache_dir, monkeypatch)[1] is True
+    (tmp_path / "later.cfg").write_text("extract.path-excl[um] = /\n")
+    fcm_extract, cached = parse_cached(extract, cache_dir, monkeypatch)
+    assert not cached
+    assert fcm_extract["um"] == [("exclude", [Path("/")])]
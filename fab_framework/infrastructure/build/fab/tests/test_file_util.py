@@ -0,0 +1,133 @@
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''Tests for file_util.py.'''
+
+import os
+
+import pytest
+
+from file_util import copy_tree_if_changed, link_or_copy, sync_tree
+
+
+@pytest.fixture(name="src")
+def fixture_src(tmp_path):
+    ''':returns: a source file.'''
+    src = tmp_path / "src.f90"
+    src.write_text("module a\nend module\n", encoding="utf8")
+    return src
+
+
+def test_copy(tmp_path, src):
+    '''A copy is independent of the source, and keeps its timestamps.'''
+    dst = tmp_path / "sub" / "dst.f90"
+    assert link_or_copy(src, dst, "copy") == "copy"
+    assert not os.path.samefile(src, dst)
+    assert dst.read_text(encoding="utf8") == src.read_text(encoding="utf8")
+    assert dst.stat().st_mtime_ns == src.stat().st_mtime_ns
+
+
+def test_link(tmp_path, src):
+    '''A hardlink is created, and creating it again changes nothing.'''
+    dst = tmp_path / "dst.f90"
+    assert link_or_copy(src, dst, "link") in ["link", "copy"]
+    if os.path.samefile(src, dst):
+        assert link_or_copy(src, dst, "link") == "unchanged"
+
+
+def test_reflink(tmp_path, src):
+    '''A reflink (or copy, if not supported) does not share changes with
+    the source.'''
+    dst = tmp_path / "dst.f90"
+    assert link_or_copy(src, dst, "reflink") in ["reflink", "copy"]
+    dst.write_text("changed\n", encoding="utf8")
+    assert src.read_text(encoding="utf8") == "module a\nend module\n"
+
+
+def test_replace_existing(tmp_path, src):
+    '''An existing destination is replaced.'''
+    dst = tmp_path / "dst.f90"
+    dst.write_text("old\n", encoding="utf8")
+    link_or_copy(src, dst, "auto")
+    assert dst.read_text(encoding="utf8") == "module a\nend module\n"
+
+
+def test_copy_tree_if_changed(tmp_path):
+    '''Only changed files are written, so unchanged files keep their
+    timestamps, and the transformation is applied.'''
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    (src / "sub").mkdir(parents=True)
+    (src / "a.f90").write_bytes(b"a\n")
+    (src / "sub" / "b.f90").write_bytes(b"b\n")
+
+    def transform(rel_path, content):
+        return content.upper() if rel_path.name == "a.f90" else content
+
+    assert copy_tree_if_changed(src, dst, transform) == {"unchanged": 0,
+                                                         "written": 2}
+    assert (dst / "a.f90").read_bytes() == b"A\n"
+    assert (dst / "sub" / "b.f90").read_bytes() == b"b\n"
+    mtime = (dst / "a.f90").stat().st_mtime_ns
+    os.utime(dst / "a.f90", ns=(mtime - 10**9, mtime - 10**9))
+
+    (src / "sub" / "b.f90").write_bytes(b"c\n")
+    assert copy_tree_if_changed(src, dst, transform) == {"unchanged": 1,
+                                                         "written": 1}
+    assert (dst / "a.f90").stat().st_mtime_ns == mtime - 10**9
+    assert (dst / "sub" / "b.f90").read_bytes() == b"c\n"
+
+
+@pytest.mark.parametrize("mode", ["copy", "link"])
+def test_sync_tree(tmp_path, mode):
+    '''Unchanged files are not touched, while files that were changed
+    or replaced in the source or in the destination are synchronised
+    again, and files removed from the source are removed.'''
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    manifest = tmp_path / "manifest.json"
+    (src / "sub").mkdir(parents=True)
+    for name in ["a.f90", "b.f90", "c.f90", "sub/d.f90"]:
+        (src / name).write_text(f"{name}\n", encoding="utf8")
+    counts = sync_tree(src, dst, manifest, mode)
+    assert counts["unchanged"] == 0 and counts[mode] == 4
+    assert sync_tree(src, dst, manifest, mode)["unchanged"] == 4
+
+    # Replace a destination file with a different file that has the
+    # same size and modification time as the original.
+    stat = (dst / "a.f90").stat()
+    (tmp_path / "x.f90").write_text("x.f90\n", encoding="utf8")
+    os.utime(tmp_path / "x.f90", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(tmp_path / "x.f90", dst / "a.f90")
+    # Replace a source file (as e.g. git does) and remove one
+    (tmp_path / "b.f90").write_text("changed\n", encoding="utf8")
+    os.replace(tmp_path / "b.f90", src / "b.f90")
+    (src / "sub" / "d.f90").unlink()
+    counts = sync_tree(src, dst, manifest, mode)
+    assert counts == dict.fromkeys(["unchanged", "reflink", "link", "copy",
+                                    "removed"], 0) | {"unchanged": 1,
+                                                      mode: 2, "removed": 1}
+    assert (dst / "a.f90").read_text(encoding="utf8") == "a.f90\n"
+    assert (dst / "b.f90").read_text(encoding="utf8") == "changed\n"
+    assert not (dst / "sub" / "d.f90").exists()
+    if mode == "link":
+        assert os.path.samefile(src / "a.f90", dst / "a.f90")
+
+
+def test_sync_tree_keeps_replaced_files(tmp_path):
+    '''A file removed from the source is not removed from the
+    destination if it was replaced by another file.'''
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    manifest = tmp_path / "manifest.json"
+    src.mkdir()
+    (src / "a.f90").write_text("a\n", encoding="utf8")
+    sync_tree(src, dst, manifest, "copy")
+    (src / "a.f90").unlink()
+    (dst / "a.f90").unlink()
+    (dst / "a.f90").write_text("other\n", encoding="utf8")
+    assert sync_tree(src, dst, manifest, "copy")["removed"] == 0
+    assert (dst / "a.f90").read_text(encoding="utf8") == "other\n"
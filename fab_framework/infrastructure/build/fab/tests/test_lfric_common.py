@@ -0,0 +1,105 @@
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+
+'''Tests for the configurator cache key in lfric_common.py.'''
+
+import pytest
+
+pytest.importorskip("fab.tools")
+# pylint: disable=wrong-import-position
+from lfric_common import (get_configurator_key,  # noqa: E402
+                          get_rose_meta_closure)
+
+
+def write_meta(root, name, *imports):
+    '''Creates `root/rose-meta/name/HEAD/rose-meta.conf`, which imports
+    the specified metadata (the second one on a continuation line).
+
+    :returns: the path of the file.
+    '''
+    fpath = root / "rose-meta" / name / "HEAD" / "rose-meta.conf"
+    fpath.parent.mkdir(parents=True)
+    lines = []
+    if imports:
+        lines.append(f"import={imports[0]}/HEAD")
+        lines.extend(f"      ={imported}/HEAD" for imported in imports[1:])
+    lines.append(f"[namelist:{name}]")
+    fpath.write_text("\n".join(lines) + "\n")
+    return fpath
+
+
+@pytest.fixture(name="sources")
+def fixture_sources(tmp_path):
+    '''Creates a core and an apps source tree with rose metadata: the
+    application imports the driver and a physics scheme, the driver
+    imports the base metadata, and one scheme is not used.
+
+    :returns: the core and apps directories, and all rose-meta files.
+    '''
+    core = tmp_path / "core"
+    apps = tmp_path / "apps"
+    tools = core / "infrastructure" / "build" / "tools"
+    tools.mkdir(parents=True)
+    (tools / "GenerateNamelist").write_text("#!/usr/bin/env python3\n")
+    metas = {"app": write_meta(apps / "app", "lfric-app",
+                               "lfric-driver", "um-physics"),
+             "physics": write_meta(apps / "physics", "um-physics"),
+             "unused": write_meta(apps / "unused", "socrates"),
+             "driver": write_meta(core / "driver", "lfric-driver",
+                                  "lfric-base"),
+             "base": write_meta(core / "base", "lfric-base")}
+    return core, apps, metas
+
+
+def test_rose_meta_closure(sources):
+    '''All directly and indirectly imported files are found.'''
+    core, apps, metas = sources
+    closure = get_rose_meta_closure(metas["app"], [apps, core])
+    assert closure == sorted(metas[name] for name in
+                             ["app", "physics", "driver", "base"])
+
+
+def test_rose_meta_closure_missing(sources):
+    '''A missing import results in None.'''
+    core, _, metas = sources
+    assert get_rose_meta_closure(metas["app"], [core]) is None
+
+
+@pytest.mark.parametrize("name, changes_key",
+                         [("app", True), ("base", True), ("physics", True),
+                          ("unused", False)])
+def test_configurator_key(sources, name, changes_key):
+    '''Changing an (indirectly) imported rose-meta.conf file changes the
+    key, changing an unrelated one does not.'''
+    core, apps, metas = sources
+    key = get_configurator_key(core, apps, metas["app"], "1.0")
+    with open(metas[name], "a", encoding="utf8") as f_out:
+        f_out.write("[namelist:extra]\n")
+    new_key = get_configurator_key(core, apps, metas["app"], "1.0")
+    assert (new_key != key) == changes_key
+
+
+def test_configurator_key_tools(sources):
+    '''The configurator tools and the rose_picker version are part of
+    the key.'''
+    core, apps, metas = sources
+    key = get_configurator_key(core, apps, metas["app"], "1.0")
+    assert get_configurator_key(core, apps, metas["app"], "2.0") != key
+    (core / "infrastructure" / "build" / "tools" / "GenerateLoader"
+     ).write_text("#!/usr/bin/env python3\n")
+    assert get_configurator_key(core, apps, metas["app"], "1.0") != key
+
+
+def test_configurator_key_missing_import(sources):
+    '''If an import cannot be found, all rose-meta.conf files are part
+    of the key.'''
+    core, apps, metas = sources
+    metas["physics"].unlink()
+    key = get_configurator_key(core, apps, metas["app"], "1.0")
+    with open(metas["unused"], "a", encoding="utf8") as f_out:
+        f_out.write("[namelist:extra]\n")
+    assert get_configurator_key(core, apps, metas["app"], "1.0") != key
@@ -0,0 +1,99 @@
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+
+'''Tests for memory_budget.py.'''
+
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import memory_budget
+from memory_budget import (memory_admission, memory_limited, MemoryBudget,
+                           parse_memory)
+
+
+@pytest.mark.parametrize("value, expected",
+                         [("123", 123), ("2kb", 2048), ("500mb", 500 * 2**20),
+                          ("32GB", 32 * 2**30), ("1.5g", int(1.5 * 2**30)),
+                          (" 2 TiB ", 2 * 2**40), ("4gw", 4 * 2**30)])
+def test_parse_memory(value, expected):
+    '''Memory specifications in the formats used by PBS are parsed.'''
+    assert parse_memory(value) == expected
+
+
+@pytest.mark.parametrize("value", ["", "GB", "12 apples", "-1gb"])
+def test_parse_memory_invalid(value):
+    '''Invalid memory specifications raise a ValueError.'''
+    with pytest.raises(ValueError, match="Cannot parse"):
+        parse_memory(value)
+
+
+def run_reservations(budget, sizes):
+    '''Reserves the specified amounts from the budget in threads, which
+    are started one after another, and hold the reservation for a short
+    time.
+
+    :returns: the maximum number of concurrent reservations.
+    '''
+    lock = threading.Lock()
+    state = {"running": 0, "max_running": 0}
+
+    def task(nbytes):
+        with budget.reserve(nbytes):
+            with lock:
+                state["running"] += 1
+                state["max_running"] = max(state["max_running"],
+                                           state["running"])
+            time.sleep(0.05)
+            with lock:
+                state["running"] -= 1
+
+    threads = [threading.Thread(target=task, args=(nbytes,))
+               for nbytes in sizes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return state["max_running"]
+
+
+def test_budget_admission():
+    '''Tasks only run at the same time if they fit into the budget.'''
+    assert run_reservations(MemoryBudget(100), [40, 40]) == 2
+    assert run_reservations(MemoryBudget(100), [60, 60, 60]) == 1
+
+
+def test_budget_large_task():
+    '''A task larger than the budget runs on its own.'''
+    assert run_reservations(MemoryBudget(100), [500]) == 1
+    assert run_reservations(MemoryBudget(100), [500, 10]) == 1
+
+
+def test_concurrent_labels(tmp_path):
+    '''Each label has its own budget, so stages using different labels
+    can be active at the same time.'''
+    config = SimpleNamespace(project_workspace=tmp_path)
+    with memory_limited(config, "first", 100):
+        with memory_limited(config, "second", 200):
+            # pylint: disable=protected-access
+            assert memory_budget._active["first"].budget.limit == 100
+            assert memory_budget._active["second"].budget.limit == 200
+            with pytest.raises(RuntimeError, match="already active"):
+                with memory_limited(config, "first", 100):
+                    pass
+        # Leaving the second stage does not affect the first one
+        assert memory_budget._active["first"].budget.limit == 100
+        with memory_admission("first", "file.f90") as measurement:
+            measurement["peak"] = 2**30
+        assert (tmp_path / "memory_first.records").exists()
+        with memory_admission("second", "file.f90") as measurement:
+            assert measurement == {}
+    assert not memory_budget._active
+    history = memory_budget.MemoryHistory(tmp_path / "memory_first.json")
+    assert history.estimate("file.f90") >= 2**30
@@ -0,0 +1,50 @@
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''Tests for parallelism.py.'''
+
+import threading
+
+import pytest
+
+from parallelism import parse_stage_jobs, ProcessBudget
+
+
+def test_parse_stage_jobs():
+    '''Settings are converted, and invalid settings are rejected.'''
+    stages = ["grab", "psyclone"]
+    assert parse_stage_jobs(None, stages) == {}
+    assert parse_stage_jobs(["psyclone=4", " grab=2"], stages) == {
+        "psyclone": 4, "grab": 2}
+    with pytest.raises(ValueError, match="expected 'STAGE=N'"):
+        parse_stage_jobs(["psyclone"], stages)
+    with pytest.raises(ValueError, match="Invalid number"):
+        parse_stage_jobs(["psyclone=0"], stages)
+    with pytest.raises(ValueError, match="Unknown stage"):
+        parse_stage_jobs(["psyclon=4"], stages)
+
+
+def test_process_budget():
+    '''Concurrent reservations never exceed the budget, and a stage gets
+    at least one process.'''
+    budget = ProcessBudget(4)
+    with budget.reserve(3) as first:
+        assert first == 3
+        with budget.reserve(8) as second:
+            assert second == 1
+            granted = []
+
+            def third():
+                with budget.reserve(2) as n_procs:
+                    granted.append(n_procs)
+
+            thread = threading.Thread(target=third)
+            thread.start()
+            thread.join(0.1)
+            # The budget is exhausted, so the third stage must wait
+            assert thread.is_alive()
+        thread.join()
+        assert granted == [1]
@@ -0,0 +1,73 @@
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''Tests for path_filter_index.py, which must give the same result as
+evaluating Fab's path filters in order.'''
+
+import random
+from types import SimpleNamespace
+
+from path_filter_index import PathFilterIndex
+
+ROOT = "/workspace/source"
+
+
+def linear_check(rules, path):
+    ''':returns: the result of evaluating the rules in order, as done by
+        Fab's find_source_files (the last matching rule wins).'''
+    result = None
+    for filter_strings, include in rules:
+        if any(str(string) in path for string in filter_strings):
+            result = include
+    return result
+
+
+def test_last_rule_wins():
+    '''Later rules take precedence, independent of the rule type.'''
+    index = PathFilterIndex(ROOT)
+    index.add_rule([f"{ROOT}/um"], False)
+    index.add_rule([f"{ROOT}/um/control"], True)
+    index.add_rule(["/test/"], False)
+    assert len(index) == 3
+    assert index.check(f"{ROOT}/um/atmos/a.F90") is False
+    assert index.check(f"{ROOT}/um/control/b.F90") is True
+    assert index.check(f"{ROOT}/um/control/test/c.F90") is False
+    assert index.check(f"{ROOT}/jules/d.F90") is None
+    index.add_rule([f"{ROOT}/um"], True)
+    assert index.check(f"{ROOT}/um/control/test/c.F90") is True
+
+
+def test_from_filters():
+    '''An index can be created from Fab's Include and Exclude filters.'''
+    filters = [SimpleNamespace(filter_strings=[f"{ROOT}/a", "/b/"],
+                               include=False),
+               SimpleNamespace(filter_strings=[f"{ROOT}/a/b"], include=True)]
+    index = PathFilterIndex.from_filters(filters, root=ROOT)
+    assert index.check(f"{ROOT}/a/x.f90") is False
+    assert index.check(f"{ROOT}/a/b/x.f90") is True
+    assert index.check(f"{ROOT}/c/b/x.f90") is False
+
+
+def test_random_rules():
+    '''The index agrees with the linear evaluation for random rules.'''
+    rand = random.Random(1)
+    dirs = [f"{ROOT}/science/dir{i // 5}/sub{i % 5}" for i in range(50)]
+    rules = [([f"{ROOT}/science"], False)]
+    for _ in range(200):
+        kind = rand.random()
+        if kind < 0.7:
+            strings = [rand.choice(dirs)]
+        elif kind < 0.9:
+            strings = [f"/sub{rand.randrange(5)}/"]
+        else:
+            strings = [rand.choice(dirs), f"/dir{rand.randrange(10)}/"]
+        rules.append((strings, rand.random() < 0.5))
+    index = PathFilterIndex(ROOT)
+    for strings, include in rules:
+        index.add_rule(strings, include)
+    for i in range(1000):
+        path = f"{rand.choice(dirs)}/file_{i}.F90"
+        assert index.check(path) == linear_check(rules, path), path
@@ -0,0 +1,98 @@
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+
+'''Tests for the cache key of the PSyclone tool in psyclone_tool.py.'''
+
+import pytest
+
+pytest.importorskip("fab.tools")
+# pylint: disable=wrong-import-position
+import psyclone_tool  # noqa: E402
+from psyclone_tool import LFRicPsyclone  # noqa: E402
+
+
+def make_tree(root):
+    '''Creates an algorithm file, which uses a kernel module in a file
+    that is not named after the module, and a module in an include
+    directory, together with a transformation script and config file.
+
+    :returns: the parameters for PSyclone.
+    '''
+    kernels = root / "kernels"
+    kernels.mkdir(parents=True)
+    (kernels / "kernels.f90").write_text(
+        "module my_kernel_mod\nuse base_mod\nend module my_kernel_mod\n")
+    include = root / "include"
+    include.mkdir()
+    (include / "base.f90").write_text("module base_mod\nend module\n")
+    (root / "optimisation").mkdir()
+    (root / "optimisation" / "global.py").write_text("# script\n")
+    (root / "psyclone.cfg").write_text("[DEFAULT]\n")
+    x90_file = root / "algorithm.x90"
+    x90_file.write_text("program alg\nuse my_kernel_mod\nend program\n")
+    return ["-api", "dynamo0.3", "-opsy", str(root / "psy.f90"),
+            "-oalg", str(root / "alg.f90"), "-l", "all",
+            "-s", str(root / "optimisation" / "global.py"),
+            f"--config={root / 'psyclone.cfg'}",
+            "-I", str(include), "-d", str(kernels), str(x90_file)]
+
+
+def get_key(root, params):
+    ''':returns: the cache key of a new tool that indexed `root`.'''
+    tool = LFRicPsyclone()
+    tool.index_modules([root / "kernels"])
+    return tool.get_cache_key(params)
+
+
+@pytest.fixture(name="tree")
+def fixture_tree(tmp_path, monkeypatch):
+    ''':returns: the root of a source tree, and the parameters.'''
+    # PSyclone does not need to be installed
+    monkeypatch.setattr(psyclone_tool.metadata, "version",
+                        lambda name: "3.0")
+    root = tmp_path / "first"
+    return root, make_tree(root)
+
+
+def test_key_independent_of_location(tmp_path, tree):
+    '''The key does not depend on where the files are stored.'''
+    root, params = tree
+    other = tmp_path / "second"
+    assert get_key(root, params) == get_key(other, make_tree(other))
+    assert get_key(root, params[:-1] + ["alg.f90"]) is None
+
+
+@pytest.mark.parametrize("fpath", ["algorithm.x90", "kernels/kernels.f90",
+                                   "include/base.f90",
+                                   "optimisation/global.py",
+                                   "optimisation/helper.py",
+                                   "psyclone.cfg"])
+def test_key_depends_on_content(tree, fpath):
+    '''Changing the algorithm file, a (directly or indirectly) used
+    module, the transformation script or a Python file next to it, or
+    the configuration file changes the key.'''
+    root, params = tree
+    key = get_key(root, params)
+    with open(root / fpath, "a", encoding="utf8") as f_out:
+        f_out.write("! changed\n")
+    assert get_key(root, params) != key
+
+
+def test_key_depends_on_options(tree):
+    '''Options without a path are part of the key.'''
+    root, params = tree
+    key = get_key(root, params)
+    params = params[:-1] + ["--profile", "kernels", params[-1]]
+    assert get_key(root, params) != key
+
+
+def test_unused_module(tree):
+    '''Modules that are not used do not change the key.'''
+    root, params = tree
+    key = get_key(root, params)
+    (root / "kernels" / "unused.f90").write_text("module unused_mod\nend\n")
+    assert get_key(root, params) == key
@@ -0,0 +1,165 @@
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''Tests for source_index.py. Pruning must be conservative: a file that
+might be needed must never be removed.'''
+
+from source_index import get_reachable_files, scan_source, SourceIndex
+
+
+def write(path, content):
+    '''Writes a file and returns its path.'''
+    path.write_text(content, encoding="utf8")
+    return path
+
+
+def test_scan_source(tmp_path):
+    '''Module definitions and uses are found, ignoring 'module procedure'
+    and the modules defined in the same file.'''
+    fpath = write(tmp_path / "a.f90", """
+module a_mod
+  use, intrinsic :: iso_c_binding
+  use b_mod, only: b
+  use a_mod
+  interface x
+    module procedure y
+  end interface
+end module a_mod
+""")
+    assert scan_source(fpath) == ({"a_mod"}, {"iso_c_binding", "b_mod"})
+
+
+def test_closure(tmp_path):
+    '''The closure contains the files that define the (indirectly) used
+    modules, but not unrelated files.'''
+    a_file = write(tmp_path / "a.f90", "module a\nuse b\nend module\n")
+    b_file = write(tmp_path / "b.f90", "module b\nuse c\nend module\n")
+    c_file = write(tmp_path / "c.f90", "module c\nuse mpi\nend module\n")
+    write(tmp_path / "d.f90", "module d\nend module\n")
+    alg = write(tmp_path / "alg.x90", "program alg\nuse a\nend program\n")
+    index = SourceIndex(tmp_path.glob("*.f90"))
+    assert index.get_module_file("B") == b_file
+    assert index.get_closure([alg]) == {a_file, b_file, c_file}
+    assert index.get_closure([b_file]) == {b_file, c_file}
+
+
+def test_reachable_files(tmp_path):
+    '''Files are reached by use statements, calls (also of subroutines in
+    fixed form files), includes and DEPENDS ON comments.'''
+    files = {
+        "main.F90": """program main
+#ifdef UNUSED_OPTION
+use optional_mod
+#endif
+use a_mod
+#include "defs.h"
+call legacy()
+end program
+""",
+        "a_mod.f90": "module a_mod\n! DEPENDS ON: helper\nend module\n",
+        "optional_mod.f90": "module optional_mod\nend module\n",
+        "defs.h": "integer, parameter :: n = 1\n",
+        "legacy.f": ("      subroutine legacy\n      call modern()\n"
+                     "      end\n"),
+        "modern.f90": "subroutine modern()\nend subroutine\n",
+        "helper.f90": "subroutine helper()\nend subroutine\n",
+        "unused.f90": "module unused\nend module\n",
+        "unused_sub.f90": "subroutine unused_sub()\nend subroutine\n",
+    }
+    fpaths = {name: write(tmp_path / name, content)
+              for name, content in files.items()}
+    needed = get_reachable_files(fpaths.values(), "main")
+    assert {fpath.name for fpath in needed} == (
+        set(files) - {"unused.f90", "unused_sub.f90"})
+
+
+def test_reachable_files_always_keeps(tmp_path):
+    '''External functions and C bindings outside of a module can be used
+    without a use statement or call, and seeds are always needed.'''
+    write(tmp_path / "main.f90", "program main\nend program\n")
+    func = write(tmp_path / "func.f90",
+                 "real function f(x)\nreal x\nf = x\nend function\n")
+    bind_c = write(tmp_path / "bind.f90",
+                   "subroutine s() bind(c)\nend subroutine\n")
+    seed = write(tmp_path / "seed.f90", "module seed\nuse dep\nend module\n")
+    dep = write(tmp_path / "dep.f90", "module dep\nend module\n")
+    unused = write(tmp_path / "unused.f90", "module unused\nend module\n")
+    needed = get_reachable_files(
+        [tmp_path / "main.f90", func, bind_c, dep, unused], "main",
+        seeds=[seed])
+    assert func in needed
+    assert bind_c in needed
+    assert seed in needed
+    assert dep in needed
+    assert unused not in needed
+
+
+def test_reachable_files_without_root(tmp_path):
+    '''If the root program is not found, all files are needed.'''
+    fpaths = [write(tmp_path / "a.f90", "module a\nend module\n"),
+              write(tmp_path / "b.f90", "module b\nend module\n")]
+    assert get_reachable_files(fpaths, ["main"]) == set(fpaths)
+
+
+def test_reachable_submodule(tmp_path):
+    '''A file that only contains a submodule is needed if its ancestor
+    module is needed.'''
+    write(tmp_path / "main.f90",
+          "program main\nuse parent_mod\nend program\n")
+    write(tmp_path / "parent.f90", "module parent_mod\nend module\n")
+    child = write(tmp_path / "child.f90",
+                  "submodule (parent_mod) child\nend submodule child\n")
+    grandchild = write(tmp_path / "grandchild.f90",
+                       "submodule (parent_mod:child) grandchild\n"
+                       "end submodule grandchild\n")
+    other = write(tmp_path / "other.f90",
+                  "submodule (other_mod) other\nend submodule other\n")
+    needed = get_reachable_files(tmp_path.glob("*.f90"), "main")
+    assert child in needed
+    assert grandchild in needed
+    assert other not in needed
+
+
+def test_reachable_external_and_argument(tmp_path):
+    '''External subroutines that are only named in an EXTERNAL statement
+    or passed as actual argument are needed.'''
+    write(tmp_path / "main.f90", """program main
+external ext_sub
+call solve(rhs_sub)
+end program
+""")
+    ext = write(tmp_path / "ext.f90", "subroutine ext_sub()\nend subroutine\n")
+    rhs = write(tmp_path / "rhs.f90", "subroutine rhs_sub()\nend subroutine\n")
+    solve = write(tmp_path / "solve.f90",
+                  "subroutine solve(f)\nexternal f\ncall f()\n"
+                  "end subroutine\n")
+    needed = get_reachable_files(tmp_path.glob("*.f90"), "main")
+    assert {ext, rhs, solve} <= needed
+
+
+def test_reachable_bind_c_in_module(tmp_path):
+    '''A module with C bindings is kept, since it might only be called
+    from C.'''
+    write(tmp_path / "main.f90", "program main\nend program\n")
+    bound = write(tmp_path / "bound.f90", """module bound_mod
+contains
+subroutine from_c() bind(c, name="from_c")
+end subroutine
+end module
+""")
+    needed = get_reachable_files(tmp_path.glob("*.f90"), "main")
+    assert bound in needed
+
+
+def test_reachable_include_of_fortran_file(tmp_path):
+    '''A Fortran file included with its full name is needed.'''
+    write(tmp_path / "main.F90", '''program main
+#include "body.F90"
+end program
+''')
+    body = write(tmp_path / "body.F90", "print *, 'included'\n")
+    needed = get_reachable_files(tmp_path.glob("*.F90"), "main")
+    assert body in needed
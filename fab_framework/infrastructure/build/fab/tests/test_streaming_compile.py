@@ -0,0 +1,107 @@
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''Tests for streaming_compile.py.'''
+
+from concurrent.futures import Future
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("fab.steps.compile_fortran")
+
+import streaming_compile  # noqa: E402
+from streaming_compile import StreamingCompiler  # noqa: E402
+
+
+class FakeConfig:
+    '''Collects the prebuild artefacts of the compiled files.'''
+    def __init__(self):
+        self.prebuilds = []
+
+    def add_current_prebuilds(self, artefacts):
+        '''Stores the prebuild artefacts.'''
+        self.prebuilds.extend(artefacts)
+
+
+class FakeAnalysedFile:
+    '''An analysed file defining module `name` which uses the modules
+    `deps`, each of which is defined in a file of the same name.'''
+    def __init__(self, name, *deps):
+        self.fpath = Path(f"{name}.f90")
+        self.file_deps = {Path(f"{dep}.f90") for dep in deps}
+        self.module_defs = {name}
+        self.module_deps = set(deps)
+
+
+@pytest.fixture(name="compiler")
+def fixture_compiler(monkeypatch):
+    ''':returns: a function creating a StreamingCompiler for files.'''
+    monkeypatch.setattr(streaming_compile, "get_mod_hashes",
+                        lambda files, config: {mod: 1 for af in files
+                                               for mod in af.module_defs})
+
+    def create(files, priority=None):
+        args = streaming_compile.MpCommonArgs(config=None, flags=None,
+                                              mod_hashes={},
+                                              syntax_only=False)
+        return StreamingCompiler(FakeConfig(), args, files, priority)
+    return create
+
+
+def run_serially(streaming, order, fail=()):
+    '''Runs the compiler with a fake compilation that fails for the
+    files in `fail`. The name of each submitted file and the modules
+    whose hashes are passed to the worker are appended to `order`.
+
+    :returns: the compiled files.
+    '''
+
+    def submit(args):
+        af, common_args = args
+        order.append((af.fpath.stem, set(common_args.mod_hashes)))
+        future = Future()
+        if af.fpath.stem in fail:
+            future.set_result((ValueError(af.fpath.stem), [], 0, 0))
+        else:
+            future.set_result((af.fpath.stem, [af.fpath.stem], 0, 0))
+        return future
+    return streaming.run(submit, max_running=1)
+
+
+def test_dependencies_and_priority(compiler):
+    '''Files are only compiled after their dependencies, and ready files
+    are compiled in the order of their priority.'''
+    files = [FakeAnalysedFile("a"), FakeAnalysedFile("b"),
+             FakeAnalysedFile("c", "a"), FakeAnalysedFile("d", "b", "c")]
+    priority = {Path("a.f90"): 1, Path("b.f90"): 5, Path("c.f90"): 2}
+    streaming = compiler(files, priority)
+    order = []
+    compiled = run_serially(streaming, order)
+    # Only the hashes of the used modules are passed to the worker
+    assert order == [("b", set()), ("a", set()), ("c", {"a"}),
+                     ("d", {"b", "c"})]
+    assert compiled == {af.fpath: af.fpath.stem for af in files}
+    # pylint: disable=protected-access
+    assert streaming._config.prebuilds == ["b", "a", "c", "d"]
+
+
+def test_error_stops_submission(compiler):
+    '''After a failed compilation no new files are submitted, and the
+    error is reported.'''
+    files = [FakeAnalysedFile("a"), FakeAnalysedFile("b"),
+             FakeAnalysedFile("c", "a")]
+    priority = {Path("a.f90"): 2, Path("b.f90"): 1}
+    order = []
+    with pytest.raises(RuntimeError, match="error.*streaming"):
+        run_serially(compiler(files, priority), order, fail={"a"})
+    assert order == [("a", set())]
+
+
+def test_missing_dependency(compiler):
+    '''A dependency on a file that is not compiled is an error.'''
+    with pytest.raises(ValueError, match="unfulfilled dependencies"):
+        compiler([FakeAnalysedFile("a", "missing")])
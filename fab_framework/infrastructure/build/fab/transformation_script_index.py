@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+
+'''This module contains an index of the PSyclone transformation scripts
+in an optimisation directory. A file `a/b/c.x90` uses the script
+`a/b/c.py` in the optimisation directory if it exists, otherwise the
+script `global.py`. The optimisation directory is scanned once, so that
+looking up the script for a file does not need to access the file system
+(which, on a parallel file system like Lustre, is expensive when done
+for every x90 file).
+'''
+
+from collections import Counter
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Union
+
+logger = logging.getLogger('fab')
+
+
+class TransformationScriptIndex:
+    '''An index of the transformation scripts in an optimisation directory.
+
+    :param optimisation_path: the optimisation directory.
+    :param base_paths: the directories the processed files are in. The
+        path of a file relative to its base path determines its script.
+    '''
+    def __init__(self, optimisation_path: Path, base_paths: List[Path]):
+        self._optimisation_path = optimisation_path
+        self._base_paths = base_paths
+        self._scripts: Dict[str, Path] = {}
+        for root, _, files in os.walk(optimisation_path):
+            rel_root = Path(root).relative_to(optimisation_path)
+            for name in files:
+                if name.endswith(".py"):
+                    self._scripts[str(rel_root / name)] = Path(root) / name
+        self._global = self._scripts.get("global.py")
+        logger.info(f"Found {len(self._scripts)} transformation scripts "
+                    f"in '{optimisation_path}'.")
+
+    def get_per_file_script(self, fpath: Path) -> Union[Path, str]:
+        ''':returns: the transformation script specific to this file, or
+            "" if there is none.'''
+        relative_path = None
+        for base_path in self._base_paths:
+            try:
+                relative_path = fpath.relative_to(base_path)
+            except ValueError:
+                pass
+        if relative_path:
+            return self._scripts.get(str(relative_path.with_suffix(".py")),
+                                     "")
+        return ""
+
+    def get_script(self, fpath: Path) -> Union[Path, str]:
+        ''':returns: the transformation script to be used for this file,
+            which is the script specific to this file, or otherwise the
+            global script, or "" if neither exists.'''
+        return self.get_per_file_script(fpath) or self._global or ""
+
+    def report(self, fpaths: Iterable[Path], report_file: Path) -> Counter:
+        '''Writes the script used for each file into a report file, and
+        logs how many files use a per-file script, the global script, or
+        no script.
+
+        :param fpaths: the files processed by PSyclone.
+        :param report_file: the file to write the report to.
+
+        :returns: the number of files per kind of script.
+        '''
+        counts = Counter()
+        lines = []
+        for fpath in sorted(fpaths):
+            script = self.get_script(fpath)
+            if not script:
+                kind = "none"
+            elif script == self._global:
+                kind = "global"
+            else:
+                kind = "per-file"
+            counts[kind] += 1
+            lines.append(f"{fpath}\t{kind}\t{script}\n")
+        report_file.parent.mkdir(parents=True, exist_ok=True)
+        report_file.write_text("".join(lines), encoding="utf8")
+        logger.info(f"Transformation scripts: {dict(counts)}, see "
+                    f"'{report_file}'.")
+        return counts
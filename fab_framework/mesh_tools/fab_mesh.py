@@ -11,8 +11,6 @@ contained in the infrastructure directory.
 
 import logging
 
-from fab.steps.grab.folder import grab_folder
-
 from lfric_base import LFRicBase
 
 
@@ -24,8 +22,8 @@ class FabMeshTool(LFRicBase):
 
         # pylint: disable=redefined-builtin
         for dir in dirs:
-            grab_folder(self.config, src=self.lfric_core_root / dir,
-                        dst_label='')
+            self.grab_folder(src=self.lfric_core_root / dir,
+                             dst_label='')
 
     def get_rose_meta(self):
         return (self.lfric_core_root / 'mesh_tools' / 'rose-meta' /
@@ -10,6 +10,11 @@ export FAB_FRAMEWORK_REPO=$PWD
 mkdir /scratch/hc46/hc46_gitlab/lfric_fab
 export FAB_WORKSPACE=/scratch/hc46/hc46_gitlab/lfric_fab
 
+# The caches (source exports, PSyclone and configurator output, analysis
+# results) must not be in FAB_WORKSPACE, which is removed by the clean job
+export LFRIC_FAB_CACHE=/scratch/hc46/hc46_gitlab/lfric_fab_cache
+mkdir -p $LFRIC_FAB_CACHE
+
 # get the current lfric_core revision from the repo mirror
 lfric_core_rev=$(svn info file:///g/data/ki32/mosrs/lfric/LFRic/trunk | grep Revision | sed 's/.* //g')
 echo $lfric_core_rev > lfric_core_revision
@@ -56,7 +61,8 @@ export PYTHONPATH=$PWD/fab/source
 cd $PATH_TO_APPS/applications/lfric_atm/
 echo "current dir"
 echo $PWD
-imagerun PSYCLONE_CONFIG= PSYCLONE_TRANSFORMATION= FAB_WORKSPACE=$FAB_WORKSPACE PYTHONPATH=$PYTHONPATH FC=   \
+imagerun PSYCLONE_CONFIG= PSYCLONE_TRANSFORMATION= FAB_WORKSPACE=$FAB_WORKSPACE \
+         LFRIC_FAB_CACHE=$LFRIC_FAB_CACHE PYTHONPATH=$PYTHONPATH FC=   \
          CC=icc LD= $PATH_TO_CORE/build.sh \
          ./fab_lfric_atm.py --site nci --platform gadi --mpi       \
                       --suite intel-classic                        \